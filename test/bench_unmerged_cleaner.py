@@ -0,0 +1,419 @@
+#! /usr/bin/env python
+
+"""
+``test/bench_unmerged_cleaner.py`` measures how the :ref:`unmerged-ref` scales.
+It builds a synthetic ``/store/unmerged`` tree, then times each phase of a full run
+and records the memory used, for both values of **WHICH_LIST**,
+and for each **TREE_TYPE** and the ``'decision'`` **SCAN_MODE** when listing directories::
+
+    ./bench_unmerged_cleaner.py --sizes 10000,100000,1000000 --output results.json
+
+The tree is held by the ``'memory'`` storage backend by default,
+so that the cleaner itself is measured instead of the file system.
+Pass ``--storage posix --path <DIR>`` to build the tree on disk instead.
+Each case runs in a fresh process, so the memory of one case does not hide another.
+Results are stored as JSON. Passing an earlier result with ``--compare``
+prints how much each phase changed, and exits with an error if any phase
+got slower than ``--tolerance`` allows.
+
+The tree has ``--depth`` levels of directories below the unmerged directory,
+like ``<era>/<dataset>/<tier>/<processing>/<block>``, with the leaves holding files.
+Each leaf is either old or new. A fraction of the old leaves also hold a few new files,
+and a fraction of the second level directories are protected.
+"""
+
+
+import os
+import sys
+import time
+import json
+import math
+import random
+import shutil
+import tempfile
+import datetime
+import subprocess
+import types
+from optparse import OptionParser
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+TOP_LFN = '/store/unmerged'
+MIN_AGE = 60 * 60 * 24 * 7 * 2
+
+
+def load_cleaner(opts, unmerged_location, deletion_file):
+    """
+    Imports ``ListDeletable`` with a configuration made for the benchmark,
+    instead of the one for the site.
+
+    :param opts: are the parsed command line options
+    :param str unmerged_location: is the PFN of the unmerged directory
+    :param str deletion_file: is where the deletion file is written
+    :returns: the ListDeletable module
+    :rtype: module
+    """
+
+    sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'unmerged-cleaner'))
+
+    config = types.ModuleType('config')
+    config.SITE_NAME = 'T2_XX_Benchmark'
+    config.LFN_TO_CLEAN = TOP_LFN
+    config.UNMERGED_DIR_LOCATION = unmerged_location
+    config.DELETION_FILE = deletion_file
+    config.STORAGE_TYPE = opts.storage
+    config.MIN_AGE = MIN_AGE
+    config.SLEEP_TIME = 0
+    config.SCAN_THREADS = opts.scan_threads
+    config.DELETE_THREADS = opts.delete_threads
+    config.SCAN_CACHE = ''
+    sys.modules['config'] = config
+
+    import ListDeletable
+    import StorageTools
+    StorageTools.BACKENDS['memory'] = StorageTools.MemoryBackend
+    return ListDeletable
+
+
+def iter_namespace(opts, n_files, now):
+    """
+    Generates the synthetic tree.
+
+    :param opts: are the parsed command line options
+    :param int n_files: is the number of files to make
+    :param float now: is the time that the ages are relative to
+    :returns: the path relative to the unmerged directory, whether it is a directory,
+              the size, and the modification time of each entry, parents first
+    :rtype: generator
+    """
+
+    rng = random.Random(opts.seed)
+
+    n_leaves = max(1, n_files / opts.files_per_dir)
+    fanout = max(2, int(math.ceil(n_leaves ** (1.0 / opts.depth))))
+    names = ['era', 'dataset', 'tier', 'processing', 'block']
+
+    made = set([''])
+    made_files = 0
+    leaf = 0
+
+    while made_files < n_files:
+        # Spread the leaves over the tree like digits of a number
+        parts = []
+        index = leaf
+        for level in xrange(opts.depth):
+            parts.append('%s%i' % (names[level] if level < len(names) else 'dir',
+                                   index % fanout))
+            index /= fanout
+        leaf += 1
+
+        old = rng.random() < opts.old_fraction
+        # Some old leaves are still being written to
+        mixed = old and rng.random() < opts.mixed_fraction
+        dir_time = now - (rng.uniform(MIN_AGE, 8 * MIN_AGE) if old else
+                          rng.uniform(0, MIN_AGE / 2))
+
+        path = ''
+        for part in parts:
+            path = '/'.join([path, part]) if path else part
+            if path not in made:
+                made.add(path)
+                yield path, True, 0, dir_time
+
+        for i_file in xrange(min(rng.randint(1, 2 * opts.files_per_dir - 1),
+                                 n_files - made_files)):
+            if old and not (mixed and rng.random() < 0.1):
+                mtime = dir_time - rng.uniform(0, 60 * 60 * 24)
+            else:
+                mtime = now - rng.uniform(0, MIN_AGE / 2)
+            size = int(rng.lognormvariate(math.log(opts.size_mb * 1024 * 1024), 1))
+            yield '%s/file_%i.root' % (path, i_file), False, size, mtime
+            made_files += 1
+
+
+def protected_lfns(opts):
+    """
+    :param opts: are the parsed command line options
+    :returns: the protected LFNs, which are some of the directories at the second level
+    :rtype: list
+    """
+
+    rng = random.Random(opts.seed + 1)
+    protected = []
+    # Protected directories are picked from the same names that the generator uses
+    for era in xrange(opts.max_fanout):
+        for dataset in xrange(opts.max_fanout):
+            if rng.random() < opts.protected_fraction:
+                protected.append('%s/era%i/dataset%i' % (TOP_LFN, era, dataset))
+
+    return protected
+
+
+def memory_mb():
+    """
+    :returns: the current and peak resident memory of this process, in MB
+    :rtype: tuple
+    """
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kB, and Mac OS gives bytes
+    peak /= 1024.0 if sys.platform != 'darwin' else 1024.0 * 1024.0
+
+    current = None
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm', 'r') as statm:
+            current = int(statm.read().split()[1]) * \
+                os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+    return current, peak
+
+
+def run_case(opts, n_files, mode):
+    """
+    Runs every phase for one size and **WHICH_LIST** mode.
+
+    :param opts: are the parsed command line options
+    :param int n_files: is the number of files in the tree
+    :param str mode: is ``'directories'`` or ``'files'``
+    :returns: the results of the case
+    :rtype: dict
+    """
+
+    work_dir = tempfile.mkdtemp(prefix='bench_unmerged_')
+    if opts.storage == 'posix':
+        unmerged_location = os.path.join(opts.path or work_dir, 'store/unmerged')
+    else:
+        unmerged_location = TOP_LFN
+
+    cleaner = load_cleaner(opts, unmerged_location, os.path.join(work_dir, 'to_delete.txt'))
+    cleaner.config.WHICH_LIST = mode
+    cleaner.PROTECTED_LIST = protected_lfns(opts)
+    cleaner.PROTECTED_LIST.sort()
+
+    now = time.time()
+    cleaner.NOW = int(now)
+
+    result = {'files': n_files, 'mode': mode, 'phases': {}, 'order': []}
+    stdout = sys.stdout
+
+    def phase(name, function, *args):
+        """Times one phase, with the cleaner's own printing hidden"""
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            function(*args)
+        finally:
+            elapsed = time.time() - start
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        current, peak = memory_mb()
+        result['phases'][name] = {'seconds': elapsed, 'rss_mb': current, 'max_rss_mb': peak}
+        result['order'].append(name)
+
+    def generate():
+        """Puts the tree into the storage"""
+        storage = cleaner.get_storage()
+        for path, is_dir, size, mtime in iter_namespace(opts, n_files, now):
+            full_path = os.path.join(unmerged_location, path)
+            if opts.storage == 'memory':
+                storage.add(full_path, is_dir, size, mtime)
+            elif is_dir:
+                os.makedirs(full_path)
+            else:
+                with open(full_path, 'w') as new_file:
+                    new_file.truncate(size)
+                os.utime(full_path, (mtime, mtime))
+
+        if opts.storage == 'posix':
+            # Directory times change while the files are made, so they are set last
+            for path, is_dir, _, mtime in iter_namespace(opts, n_files, now):
+                if is_dir:
+                    os.utime(os.path.join(unmerged_location, path), (mtime, mtime))
+
+    def count_deletions():
+        """Records the size of the deletion list"""
+        with open(cleaner.config.DELETION_FILE, 'r') as deletions:
+            result['deletions'] = sum(1 for line in deletions if line.strip())
+
+    try:
+        phase('generate', generate)
+
+        if mode == 'directories':
+            for tree_type in ['objects', 'columnar']:
+                cleaner.config.TREE_TYPE = tree_type
+                phase('list_%s' % tree_type, cleaner.main)
+            cleaner.config.SCAN_MODE = 'decision'
+            phase('list_decision', cleaner.main)
+        else:
+            phase('list_files', cleaner.main)
+
+        count_deletions()
+        phase('delete', cleaner.do_delete)
+
+    finally:
+        shutil.rmtree(work_dir)
+        if opts.storage == 'posix' and opts.path:
+            shutil.rmtree(os.path.join(opts.path, 'store'), ignore_errors=True)
+
+    return result
+
+
+def compare(old_results, new_results, tolerance):
+    """
+    Prints the change of each phase between two sets of results.
+
+    :param dict old_results: are earlier results
+    :param dict new_results: are the results to check
+    :param float tolerance: is the fraction that a phase can get slower before it is a regression
+    :returns: the number of regressions
+    :rtype: int
+    """
+
+    old_cases = dict([((case['files'], case['mode']), case) for case in old_results['cases']])
+    regressions = 0
+
+    print '%-9s %-12s %-16s %10s %10s %7s' % ('Files', 'Mode', 'Phase', 'Old [s]', 'New [s]', 'Ratio')
+    for case in new_results['cases']:
+        old_case = old_cases.get((case['files'], case['mode']))
+        if old_case is None:
+            continue
+
+        for name in case['order']:
+            if name not in old_case['phases']:
+                continue
+
+            old_time = old_case['phases'][name]['seconds']
+            new_time = case['phases'][name]['seconds']
+            ratio = new_time / old_time if old_time else 1.0
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = ' SLOWER'
+                regressions += 1
+
+            print '%-9i %-12s %-16s %10.3f %10.3f %7.2f%s' % \
+                (case['files'], case['mode'], name, old_time, new_time, ratio, flag)
+
+    return regressions
+
+
+def git_commit():
+    """
+    :returns: the commit of the repository being measured, if it can be found
+    :rtype: str
+    """
+
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return out.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    """
+    Runs the benchmark with the command line options.
+    """
+
+    parser = OptionParser('Usage: ./%prog [options]')
+    parser.add_option('--sizes', default='10000,100000,1000000',
+                      help='Comma separated numbers of files to test. [default: %default]')
+    parser.add_option('--modes', default='directories,files',
+                      help='Comma separated values of WHICH_LIST to test. [default: %default]')
+    parser.add_option('--storage', default='memory', choices=['memory', 'posix'],
+                      help='Where the tree is built, memory or posix. [default: %default]')
+    parser.add_option('--path', help='The directory to build a posix tree in. '
+                      'By default, a temporary directory is used.')
+    parser.add_option('--depth', type='int', default=5,
+                      help='Levels of directories in the tree. [default: %default]')
+    parser.add_option('--files-per-dir', type='int', default=50, dest='files_per_dir',
+                      help='Average number of files in each leaf. [default: %default]')
+    parser.add_option('--size-mb', type='float', default=100.0, dest='size_mb',
+                      help='Typical file size in MB, spread log-normally. [default: %default]')
+    parser.add_option('--old-fraction', type='float', default=0.7, dest='old_fraction',
+                      help='Fraction of leaves older than MIN_AGE. [default: %default]')
+    parser.add_option('--mixed-fraction', type='float', default=0.1, dest='mixed_fraction',
+                      help='Fraction of old leaves that also hold new files. [default: %default]')
+    parser.add_option('--protected-fraction', type='float', default=0.1,
+                      dest='protected_fraction',
+                      help='Fraction of second level directories protected. [default: %default]')
+    parser.add_option('--max-fanout', type='int', default=64, dest='max_fanout',
+                      help='Largest fanout considered when picking protected directories. '
+                      '[default: %default]')
+    parser.add_option('--scan-threads', type='int', default=1, dest='scan_threads',
+                      help='SCAN_THREADS for the listing. [default: %default]')
+    parser.add_option('--delete-threads', type='int', default=1, dest='delete_threads',
+                      help='DELETE_THREADS for the deletion. [default: %default]')
+    parser.add_option('--seed', type='int', default=12345,
+                      help='Seed of the tree generator. [default: %default]')
+    parser.add_option('--output', default='bench_results.json',
+                      help='File to store the results in. [default: %default]')
+    parser.add_option('--compare', metavar='FILE',
+                      help='Earlier results to compare against.')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='Fraction slower that counts as a regression. [default: %default]')
+    parser.add_option('--case', nargs=2, metavar='FILES MODE',
+                      help='Run a single case in this process and print the result. '
+                      'This is used by the benchmark itself.')
+
+    opts, _ = parser.parse_args()
+
+    if opts.case:
+        print json.dumps(run_case(opts, int(opts.case[0]), opts.case[1]))
+        return
+
+    # Every argument except --output and --compare is passed on to each case
+    passed = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg in ('--output', '--compare'):
+            skip = True
+        elif not arg.startswith('--output=') and not arg.startswith('--compare='):
+            passed.append(arg)
+
+    results = {
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'commit': git_commit(),
+        'options': dict([(key, value) for key, value in vars(opts).iteritems()
+                         if key not in ('output', 'compare', 'case')]),
+        'cases': []
+        }
+
+    for n_files in [int(size) for size in opts.sizes.split(',')]:
+        for mode in opts.modes.split(','):
+            print 'Running %i files listing %s...' % (n_files, mode)
+            out = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + passed +
+                                   ['--case', str(n_files), mode], stdout=subprocess.PIPE)
+            output = out.communicate()[0]
+            if out.returncode:
+                print 'Case failed with exit code %i' % out.returncode
+                exit(out.returncode)
+
+            case = json.loads(output.strip().splitlines()[-1])
+            results['cases'].append(case)
+
+            for name in case['order']:
+                print '    %-16s %10.3f s  %8.1f MB peak' % \
+                    (name, case['phases'][name]['seconds'], case['phases'][name]['max_rss_mb'])
+
+    with open(opts.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print 'Results written to %s' % opts.output
+
+    if opts.compare:
+        with open(opts.compare, 'r') as compare_file:
+            regressions = compare(json.load(compare_file), results, opts.tolerance)
+        if regressions:
+            print '%i phases got slower.' % regressions
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
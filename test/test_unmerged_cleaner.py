@@ -16,15 +16,29 @@ The script can take two optional arguments for testing for the file system at yo
 
 import os
 import sys
+import errno
 import unittest
 import random
 import uuid
 import testfixtures
 import time
 import shutil
+import json
+import tempfile
+import thread
+import threading
+import BaseHTTPServer
 
 import CMSToolBox._loadtestpath
 import ListDeletable
+import CacheTools
+import ConfigTools
+import ProtectionTools
+import DumpTools
+import MetricsTools
+import PosixTools
+import StorageTools
+import WatchTools
 
 
 # Check if the place to do the test is already used or not
@@ -43,10 +57,10 @@ protected_list = ['protected1', 'dir/that/is/protected', 'delete/except/protecte
 ListDeletable.PROTECTED_LIST = [os.path.join(ListDeletable.config.LFN_TO_CLEAN, protected) \
                                     for protected in protected_list]
 ListDeletable.PROTECTED_LIST.sort()
-ListDeletable.PROTECTED_UPPER_DIRS = set()
-ListDeletable.ALL_LENGTHS = list(set(
-        len(protected) for protected in ListDeletable.PROTECTED_LIST))
-ListDeletable.ALL_LENGTHS.sort()
+ListDeletable.PROTECTED_INDEX = ProtectionTools.ProtectedTrie(ListDeletable.PROTECTED_LIST)
+
+# Only tests can pick the storage simulated in memory
+StorageTools.BACKENDS['memory'] = StorageTools.MemoryBackend
 
 
 class TestUnmergedFunctions(unittest.TestCase):
@@ -77,6 +91,155 @@ class TestUnmergedFunctions(unittest.TestCase):
             self.assertEqual(ListDeletable.bi_search(test_list, popped),
                              False, 'bi_search found a string when it should not.')
 
+    def test_protected_trie(self):
+        trie = ProtectionTools.ProtectedTrie(ListDeletable.PROTECTED_LIST)
+
+        for protected in ListDeletable.PROTECTED_LIST:
+            self.assertTrue(trie.is_protected(protected))
+            self.assertTrue(trie.is_under(protected + '/sub/file.root'))
+            self.assertFalse(trie.is_protected(protected + '/sub'))
+            self.assertFalse(trie.holds_protected(protected))
+
+            parent = os.path.dirname(protected)
+            while parent != '/':
+                self.assertTrue(trie.holds_protected(parent))
+                self.assertFalse(trie.is_under(parent))
+                parent = os.path.dirname(parent)
+
+        for path in ['/store/unmerged/dir/that', '/store/unmerged/dir/that/is']:
+            self.assertEqual(trie.lookup(path), trie.HOLDS_PROTECTED)
+        for path in ['/store/unmerged/dir/that/is/not', '/store/unmerged/protected',
+                     '/store/unmerged/protected10', '/store/other/protected1']:
+            self.assertEqual(trie.lookup(path), trie.NOT_PROTECTED)
+
+        index_file = 'protected_index.json'
+        trie.save(index_file)
+        loaded = ProtectionTools.ProtectedTrie.load(index_file)
+        os.remove(index_file)
+
+        self.assertEqual(loaded.root, trie.root)
+        self.assertTrue(loaded.is_protected(ListDeletable.PROTECTED_LIST[0]))
+
+    def test_pfn_cache(self):
+        requests = []
+        connections = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                connections.append(self.client_address)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                requests.append(self.path)
+                lfn = self.path.split('lfn=')[-1]
+                body = json.dumps({'phedex': {'mapping': [{'pfn': '/mnt/site' + lfn}]}})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        url = 'http://127.0.0.1:%i/phedex/datasvc/json/prod' % server.server_port
+        cache_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(cache_dir, 'pfns.json')
+        lfns = ['/store/unmerged', '/store/temp', '/store/user']
+
+        try:
+            # Many LFNs share one connection
+            cache = ConfigTools.PfnCache(cache_file, 3600)
+            self.assertEqual(cache.resolve('T2_Test', lfns, url),
+                             dict([(lfn, '/mnt/site' + lfn) for lfn in lfns]))
+            self.assertEqual(len(requests), 3)
+            self.assertEqual(len(connections), 1)
+            self.assertTrue(requests[0].startswith('/phedex/datasvc/json/prod/lfn2pfn?'))
+
+            # Fresh PFNs come from the file only
+            self.assertEqual(ConfigTools.pfn_from_cache('T2_Test', lfns[0], cache_file, 3600, url),
+                             '/mnt/site/store/unmerged')
+            self.assertEqual(len(requests), 3)
+
+            # Other sites and expired PFNs are asked for again
+            ConfigTools.pfn_from_cache('T2_Other', lfns[0], cache_file, 3600, url)
+            ConfigTools.pfn_from_cache('T2_Test', lfns[0], cache_file, 0, url)
+            self.assertEqual(len(requests), 5)
+
+            # A PFN dated in the future is asked for again
+            with open(cache_file, 'r') as cached:
+                entries = json.load(cached)
+            entries[ConfigTools.PfnCache.key('T2_Test', lfns[2])] = {
+                'pfn': '/planted', 'found': time.time() + 3600 * 24 * 365}
+            with open(cache_file, 'w') as cached:
+                json.dump(entries, cached)
+            self.assertEqual(ConfigTools.pfn_from_cache('T2_Test', lfns[2], cache_file, 3600, url),
+                             '/mnt/site/store/user')
+            self.assertEqual(len(requests), 6)
+
+            # An expired PFN is still used when Phedex is down
+            server.shutdown()
+            server.server_close()
+            self.assertEqual(ConfigTools.pfn_from_cache('T2_Test', lfns[1], cache_file, 0, url),
+                             '/mnt/site/store/temp')
+            self.assertRaises(SystemExit, ConfigTools.pfn_from_cache,
+                              'T2_Test', '/store/data', cache_file, 0, url)
+
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_adaptive_rate(self):
+        limiter = ListDeletable.AdaptiveRateLimiter(10, 0.1, 0.2, window=2)
+        deleted = [('path', 'deleted', '')]
+        failed = [('path', 'failed', 'Permission denied')]
+
+        # Nothing changes until the end of a window
+        limiter.observe(0.01, 1, deleted)
+        self.assertEqual(limiter.rate, 10)
+        limiter.observe(0.01, 1, deleted)
+        self.assertEqual(limiter.rate, 11)
+        self.assertEqual(limiter.interval, 1.0 / 11)
+
+        # Latency is per operation, so a slow call that counted as many is fine
+        limiter.observe(0.5, 10, deleted)
+        limiter.observe(0.5, 10, deleted)
+        self.assertEqual(limiter.rate, 12)
+
+        limiter.observe(0.5, 1, deleted)
+        limiter.observe(0.01, 1, deleted)
+        self.assertEqual(limiter.rate, 6)
+
+        limiter.observe(0.01, 1, deleted * 3)
+        limiter.observe(0.01, 1, failed)
+        self.assertEqual(limiter.rate, 3)
+        self.assertTrue('failed' in limiter.decisions[-1][2])
+
+        # The rate does not drop below a hundredth of where it started
+        for _ in range(20):
+            limiter.observe(1.0, 1, failed)
+        self.assertEqual(limiter.rate, 0.1)
+        self.assertEqual([rate for _, rate, _ in limiter.decisions],
+                         [11, 12, 6, 3, 1.5, 0.75, 0.375, 0.1875, 0.1])
+
+    def test_pattern_matcher(self):
+        patterns = list(set(''.join(random.choice('ab/') for _ in range(random.randint(1, 6)))
+                            for _ in range(50)))
+        matcher = ProtectionTools.PatternMatcher()
+        for pattern in patterns:
+            matcher.add(pattern, pattern)
+
+        for _ in range(200):
+            text = ''.join(random.choice('ab/c') for _ in range(random.randint(0, 30)))
+            self.assertEqual(sorted(set(matcher.find(text))),
+                             sorted([pattern for pattern in patterns if pattern in text]),
+                             'Matcher gives the wrong patterns for %s' % text)
+
     def test_get_protected(self):
         protected = ListDeletable.get_protected()
         self.assertTrue(isinstance(protected, list), 'Protected list is not a list.')
@@ -85,6 +248,82 @@ class TestUnmergedFunctions(unittest.TestCase):
             self.assertTrue(one_dir.startswith('/store/'),
                             'Protected directory %s does not have expected LFN.' % one_dir)
 
+    def test_protected_cache(self):
+        protected = ['/store/unmerged/protected/%i' % i for i in range(5)]
+        requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.headers.get('If-None-Match'))
+                if requests[-1] == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = json.dumps({'protected': protected})
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        old_config = dict([(key, getattr(ListDeletable.config, key)) for key in
+                           ['PROTECTED_SOURCE', 'PROTECTED_CACHE',
+                            'PROTECTED_REFRESH', 'PROTECTED_MAX_AGE']])
+
+        cache_dir = tempfile.mkdtemp()
+        ListDeletable.config.PROTECTED_SOURCE = 'http://127.0.0.1:%i/list.txt' % server.server_port
+        ListDeletable.config.PROTECTED_CACHE = os.path.join(cache_dir, 'protected.json')
+        ListDeletable.config.PROTECTED_REFRESH = 0
+        ListDeletable.config.PROTECTED_MAX_AGE = 3600
+
+        try:
+            # Download, then only check
+            self.assertEqual(ListDeletable.get_protected(), protected)
+            self.assertEqual(ListDeletable.get_protected(), protected)
+            self.assertEqual(requests, [None, '"v1"'])
+
+            # Recent enough to not check
+            ListDeletable.config.PROTECTED_REFRESH = 3600
+            self.assertEqual(ListDeletable.get_protected(), protected)
+            self.assertEqual(len(requests), 2)
+
+            # A copy dated in the future is not trusted
+            with open(ListDeletable.config.PROTECTED_CACHE, 'w') as cache_file:
+                json.dump({'source': ListDeletable.config.PROTECTED_SOURCE,
+                           'checked': time.time() + 3600 * 24 * 365,
+                           'etag': None, 'last_modified': None,
+                           'protected': []}, cache_file)
+            self.assertEqual(ListDeletable.get_protected(), protected)
+            self.assertEqual(len(requests), 3)
+
+            # Use the stale copy when the source is down, but only for so long
+            server.shutdown()
+            server.server_close()
+            ListDeletable.config.PROTECTED_REFRESH = 0
+            self.assertEqual(ListDeletable.get_protected(), protected)
+            ListDeletable.config.PROTECTED_MAX_AGE = 0
+            self.assertRaises(SystemExit, ListDeletable.get_protected)
+
+            # A local file can be the source too
+            source = os.path.join(cache_dir, 'list.txt')
+            with open(source, 'w') as source_file:
+                json.dump({'protected': protected[:2]}, source_file)
+            ListDeletable.config.PROTECTED_SOURCE = source
+            self.assertEqual(ListDeletable.get_protected(), protected[:2])
+
+        finally:
+            for key, value in old_config.iteritems():
+                setattr(ListDeletable.config, key, value)
+            shutil.rmtree(cache_dir)
+
 
 class TestUnmergedFileChecks(unittest.TestCase):
 
@@ -122,6 +361,352 @@ class TestUnmergedFileChecks(unittest.TestCase):
         self.assertTrue(ListDeletable.get_mtime(tmp_file) <= int(after_create),
                         'File appears newer than it actually is.')
 
+    def test_list_entries(self):
+        for log_size in range(1, 4):
+            self.tmpdir.write('listing/file_{0}'.format(log_size),
+                              bytearray(os.urandom(10 ** log_size)))
+            self.tmpdir.makedir('listing/dir_{0}'.format(log_size))
+
+        listing = self.tmpdir.getpath('listing')
+        entries = ListDeletable.list_entries(listing)
+
+        self.assertEqual(sorted([entry.name for entry in entries if entry.is_dir]),
+                         sorted(ListDeletable.list_folder(listing, 'subdirs')))
+        self.assertEqual(sorted([entry.name for entry in entries if not entry.is_dir]),
+                         sorted(ListDeletable.list_folder(listing, 'files')))
+
+        for entry in entries:
+            if not entry.is_dir:
+                file_name = os.path.join(listing, entry.name)
+                self.assertEqual(entry.size, ListDeletable.get_file_size(file_name))
+                self.assertEqual(entry.mtime, ListDeletable.get_mtime(file_name))
+
+    def test_unmerged_files_stream(self):
+        names = ['with space/file name.root', 'tab\tdir/file.root', 'plain/file.root']
+        old_time = time.time() - 3600
+        for name in names:
+            os.utime(self.tmpdir.write(name, 'old file'), (old_time, old_time))
+        self.tmpdir.write('plain/new_file.root', 'new file')
+
+        ListDeletable.config.MIN_AGE = 60
+        files = ListDeletable.iter_unmerged_files(chunk_size=7)
+
+        self.assertFalse(isinstance(files, list))
+        self.assertEqual(sorted(files), sorted([self.tmpdir.getpath(name) for name in names]))
+
+    def test_old_files(self):
+        self.make_random_tree()
+        for avoided in ListDeletable.config.DIRS_TO_AVOID:
+            self.tmpdir.write(os.path.join(avoided, 'file.root'), 'avoided file')
+
+        ListDeletable.config.MIN_AGE = 60
+
+        unmerged = ListDeletable.config.UNMERGED_DIR_LOCATION
+        skipped = [os.path.join(unmerged, avoided) + '/'
+                   for avoided in ListDeletable.config.DIRS_TO_AVOID] + \
+            [ListDeletable.lfn_to_pfn(protected) + '/'
+             for protected in ListDeletable.PROTECTED_LIST]
+
+        expected = sorted([name for name in ListDeletable.iter_unmerged_files()
+                           if not [skip for skip in skipped if name.startswith(skip)]])
+
+        self.assertNotEqual(expected, [])
+        self.assertEqual(sorted(ListDeletable.iter_old_files(4)), expected)
+
+        # Vanished directories are skipped, and other errors end the walk instead of hanging
+        list_entries = ListDeletable.list_entries
+        vanished = os.path.dirname(expected[0])
+
+        def failing(name, *args):
+            if name.rstrip('/') == vanished:
+                raise OSError(error_number, os.strerror(error_number), name)
+            return list_entries(name, *args)
+
+        ListDeletable.list_entries = failing
+        try:
+            error_number = errno.ENOENT
+            self.assertEqual(sorted(ListDeletable.iter_old_files(4)),
+                             [name for name in expected if not name.startswith(vanished + '/')])
+
+            error_number = errno.EIO
+            self.assertRaises(OSError, list, ListDeletable.iter_old_files(4))
+        finally:
+            ListDeletable.list_entries = list_entries
+
+    def make_random_tree(self, num_dirs=200):
+        # Makes a random tree with back-dated files and returns the top level directories
+
+        old_time = time.time() - 3600
+        all_dirs = list(protected_list)
+
+        for i_dir in xrange(num_dirs):
+            parent = random.choice(all_dirs + ['top%i' % random.randint(0, 4)])
+            all_dirs.append(os.path.join(parent, 'sub%i' % i_dir))
+
+        for next_dir in all_dirs:
+            self.tmpdir.makedir(next_dir)
+            for i_file in xrange(random.randint(0, 3)):
+                file_name = self.tmpdir.write(os.path.join(next_dir, 'file_%i.root' % i_file),
+                                              bytearray(random.randint(0, 2048)))
+                if random.random() < 0.9:
+                    os.utime(file_name, (old_time, old_time))
+
+        return ListDeletable.list_folder(unmerged_location, 'subdirs')
+
+    def test_parallel_fill(self):
+        top_dirs = self.make_random_tree()
+
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        serial = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+        for node in serial:
+            node.fill()
+
+        parallel = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+        ListDeletable.fill_parallel(parallel, 8)
+
+        self.compare_trees(serial, parallel, 'Parallel fill')
+
+    def compare_trees(self, first, second, what):
+        # Checks that two lists of filled DataNodes match everywhere
+        while first:
+            first_node = first.pop()
+            second_node = second.pop()
+
+            for attr in ['path_name', 'can_vanish', 'latest', 'size', 'nsubnodes', 'nsubfiles']:
+                self.assertEqual(getattr(first_node, attr), getattr(second_node, attr),
+                                 '%s gives different %s for %s' %
+                                 (what, attr, first_node.path_name))
+
+            first.extend(sorted(first_node.sub_nodes, key=lambda node: node.path_name))
+            second.extend(sorted(second_node.sub_nodes, key=lambda node: node.path_name))
+
+        self.assertEqual(second, [])
+
+    def test_memory_backend(self):
+        top_dirs = self.make_random_tree()
+
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        posix = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+        for node in posix:
+            node.fill()
+
+        # Copy the tree into memory, then scan it again with the memory backend
+        storage_type = ListDeletable.config.STORAGE_TYPE
+        ListDeletable.config.STORAGE_TYPE = 'memory'
+        memory = ListDeletable.get_storage()
+        for path, dirs, files in os.walk(unmerged_location):
+            for name in dirs + files:
+                stats = os.stat(os.path.join(path, name))
+                memory.add(os.path.join(path, name), name in dirs, stats.st_size, stats.st_mtime)
+
+        try:
+            in_memory = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+            for node in in_memory:
+                node.fill()
+        finally:
+            ListDeletable.config.STORAGE_TYPE = storage_type
+
+        self.compare_trees(posix, in_memory, 'Memory backend')
+
+    def test_decision_scan(self):
+        top_dirs = self.make_random_tree()
+
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        storage_type = ListDeletable.config.STORAGE_TYPE
+        ListDeletable.config.STORAGE_TYPE = 'memory'
+        memory = ListDeletable.get_storage()
+        for path, dirs, files in os.walk(unmerged_location):
+            for name in dirs + files:
+                stats = os.stat(os.path.join(path, name))
+                memory.add(os.path.join(path, name), name in dirs, stats.st_size, stats.st_mtime)
+
+        # More than one new file makes sure that some file comes after the first
+        for i_file in xrange(10):
+            memory.add(os.path.join(unmerged_location, 'mixed/file_%i.root' % i_file),
+                       False, 100, ListDeletable.NOW - (i_file % 2) * 3600)
+        top_dirs.append('mixed')
+
+        try:
+            full = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+            for node in full:
+                node.fill()
+
+            ListDeletable.config.SCAN_MODE = 'decision'
+            decided = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+            for node in decided:
+                node.fill()
+        finally:
+            ListDeletable.config.STORAGE_TYPE = storage_type
+            ListDeletable.config.SCAN_MODE = 'full'
+
+        num_deletable = 0
+        while full:
+            full_node = full.pop()
+            decided_node = decided.pop()
+
+            attrs = ['path_name', 'can_vanish', 'nsubnodes', 'nsubfiles']
+            if full_node.can_vanish:
+                attrs.append('latest')
+            for attr in attrs:
+                self.assertEqual(getattr(full_node, attr), getattr(decided_node, attr),
+                                 'Decision scan gives different %s for %s' %
+                                 (attr, full_node.path_name))
+
+            # Sizes are only found for the deletable directories
+            self.assertEqual(decided_node.files_size, 0)
+            if full_node.can_vanish:
+                num_deletable += 1
+                self.assertEqual(ListDeletable.add_sizes([decided_node])[0].size, full_node.size)
+
+            full.extend(sorted(full_node.sub_nodes, key=lambda node: node.path_name))
+            decided.extend(sorted(decided_node.sub_nodes, key=lambda node: node.path_name))
+
+        self.assertTrue(num_deletable)
+
+        # The POSIX backend finds the same entries, whether or not it can skip stats
+        for i_entry in xrange(10):
+            self.tmpdir.write('listing/file_%i.root' % i_entry, 'new file')
+            if i_entry % 3 == 0:
+                self.tmpdir.makedir('listing/sub_%i' % i_entry)
+        listing = os.path.join(unmerged_location, 'listing')
+        backend = StorageTools.PosixBackend()
+        listed = sorted([entry[:2] for entry in backend.list_dir(listing)])
+        self.assertEqual(
+            sorted([entry[:2] for entry in backend.list_dir_until(listing, ListDeletable.NOW)]),
+            listed)
+
+        # Without scandir, subdirectories are still found after every file is too new
+        scandir = StorageTools.scandir
+        StorageTools.scandir = None
+        try:
+            self.assertEqual(
+                sorted([entry[:2] for entry in backend.list_dir_until(listing, 0)]), listed)
+        finally:
+            StorageTools.scandir = scandir
+
+    def test_scan_cache(self):
+        top_dirs = self.make_random_tree()
+
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        # Directories that were just made are too new to cache
+        old_time = time.time() - 3600
+        for path, _, _ in os.walk(unmerged_location):
+            os.utime(path, (old_time, old_time))
+
+        cache_file = self.tmpdir.getpath('../scan_cache.db')
+
+        def fill(use_cache):
+            if use_cache:
+                ListDeletable.SCAN_CACHE = CacheTools.ScanCache(cache_file)
+            nodes = [ListDeletable.DataNode(top_dir) for top_dir in top_dirs]
+            for node in nodes:
+                node.fill()
+
+            cache = ListDeletable.SCAN_CACHE
+            if cache is not None:
+                cache.save()
+            ListDeletable.SCAN_CACHE = None
+            return nodes, cache
+
+        try:
+            cached, cache = fill(True)
+            self.assertEqual(cache.hits, 0)
+            self.compare_trees(fill(False)[0], cached, 'Cold scan cache')
+
+            cached, cache = fill(True)
+            self.assertTrue(cache.hits > 0)
+            self.compare_trees(fill(False)[0], cached, 'Warm scan cache')
+
+            # Add an old file and remove a directory without touching the parents
+            changed = os.path.join(unmerged_location, top_dirs[0])
+            new_file = os.path.join(changed, 'new_file.root')
+            with open(new_file, 'w') as output:
+                output.write('data')
+            os.utime(new_file, (old_time, old_time))
+            removed = ListDeletable.list_folder(
+                os.path.join(unmerged_location, top_dirs[-1]), 'subdirs')
+            if removed:
+                shutil.rmtree(os.path.join(unmerged_location, top_dirs[-1], removed[0]))
+
+            # Wait long enough for the changed directories to be cached again
+            time.sleep(CacheTools.ScanCache.RACY_SECONDS)
+
+            cached, cache = fill(True)
+            self.assertTrue(cache.misses > 0)
+            self.compare_trees(fill(False)[0], cached, 'Changed scan cache')
+
+        finally:
+            os.remove(cache_file)
+
+    def test_columnar_tree(self):
+        top_dirs = self.make_random_tree()
+
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        numpy = ListDeletable.numpy
+        for use_numpy in set([False, numpy is not None]):
+            ListDeletable.numpy = numpy if use_numpy else None
+
+            for top_dir in top_dirs:
+                data_node = ListDeletable.DataNode(top_dir)
+                data_node.fill()
+                expected = []
+                data_node.traverse_tree(expected)
+
+                columnar = ListDeletable.ColumnarTree(top_dir)
+                columnar.fill()
+                self.assertEqual(len(columnar), data_node.nsubnodes + 1)
+                result = []
+                columnar.traverse_tree(result)
+
+                self.assertEqual(
+                    [(node.path_name, node.nsubnodes, node.nsubfiles, node.size, node.latest)
+                     for node in expected], result,
+                    'Columnar tree gives different results for %s, using NumPy: %s' %
+                    (top_dir, use_numpy))
+
+        ListDeletable.numpy = numpy
+
+    def test_deep_tree(self):
+        depth = 300
+        deep_dir = '/'.join(['d'] * depth)
+
+        file_name = self.tmpdir.write(os.path.join(deep_dir, 'test_file.root'),
+                                      bytearray(1024))
+        old_time = time.time() - 3600
+        os.utime(file_name, (old_time, old_time))
+
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        # Make sure the tree is deeper than the recursion limit
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(depth - 100)
+        try:
+            top_node = ListDeletable.DataNode('d')
+            top_node.fill()
+            top_node.aggregate_tree()
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+        self.assertTrue(top_node.can_vanish)
+        self.assertEqual(top_node.nsubnodes, depth - 1)
+        self.assertEqual(top_node.nsubfiles, 1)
+        self.assertEqual(top_node.size, 1024)
+
+        list_to_del = []
+        top_node.traverse_tree(list_to_del)
+        self.assertEqual(list_to_del, [top_node])
+
     def do_deletion(self, delete_function):
         # Pass a function that does the deletion
 
@@ -168,13 +753,6 @@ class TestUnmergedFileChecks(unittest.TestCase):
                 ],         # Test the do_delete function
             'hadoop': [
                 ListDeletable.do_delete,               # Test the do_delete function
-# The Perl script is not configurable enough for unit tests at the moment
-#                lambda: os.system(                     # Test the Perl script
-#                    '%s %s' % (
-#                        os.path.join(os.path.dirname(__file__), '../unmerged-cleaner/HadoopDelete.pl'),
-#                        ListDeletable.config.DELETION_FILE
-#                        )
-#                    )
                 ],
             'dcache': []
             }
@@ -214,6 +792,597 @@ class TestUnmergedFileChecks(unittest.TestCase):
         self.assertFalse(os.path.exists(self.tmpdir.getpath(os.path.dirname(test_to_delete))))
         self.assertTrue(os.path.exists(self.tmpdir.getpath('dir')))
 
+    def test_threaded_deletions(self):
+        if ListDeletable.config.STORAGE_TYPE != 'posix':
+            return
+
+        files = [self.tmpdir.write('dir%i/file%i.root' % (i % 4, i), 'data')
+                 for i in range(40)]
+        missing = self.tmpdir.getpath('dir0/missing.root')
+
+        if not os.path.exists(os.path.dirname(ListDeletable.config.DELETION_FILE)):
+            os.makedirs(os.path.dirname(ListDeletable.config.DELETION_FILE))
+        with open(ListDeletable.config.DELETION_FILE, 'w') as deletions:
+            for name in files + [missing]:
+                deletions.write(name + '\n')
+
+        ListDeletable.config.WHICH_LIST = 'files'
+        ListDeletable.config.DELETE_THREADS = 4
+        ListDeletable.config.DELETE_RATE = 200
+
+        start = time.time()
+        ListDeletable.do_delete()
+
+        # 41 deletions at 200 per second
+        self.assertTrue(time.time() - start >= 0.2)
+        for name in files:
+            self.assertFalse(os.path.exists(name))
+
+        ListDeletable.config.DELETE_THREADS = 1
+        ListDeletable.config.DELETE_RATE = 0
+
+        with open(ListDeletable.config.DELETION_FILE, 'r') as deletions:
+            counts = ListDeletable.run_deletions(
+                ListDeletable.iter_deletion_groups(deletions), 4, lambda count: None)
+        self.assertEqual(counts, {'missing': len(files) + 1})
+
+        # Nothing is deleted after an interrupt that comes while a thread waits its turn
+        files = [self.tmpdir.write('dir%i/file%i.root' % (i % 4, i), 'data')
+                 for i in range(4)]
+
+        def interrupted_pace(count):
+            thread.interrupt_main()
+            time.sleep(0.5)
+
+        counts = ListDeletable.run_deletions(
+            [([name], None, 1) for name in files],
+            1, interrupted_pace)
+        self.assertEqual(counts.keys(), ['skipped'])
+        for name in files:
+            self.assertTrue(os.path.exists(name))
+
+    def test_prioritized_deletions(self):
+        if ListDeletable.config.STORAGE_TYPE != 'posix':
+            return
+
+        # Each directory has one file, so the score only depends on the size
+        sizes = [100, 5000, 300, 20, 1000]
+        dirs = [os.path.dirname(self.tmpdir.write('dir%i/file.root' % i, 'x' * size))
+                for i, size in enumerate(sizes)]
+
+        if not os.path.exists(os.path.dirname(ListDeletable.config.DELETION_FILE)):
+            os.makedirs(os.path.dirname(ListDeletable.config.DELETION_FILE))
+        ListDeletable.write_deletion_entries(
+            ListDeletable.config.DELETION_FILE,
+            [ListDeletable.DeletionEntry(size, 1, 0, 0, directory)
+             for directory, size in zip(dirs, sizes)])
+
+        # The deletion file only has PFNs, and the sizes are next to it
+        with open(ListDeletable.config.DELETION_FILE, 'r') as deletions:
+            self.assertEqual(deletions.read().split('\n'), dirs + [''])
+            entries = list(ListDeletable.iter_deletion_entries(
+                deletions, metadata=ListDeletable.config.DELETION_FILE + '.meta'))
+        self.assertEqual([entry.size for entry, _ in entries], sizes)
+
+        # Resuming part way reads the metadata of the same lines
+        with open(ListDeletable.config.DELETION_FILE, 'r') as deletions:
+            self.assertEqual(list(ListDeletable.iter_deletion_entries(
+                deletions, entries[1][1], ListDeletable.config.DELETION_FILE + '.meta')),
+                             entries[2:])
+        self.assertEqual([entry.pfn for entry, _ in ListDeletable.iter_prioritized(
+            entries, {'bytes': 0})], [dirs[1], dirs[4], dirs[2], dirs[0], dirs[3]])
+        self.assertEqual(ListDeletable.parse_bytes('1.5k'), 1536)
+        self.assertEqual(ListDeletable.parse_bytes('2TB'), 2 * 1024 ** 4)
+        self.assertRaises(ValueError, ListDeletable.parse_bytes, 'lots')
+        self.assertRaises(ValueError, ListDeletable.parse_bytes, 'B')
+
+        ListDeletable.config.WHICH_LIST = 'directories'
+
+        # Each directory and its file are removed
+        self.assertEqual(sum([removed for _, _, removed in
+                              ListDeletable.group_deletions(entries)]), 2 * len(dirs))
+
+        sleep_time = ListDeletable.config.SLEEP_TIME
+        ListDeletable.config.SLEEP_TIME = 0
+        try:
+            ListDeletable.do_delete(target_bytes=4000)
+        finally:
+            ListDeletable.config.SLEEP_TIME = sleep_time
+
+        # The next group was already queued when the target was reached
+        self.assertEqual([os.path.exists(directory) for directory in dirs],
+                         [True, False, True, True, False])
+
+    def test_sharded_scan(self):
+        self.make_random_tree()
+
+        ListDeletable.config.WHICH_LIST = 'directories'
+        ListDeletable.config.MIN_AGE = 60
+        ListDeletable.NOW = int(time.time())
+
+        def read_deletions():
+            with open(ListDeletable.config.DELETION_FILE, 'r') as deletions:
+                return sorted([entry for entry, _ in ListDeletable.iter_deletion_entries(
+                    deletions, metadata=ListDeletable.config.DELETION_FILE + '.meta')])
+
+        ListDeletable.main()
+        expected = read_deletions()
+        self.assertNotEqual(expected, [])
+        os.remove(ListDeletable.config.DELETION_FILE)
+
+        self.assertEqual(ListDeletable.parse_shard('2/3'), (2, 3))
+        self.assertRaises(ValueError, ListDeletable.parse_shard, '4/3')
+
+        try:
+            # A shard left over from an earlier scan
+            ListDeletable.SHARD = (3, 3)
+            ListDeletable.RUN_ID = 'earlier'
+            ListDeletable.main()
+
+            # Each shard is run like a separate node would
+            ListDeletable.RUN_ID = 'scan'
+            for index in [1, 2, 3]:
+                if index > 1:
+                    self.assertRaises(SystemExit, ListDeletable.merge_shards)
+                ListDeletable.SHARD = (index, 3)
+                ListDeletable.main()
+
+            ListDeletable.SHARD = None
+            ListDeletable.merge_shards()
+        finally:
+            ListDeletable.SHARD = None
+            ListDeletable.RUN_ID = None
+
+        self.assertEqual(read_deletions(), expected)
+
+        deletion_dir = os.path.dirname(ListDeletable.config.DELETION_FILE)
+        self.assertEqual([name for name in os.listdir(deletion_dir) if '.shard-' in name], [])
+
+    def test_what_if(self):
+        self.make_random_tree()
+        older_time = time.time() - 3 * 3600
+        for i_file in xrange(20):
+            file_name = self.tmpdir.write('top%i/older/file_%i.root' % (i_file % 5, i_file),
+                                          bytearray(random.randint(0, 2048)))
+            os.utime(file_name, (older_time, older_time))
+
+        # The random tree may have nothing deletable, so one directory is an hour old for sure
+        hour_time = time.time() - 3600
+        os.utime(self.tmpdir.write('top0/hour/file.root', bytearray(1024)), (hour_time, hour_time))
+
+        ListDeletable.config.WHICH_LIST = 'directories'
+        ListDeletable.NOW = int(time.time())
+        ages = [60, 1800, 7200, 86400]
+
+        self.assertEqual(ListDeletable.parse_ages('7,0.5'), [43200, 604800])
+        self.assertRaises(ValueError, ListDeletable.parse_ages, '0,7')
+        self.assertRaises(ValueError, ListDeletable.parse_ages, 'week')
+
+        totals = ListDeletable.what_if(ages)
+
+        # Each age gives what a separate listing with that MIN_AGE would delete
+        for age, total in zip(ages, totals):
+            ListDeletable.config.MIN_AGE = age
+            expected = [0, 0, 0, 0]
+            for top_dir in ListDeletable.list_folder(unmerged_location, 'subdirs'):
+                node = ListDeletable.DataNode(top_dir)
+                node.fill()
+                list_to_del = []
+                node.traverse_tree(list_to_del)
+                for item in list_to_del:
+                    expected[0] += 1
+                    expected[1] += item.nsubnodes
+                    expected[2] += item.nsubfiles
+                    expected[3] += item.size
+
+            self.assertEqual(total, expected)
+
+        self.assertTrue(totals[0][3] > totals[2][3] > 0)
+        self.assertEqual(totals[3], [0, 0, 0, 0])
+
+    def test_daemon_watch(self):
+        if ListDeletable.config.STORAGE_TYPE != 'posix' or not WatchTools.available():
+            return
+
+        self.make_random_tree()
+        ListDeletable.config.MIN_AGE = 60
+
+        old_time = time.time() - 3600
+        for name in ['old', 'gone', 'kept']:
+            file_name = self.tmpdir.write('top8/%s/file.root' % name, 'old file')
+            os.utime(file_name, (old_time, old_time))
+
+        def full_scan():
+            list_to_del = []
+            for top_dir in ListDeletable.list_folder(unmerged_location, 'subdirs'):
+                node = ListDeletable.DataNode(top_dir)
+                node.fill()
+                node.traverse_tree(list_to_del)
+            return sorted([(node.path_name, node.size, node.nsubfiles, node.nsubnodes, node.latest)
+                           for node in list_to_del])
+
+        def watched():
+            return sorted([(node.path_name, node.size, node.nsubfiles, node.nsubnodes, node.latest)
+                           for node in tree.deletions()])
+
+        inotify = WatchTools.Inotify()
+        tree = ListDeletable.WatchedTree(inotify)
+        protected_index = ListDeletable.PROTECTED_INDEX
+
+        try:
+            tree.scan()
+            before = watched()
+            self.assertEqual(before, full_scan())
+            self.assertEqual(len(tree.watches), len(tree.nodes) + 1 - len(protected_list))
+
+            # A new file in one deletable directory, another one removed, and a new old tree
+            self.tmpdir.write('top8/old/new_file.root', 'new file')
+            shutil.rmtree(self.tmpdir.getpath('top8/gone'))
+            os.utime(self.tmpdir.write('top9/new/file.root', 'old file'), (old_time, old_time))
+
+            self.assertFalse(tree.update(1.0))
+            after = watched()
+            self.assertNotEqual(after, before)
+            self.assertEqual(after, full_scan())
+
+            # A write that inotify does not see, like one from another node of a network file system
+            self.assertTrue('top8/kept' in [deletable[0] for deletable in after])
+            tree.unwatch('top8/kept')
+            self.tmpdir.write('top8/kept/remote_file.root', 'new file')
+            self.assertEqual(watched(), full_scan())
+            self.assertTrue('top8/kept' in tree.wds)
+
+            # Protect a deletable directory, and unprotect one that was protected
+            ListDeletable.PROTECTED_INDEX = ProtectionTools.ProtectedTrie(
+                [os.path.join(ListDeletable.config.LFN_TO_CLEAN, after[0][0])] +
+                ListDeletable.PROTECTED_LIST[1:])
+            tree.update_protection()
+            self.assertEqual(watched(), full_scan())
+
+        finally:
+            ListDeletable.PROTECTED_INDEX = protected_index
+            inotify.close()
+
+    def test_daemon_vanished(self):
+        if ListDeletable.config.STORAGE_TYPE != 'posix' or not WatchTools.available():
+            return
+
+        ListDeletable.config.MIN_AGE = 60
+        old_time = time.time() - 3600
+        for name in ['stays', 'vanishes/sub']:
+            os.utime(self.tmpdir.write('top8/%s/file.root' % name, 'old file'),
+                     (old_time, old_time))
+
+        inotify = WatchTools.Inotify()
+        tree = ListDeletable.WatchedTree(inotify)
+        watch = tree.watch
+
+        def watch_then_remove(path_name):
+            # The directory is removed after it is watched, but before it is listed
+            watch(path_name)
+            if path_name == 'top8/vanishes':
+                shutil.rmtree(self.tmpdir.getpath(path_name))
+
+        tree.watch = watch_then_remove
+
+        try:
+            tree.scan()
+            self.assertFalse('top8/vanishes' in tree.nodes)
+            self.assertFalse('top8/vanishes' in tree.wds)
+            self.assertTrue('top8/stays' in tree.nodes)
+
+            # The parent is listed again, and forgets the directory
+            self.assertFalse(tree.update(1.0))
+            self.assertEqual([node.path_name for node in tree.nodes['top8'].sub_nodes],
+                             ['top8/stays'])
+            self.assertEqual([node.path_name for node in tree.deletions()], ['top8'])
+
+        finally:
+            inotify.close()
+
+    def test_posix_tools(self):
+        methods = [PosixTools.PathOps()]
+        if PosixTools.OPS.__class__ is not PosixTools.PathOps:
+            methods.append(PosixTools.OPS)
+
+        for ops in methods:
+            top_dirs = self.make_random_tree(50)
+            deep = os.path.join(*(['deep'] + ['level%i' % i for i in range(50)]))
+            self.tmpdir.write(os.path.join(deep, 'file.root'), 'data')
+            os.symlink(unmerged_location, self.tmpdir.getpath('deep/link'))
+
+            for top_dir in top_dirs + ['deep']:
+                PosixTools.delete_tree(os.path.join(unmerged_location, top_dir), ops)
+                self.assertFalse(os.path.exists(os.path.join(unmerged_location, top_dir)))
+
+            # The symbolic link is removed without following it
+            self.assertTrue(os.path.exists(unmerged_location))
+            self.assertRaises(OSError, PosixTools.delete_tree,
+                              os.path.join(unmerged_location, 'deep'), ops)
+
+            files = [os.path.basename(self.tmpdir.write('files/file%i.root' % i, 'data'))
+                     for i in range(5)]
+            errors = PosixTools.delete_files(self.tmpdir.getpath('files'),
+                                             files + ['missing.root'], ops)
+            self.assertEqual(errors[:5], [None] * 5)
+            self.assertEqual(errors[5].errno, errno.ENOENT)
+            self.assertEqual(os.listdir(self.tmpdir.getpath('files')), [])
+
+            self.tearDown()
+            self.setUp()
+
+    def test_resume_deletions(self):
+        if ListDeletable.config.STORAGE_TYPE != 'posix':
+            return
+
+        files = [self.tmpdir.write('dir/file%i.root' % i, 'data') for i in range(10)]
+
+        if not os.path.exists(os.path.dirname(ListDeletable.config.DELETION_FILE)):
+            os.makedirs(os.path.dirname(ListDeletable.config.DELETION_FILE))
+        with open(ListDeletable.config.DELETION_FILE, 'w') as deletions:
+            for name in files:
+                deletions.write(name + '\n')
+
+        # Pretend that a run was interrupted after the first four files
+        journal_name = ListDeletable.config.DELETION_FILE + '.journal'
+        with open(journal_name, 'w') as journal:
+            journal.write(ListDeletable.journal_header(ListDeletable.config.DELETION_FILE))
+            journal.write('@%i\n' % sum([len(name) + 1 for name in files[:4]]))
+
+        ListDeletable.config.WHICH_LIST = 'files'
+        sleep_time = ListDeletable.config.SLEEP_TIME
+        ListDeletable.config.SLEEP_TIME = 0
+        ListDeletable.do_delete(resume=True)
+        ListDeletable.config.SLEEP_TIME = sleep_time
+
+        for i, name in enumerate(files):
+            self.assertEqual(os.path.exists(name), i < 4)
+
+        header, committed = ListDeletable.read_journal(journal_name)
+        self.assertEqual(committed, os.path.getsize(ListDeletable.config.DELETION_FILE))
+
+        # A changed deletion file cannot be resumed from the old journal
+        with open(ListDeletable.config.DELETION_FILE, 'a') as deletions:
+            deletions.write(files[0] + '.new\n')
+        self.assertRaises(SystemExit, ListDeletable.do_delete, True)
+
+        # Nothing is deleted when there is no journal to resume from
+        os.remove(journal_name)
+        self.assertRaises(SystemExit, ListDeletable.do_delete, True)
+        self.assertTrue(os.path.exists(files[0]))
+        self.assertFalse(os.path.exists(journal_name))
+
+
+class TestStorageBackends(unittest.TestCase):
+
+    top = '/store/unmerged'
+
+    def fill(self, add):
+        # Makes the same small tree with any backend, using its add function
+        add('dir/file1.root', False, 10, 100)
+        add('dir/file2.root', False, 20, 200)
+        add('dir/sub', True, 0, 300)
+        add('dir/sub/file3.root', False, 30, 400)
+
+    def check_listing(self, backend, top):
+        entries = sorted(backend.list_dir(os.path.join(top, 'dir')))
+        self.assertEqual([entry[:2] for entry in entries],
+                         [('file1.root', False), ('file2.root', False), ('sub', True)])
+        self.assertEqual([entry.size for entry in entries[:2]], [10, 20])
+        self.assertEqual([entry.mtime for entry in entries[:2]], [100, 200])
+
+        stats = backend.stat_many([os.path.join(top, 'dir/sub'),
+                                   os.path.join(top, 'dir/sub/file3.root'),
+                                   os.path.join(top, 'dir/missing.root')])
+        self.assertTrue(stats[0].is_dir)
+        self.assertEqual(stats[1][1:], (False, 30, 400))
+        self.assertEqual(stats[2], None)
+
+        self.assertRaises(OSError, backend.list_dir, os.path.join(top, 'missing'))
+
+    def check_deletion(self, backend, top):
+        self.assertEqual(
+            backend.delete_many([os.path.join(top, 'dir/file1.root'),
+                                 os.path.join(top, 'dir/file2.root'),
+                                 os.path.join(top, 'dir/missing.root')], False),
+            [('deleted', ''), ('deleted', ''), ('missing', '')])
+        self.assertEqual(
+            backend.delete_many([os.path.join(top, 'dir/sub')], True), [('deleted', '')])
+        self.assertEqual(backend.list_dir(os.path.join(top, 'dir')), [])
+
+    def test_posix(self):
+        tmpdir = testfixtures.TempDirectory()
+
+        def add(path, is_dir, size, mtime):
+            if is_dir:
+                tmpdir.makedir(path)
+            else:
+                tmpdir.write(path, 'x' * size)
+            os.utime(tmpdir.getpath(path), (mtime, mtime))
+
+        try:
+            self.fill(add)
+            backend = StorageTools.PosixBackend()
+            self.check_listing(backend, tmpdir.path)
+            self.assertEqual(StorageTools.DcacheBackend().delete_many(
+                [tmpdir.getpath('dir/sub')], True)[0][0], 'skipped')
+            self.check_deletion(backend, tmpdir.path)
+        finally:
+            tmpdir.cleanup()
+
+    def test_memory(self):
+        backend = StorageTools.MemoryBackend()
+        self.fill(lambda path, *args: backend.add(os.path.join(self.top, path), *args))
+
+        self.check_listing(backend, self.top)
+        self.assertEqual(backend.delete_many([os.path.join(self.top, 'dir')], False)[0][0],
+                         'failed')
+        self.check_deletion(backend, self.top)
+        self.assertEqual(sorted(backend.stats),
+                         ['/', '/store', self.top, os.path.join(self.top, 'dir')])
+
+    def test_unknown_type(self):
+        storage_type = ListDeletable.config.STORAGE_TYPE
+        ListDeletable.config.STORAGE_TYPE = 'posxi'
+        try:
+            self.assertRaises(ValueError, ListDeletable.get_storage)
+        finally:
+            ListDeletable.config.STORAGE_TYPE = storage_type
+
+    def test_dump(self):
+        namespace = DumpTools.NamespaceDump()
+        self.fill(namespace.add)
+        backend = StorageTools.DumpBackend(namespace, self.top)
+
+        self.check_listing(backend, self.top)
+        self.assertEqual(backend.delete_many([os.path.join(self.top, 'dir')], True),
+                         [('skipped', 'Cannot delete from a namespace dump')])
+
+    def test_hadoop_groups(self):
+        backend = StorageTools.HadoopBackend(batch_size=10)
+        self.assertEqual(backend.delete_group_size(True), 5)
+        self.assertEqual(backend.delete_cost(['a', 'b', 'c'], True), 1)
+        self.assertEqual(backend.delete_cost(['a', 'b', 'c'], False), 3)
+
+        stderr = ("rm: `/store/unmerged/dir_1': No such file or directory\n"
+                  "rm: `/store/unmerged/dir/sub': Is a directory\n"
+                  "rm: Failed to move to trash: /store/unmerged/dir\n")
+        self.assertEqual(backend.error_lines(stderr, '/store/unmerged/dir'),
+                         ['rm: Failed to move to trash: /store/unmerged/dir'])
+        self.assertEqual(backend.error_lines(stderr, '/store/unmerged/dir_1'),
+                         ["rm: `/store/unmerged/dir_1': No such file or directory"])
+        self.assertEqual(backend.error_lines(stderr, '/store/unmerged'), [])
+
+    def test_timed(self):
+        metrics = MetricsTools.Metrics({'site': 'T2_Test'})
+        backend = MetricsTools.TimedBackend(StorageTools.MemoryBackend(), metrics)
+        self.fill(lambda path, *args: backend.add(os.path.join(self.top, path), *args))
+
+        with metrics.phase('check'):
+            self.check_listing(backend, self.top)
+            self.check_deletion(backend, self.top)
+        metrics.add_top_dir('dir', 0.5, deletions=1)
+
+        measured = metrics.to_dict()
+        self.assertEqual(sorted(measured['phases']), ['check'])
+        operations = measured['operations']
+        # The listing of the missing directory is the error, and has no items
+        self.assertEqual([operations['list'][key] for key in ['calls', 'items', 'errors']],
+                         [3, 3, 1])
+        self.assertEqual([operations['stat'][key] for key in ['calls', 'items', 'errors']],
+                         [1, 3, 0])
+        self.assertEqual([operations['delete'][key] for key in ['calls', 'items', 'errors']],
+                         [2, 4, 0])
+        self.assertEqual(operations['list']['buckets'][-1], ['+Inf', 3])
+
+        tmpdir = testfixtures.TempDirectory()
+        try:
+            metrics.write_json(tmpdir.getpath('metrics.json'))
+            with open(tmpdir.getpath('metrics.json'), 'r') as metrics_file:
+                self.assertEqual(json.load(metrics_file)['top_dirs'],
+                                 {'dir': {'seconds': 0.5, 'deletions': 1}})
+
+            metrics.write_prometheus(tmpdir.getpath('metrics.prom'))
+            with open(tmpdir.getpath('metrics.prom'), 'r') as metrics_file:
+                lines = metrics_file.read().split('\n')
+            self.assertTrue('unmerged_cleaner_operation_seconds_count'
+                            '{operation="delete",site="T2_Test"} 2' in lines)
+            self.assertTrue('unmerged_cleaner_top_dir_seconds'
+                            '{dir="dir",site="T2_Test"} 0.500000' in lines)
+            self.assertEqual(sorted(os.listdir(tmpdir.path)), ['metrics.json', 'metrics.prom'])
+            # The collector may run as another user
+            self.assertEqual(os.stat(tmpdir.getpath('metrics.prom')).st_mode & 0777, 0644)
+        finally:
+            tmpdir.cleanup()
+
+
+class TestNamespaceDumps(unittest.TestCase):
+
+    dump_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dumps')
+    dumps = {
+        'fsimage': 'fsimage.txt',
+        'find': 'find.txt',
+        'hdfs-ls': 'hdfs_ls.txt'
+        }
+    # Where the find dump was made
+    dump_pfn = '/data/store/unmerged'
+
+    def setUp(self):
+        ListDeletable.NOW = DumpTools.to_timestamp('2017-03-01 00:00')
+        ListDeletable.config.MIN_AGE = 60 * 60 * 24 * 14
+
+    def tearDown(self):
+        ListDeletable.NAMESPACE = None
+        ListDeletable.config.WHICH_LIST = 'directories'
+        for file_name in [ListDeletable.config.DELETION_FILE,
+                          ListDeletable.config.DELETION_FILE + '.meta']:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def run_dump(self, dump_format, which):
+        ListDeletable.NAMESPACE = DumpTools.NamespaceDump.from_file(
+            os.path.join(self.dump_dir, self.dumps[dump_format]),
+            ListDeletable.config.LFN_TO_CLEAN, pfn=self.dump_pfn)
+        ListDeletable.config.WHICH_LIST = which
+        ListDeletable.main()
+
+        with open(ListDeletable.config.DELETION_FILE, 'r') as deletions:
+            entries = [entry for entry, _ in ListDeletable.iter_deletion_entries(
+                deletions, metadata=ListDeletable.config.DELETION_FILE + '.meta')]
+
+        # Only directories have sizes written next to them
+        self.assertEqual([entry.size is None for entry in entries],
+                         [which == 'files'] * len(entries))
+        return sorted([entry.pfn for entry in entries])
+
+    def test_guess_format(self):
+        for dump_format, file_name in self.dumps.iteritems():
+            with open(os.path.join(self.dump_dir, file_name), 'r') as dump:
+                self.assertEqual(DumpTools.guess_format(dump.readline()), dump_format)
+
+    def test_relative_path(self):
+        lfn = ListDeletable.config.LFN_TO_CLEAN
+        for path, relative in [('/store/unmerged', ''),
+                               ('/store/unmerged/campaign/old', 'campaign/old'),
+                               ('/data/store/unmerged/campaign', 'campaign'),
+                               ('/store/unmerged2/campaign', None),
+                               ('/store/user/me/store/unmerged/campaign', None),
+                               ('/other/store/unmerged/campaign', None)]:
+            self.assertEqual(DumpTools.relative_path(path, lfn, self.dump_pfn), relative,
+                             'Wrong relative path of %s' % path)
+
+    def test_directories(self):
+        expected = [os.path.join(unmerged_location, path)
+                    for path in ['campaign/old', 'dir/to', 'empty']]
+
+        for dump_format in self.dumps:
+            self.assertEqual(self.run_dump(dump_format, 'directories'), expected,
+                             'Wrong directories from %s dump' % dump_format)
+
+    def test_files(self):
+        expected = [os.path.join(unmerged_location, path)
+                    for path in ['campaign/old/a.root', 'campaign/old/b.root',
+                                 'dir/to/delete/f.root', 'dir/to/delete/with space.root']]
+
+        for dump_format in self.dumps:
+            self.assertEqual(self.run_dump(dump_format, 'files'), expected,
+                             'Wrong files from %s dump' % dump_format)
+
+    def test_same_tree(self):
+        trees = []
+        for dump_format, file_name in self.dumps.iteritems():
+            ListDeletable.NAMESPACE = DumpTools.NamespaceDump.from_file(
+                os.path.join(self.dump_dir, file_name), ListDeletable.config.LFN_TO_CLEAN,
+                pfn=self.dump_pfn)
+            node = ListDeletable.DataNode('campaign')
+            node.fill()
+            trees.append((node.can_vanish, node.latest, node.size,
+                          node.nsubnodes, node.nsubfiles))
+
+        self.assertEqual(trees[0], (False, DumpTools.to_timestamp('2017-02-25 10:00'),
+                                    6000, 2, 3))
+        self.assertEqual(trees, [trees[0]] * len(trees))
+
 
 class TestConditions(unittest.TestCase):
 
@@ -242,6 +1411,20 @@ class TestConditions(unittest.TestCase):
                           [os.path.join(ListDeletable.config.UNMERGED_DIR_LOCATION.replace('/store/', '/disk/store/'),
                                         'example/file/location.root')], [])
 
+    def test_filter_protected(self):
+        unmerged = ListDeletable.config.UNMERGED_DIR_LOCATION
+        files = [os.path.join(unmerged, name) for name in
+                 ['protected1/file.root', 'protected10/file.root', 'avoid/file.root',
+                  'dir/that/is/protected/file.root', 'dir/that/file.root', 'new/file.root']]
+
+        if not os.path.exists(os.path.dirname(ListDeletable.config.DELETION_FILE)):
+            os.makedirs(os.path.dirname(ListDeletable.config.DELETION_FILE))
+
+        ListDeletable.filter_protected(files, ListDeletable.PROTECTED_LIST)
+
+        with open(ListDeletable.config.DELETION_FILE, 'r') as deletions:
+            self.assertEqual(deletions.read().split(), [files[4], files[5]])
+
     def test_partial_match(self):
         self.assertRaises(ListDeletable.SuspiciousConditions, ListDeletable.filter_protected,
                           [os.path.join(ListDeletable.config.UNMERGED_DIR_LOCATION, 'store/unmerged/protected/file.root')],
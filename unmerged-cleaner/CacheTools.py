@@ -0,0 +1,291 @@
+"""
+This module holds caches that let a run of the unmerged cleaner reuse work done by earlier runs.
+It does not depend on ``config.py``.
+"""
+
+import httplib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urlparse
+from collections import namedtuple
+
+
+def write_atomic(file_name, contents):
+    """
+    Replaces a file in one step, so that other processes never read half of it.
+    The temporary file is made by :py:func:`tempfile.mkstemp` in the same directory,
+    so another user cannot create it first, and is then made readable by everyone,
+    like metrics read by a collector running as another user.
+
+    :param str file_name: is the name of the file to write
+    :param str contents: is what goes into the file
+    """
+
+    fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(file_name) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(file_name) or '.')
+    try:
+        os.fchmod(fd, 0644)
+        with os.fdopen(fd, 'w') as output:
+            output.write(contents)
+        os.rename(tmp_name, file_name)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+
+CachedDir = namedtuple('CachedDir', ['nfiles', 'files_size', 'files_latest', 'subdirs'])
+
+
+class ScanCache(object):
+    """
+    Remembers the listing of each directory between scans, in an SQLite file.
+    For each directory, this holds the modification time of the directory,
+    the number, total size and latest modification time of the files directly inside of it,
+    and the names of its subdirectories.
+    Creating, removing or renaming an entry changes the modification time of its directory,
+    so a directory with an unchanged modification time does not need to be listed again.
+    Only the directories looked up or stored during a run are kept by :py:meth:`save`.
+    """
+
+    # A directory changed this recently may change again without a new modification time
+    RACY_SECONDS = 2
+
+    def __init__(self, file_name):
+        """
+        Loads the cache, or creates an empty one.
+        :param str file_name: is the name of the SQLite file
+        """
+        self.file_name = file_name
+        self.entries = {}
+        self.seen = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        connection = self.connect()
+        try:
+            for path, mtime, nfiles, files_size, files_latest, subdirs in \
+                    connection.execute('SELECT * FROM dirs'):
+                self.entries[path] = (mtime, CachedDir(
+                    nfiles, files_size, files_latest, subdirs and subdirs.split('/') or []))
+        finally:
+            connection.close()
+
+    def connect(self):
+        """
+        :returns: a connection to the cache file, with the table created if needed
+        :rtype: sqlite3.Connection
+        """
+
+        connection = sqlite3.connect(self.file_name)
+        # Paths are kept as byte strings, like the rest of the cleaner
+        connection.text_factory = str
+        connection.execute('CREATE TABLE IF NOT EXISTS dirs '
+                           '(path TEXT PRIMARY KEY, mtime REAL, nfiles INTEGER, '
+                           'files_size INTEGER, files_latest REAL, subdirs TEXT)')
+        return connection
+
+    def get(self, path, mtime):
+        """
+        :param str path: is the directory, relative to the top of the scan
+        :param float mtime: is the current modification time of the directory
+        :returns: the cached listing, or ``None`` if the directory changed or is not cached
+        :rtype: CachedDir
+        """
+
+        cached = self.entries.get(path)
+        with self.lock:
+            if cached is None or cached[0] != mtime:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.seen[path] = cached
+
+        return cached[1]
+
+    def put(self, path, mtime, nfiles, files_size, files_latest, subdirs):
+        """
+        Stores the listing of a directory.
+        Listings of directories that were changed too recently are not stored.
+
+        :param str path: is the directory, relative to the top of the scan
+        :param float mtime: is the modification time of the directory before it was listed
+        :param int nfiles: is the number of files directly inside the directory
+        :param int files_size: is the total size of those files
+        :param float files_latest: is the latest modification time of those files
+        :param list subdirs: is the names of the subdirectories
+        """
+
+        if time.time() - mtime < self.RACY_SECONDS:
+            return
+
+        with self.lock:
+            self.seen[path] = (mtime, CachedDir(nfiles, files_size, files_latest, subdirs))
+
+    def save(self):
+        """
+        Replaces the contents of the cache file with the directories seen during this run.
+        """
+
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM dirs')
+                connection.executemany(
+                    'INSERT INTO dirs VALUES (?, ?, ?, ?, ?, ?)',
+                    ((path, mtime, cached.nfiles, cached.files_size,
+                      cached.files_latest, '/'.join(cached.subdirs))
+                     for path, (mtime, cached) in self.seen.iteritems()))
+        finally:
+            connection.close()
+
+        self.entries = self.seen
+        self.seen = {}
+
+
+def read_protected_source(source, etag=None, last_modified=None):
+    """
+    Reads the protected LFNs, unless they did not change since a cached copy was read.
+
+    :param str source: is an http or https URL, or the name of a local file,
+                       giving the protected LFNs in the JSON format used by Unified
+    :param str etag: is the ETag of the cached copy, if any
+    :param str last_modified: is the Last-Modified time of the cached copy, if any.
+                              For a local file, this is its modification time.
+    :returns: the protected LFNs, or ``None`` if the source did not change,
+              and the new ETag and Last-Modified values
+    :rtype: tuple
+    :raises IOError: if the source cannot be read
+    """
+
+    parsed = urlparse.urlparse(source)
+
+    if parsed.scheme not in ('http', 'https'):
+        file_name = parsed.path if parsed.scheme == 'file' else source
+        modified = repr(os.stat(file_name).st_mtime)
+        if modified == last_modified:
+            return None, etag, last_modified
+
+        with open(file_name, 'r') as source_file:
+            return json.load(source_file)['protected'], None, modified
+
+    if parsed.scheme == 'https':
+        conn = httplib.HTTPSConnection(parsed.netloc)
+    else:
+        conn = httplib.HTTPConnection(parsed.netloc)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    try:
+        conn.request('GET', parsed.path + (parsed.query and '?' + parsed.query),
+                     headers=headers)
+        res = conn.getresponse()
+        body = res.read()
+    finally:
+        conn.close()
+
+    if res.status == httplib.NOT_MODIFIED:
+        return None, etag, last_modified
+
+    if res.status != httplib.OK:
+        raise IOError('%s returned HTTP status %i' % (source, res.status))
+
+    return json.loads(body)['protected'], \
+        res.getheader('etag'), res.getheader('last-modified')
+
+
+class ProtectedCache(object):
+    """
+    Keeps a local copy of the protected LFNs in a JSON file,
+    along with when it was last checked against the source
+    and the validators needed to check it again without downloading the list.
+    """
+
+    def __init__(self, source, file_name=None):
+        """
+        Loads the cached copy, if there is one for this source.
+        A copy claiming to be checked in the future is not trusted.
+        :param str source: is the location of the list, as given to :py:func:`read_protected_source`
+        :param str file_name: is the name of the cache file
+        """
+        self.source = source
+        self.file_name = file_name
+        self.cached = None
+
+        if file_name and os.path.isfile(file_name):
+            try:
+                with open(file_name, 'r') as cache_file:
+                    cached = json.load(cache_file)
+                if cached['source'] == source and cached['checked'] <= time.time():
+                    self.cached = cached
+            except (ValueError, KeyError, TypeError):
+                # A broken cache is the same as none
+                pass
+
+    def age(self):
+        """
+        :returns: the seconds since the copy was last checked against the source,
+                  or ``None`` if there is no copy
+        :rtype: float
+        """
+
+        if self.cached is None:
+            return None
+
+        return time.time() - self.cached['checked']
+
+    @property
+    def protected(self):
+        """
+        The cached protected LFNs, or ``None`` if there are none.
+        """
+
+        return self.cached and self.cached['protected']
+
+    def refresh(self):
+        """
+        Checks the source and updates the copy in memory.
+        Only downloads the list if it changed.
+
+        :returns: whether or not a new list was downloaded
+        :rtype: bool
+        :raises IOError: if the source cannot be read
+        """
+
+        cached = self.cached or {}
+        protected, etag, last_modified = read_protected_source(
+            self.source, cached.get('etag'), cached.get('last_modified'))
+
+        changed = protected is not None
+        if not changed:
+            protected = cached['protected']
+
+        self.cached = {
+            'source': self.source,
+            'checked': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'protected': protected
+            }
+
+        return changed
+
+    def save(self):
+        """
+        Writes the copy in memory to the cache file.
+        The file is replaced in one step, so other processes never read half of it.
+        """
+
+        if not self.file_name or self.cached is None:
+            return
+
+        write_atomic(self.file_name, json.dumps(self.cached))
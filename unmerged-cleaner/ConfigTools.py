@@ -13,11 +13,87 @@ import ssl
 import datetime
 import os
 import json
+import time
+import urlparse
+
+import CacheTools
+
+
+# Where PhEDEx translates LFNs to PFNs
+PHEDEX_URL = 'https://cmsweb.cern.ch/phedex/datasvc/json/prod'
+
+
+class PhedexClient(object):
+    """
+    Asks PhEDEx for the PFNs of LFNs, reusing one connection for every request.
+    """
+
+    def __init__(self, url=PHEDEX_URL):
+        """
+        Initializes the client. Nothing is connected until the first request.
+        :param str url: is the location of the PhEDEx data service
+        """
+        self.url = urlparse.urlparse(url)
+        self.conn = None
+
+    def connect(self):
+        """
+        :returns: a new connection to the data service
+        :rtype: httplib.HTTPConnection
+        """
+
+        if self.url.scheme == 'http':
+            return httplib.HTTPConnection(self.url.netloc)
+
+        # Python 2.7.something verifies HTTPS connections,
+        # but earlier version of Python do not
+        try:
+            return httplib.HTTPSConnection(self.url.netloc,
+                                           context=ssl._create_unverified_context())
+        except AttributeError:
+            return httplib.HTTPSConnection(self.url.netloc)
+
+    def lfn2pfn(self, site_name, lfn):
+        """
+        :param str site_name: is the name of the site to check
+        :param str lfn: is the LFN to find
+        :returns: the PFN of the LFN at the site
+        :rtype: str
+        :raises Exception: if PhEDEx cannot be reached or does not know the LFN
+        """
+
+        path = '%s/lfn2pfn?node=%s&protocol=direct&lfn=%s' % \
+            (self.url.path.rstrip('/'), site_name, lfn)
+
+        # The server may have closed a connection kept from an earlier request
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = self.connect()
+            try:
+                self.conn.request('GET', path)
+                result = json.loads(self.conn.getresponse().read())
+                break
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt:
+                    raise
+
+        return result['phedex']['mapping'][0]['pfn']
+
+    def close(self):
+        """
+        Closes the connection, if there is one.
+        """
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
 
 
 def pfn_from_phedex(site_name, lfn):
     """
     Get the PFN of a directory from phedex for a given LFN.
+    This asks PhEDEx every time. Configurations generated now use :py:func:`pfn_from_cache`.
 
     :param str site_name: is the name of the site to check
     :param str lfn: is the LFN to find
@@ -25,34 +101,157 @@ def pfn_from_phedex(site_name, lfn):
     :rtype: str
     """
 
-    # Python 2.7.something verifies HTTPS connections,
-    # but earlier version of Python do not
-    try:
-        conn = httplib.HTTPSConnection('cmsweb.cern.ch',
-                                       context=ssl._create_unverified_context())
-    except AttributeError:
-        conn = httplib.HTTPSConnection('cmsweb.cern.ch')
+    client = PhedexClient()
 
-    # Get the JSON from Phedex
     try:
-        conn.request('GET',
-                     '/phedex/datasvc/json/prod/lfn2pfn?'
-                     'node=%s&protocol=direct&lfn=%s' %
-                     (site_name, lfn))
-
-        res = conn.getresponse()
-        result = json.loads(res.read())
+        return client.lfn2pfn(site_name, lfn)
 
     except Exception as msg:
         print 'Exception: %s' % msg
         print 'Failed to get LFNs from Phedex...'
         print 'Had tried %s.' % site_name
-        conn.close()
         exit(1)
 
-    location = result['phedex']['mapping'][0]['pfn']
-    conn.close()
-    return location
+    finally:
+        client.close()
+
+
+class PfnCache(object):
+    """
+    Keeps the PFNs found by PhEDEx in a JSON file, keyed by site and LFN,
+    along with when each one was found.
+    """
+
+    def __init__(self, file_name, ttl):
+        """
+        Loads the cache file, if there is one.
+        Entries claiming to be found in the future are dropped.
+        :param str file_name: is the name of the cache file
+        :param float ttl: is the number of seconds that a PFN is used before asking again
+        """
+        self.file_name = file_name
+        self.ttl = ttl
+        self.entries = {}
+
+        if file_name and os.path.isfile(file_name):
+            try:
+                with open(file_name, 'r') as cache_file:
+                    self.entries = dict(json.load(cache_file))
+                self.entries = dict([(key, entry) for key, entry in self.entries.iteritems()
+                                     if entry['found'] <= time.time()])
+            except (ValueError, TypeError, KeyError):
+                # A broken cache is the same as none
+                pass
+
+    @staticmethod
+    def key(site_name, lfn):
+        """
+        :param str site_name: is the name of a site
+        :param str lfn: is an LFN
+        :returns: the key of the PFN in the cache
+        :rtype: str
+        """
+
+        return '%s|%s' % (site_name, lfn)
+
+    def get(self, site_name, lfn, stale=False):
+        """
+        :param str site_name: is the name of the site
+        :param str lfn: is the LFN to find
+        :param bool stale: if True, also give a PFN found longer than the TTL ago
+        :returns: the cached PFN, or ``None``
+        :rtype: str
+        """
+
+        entry = self.entries.get(self.key(site_name, lfn))
+        if entry is None or (not stale and time.time() - entry['found'] >= self.ttl):
+            return None
+
+        return entry['pfn']
+
+    def resolve(self, site_name, lfns, url=PHEDEX_URL):
+        """
+        Asks PhEDEx for every LFN that is not fresh in the cache, over one connection,
+        and saves the cache.
+
+        :param str site_name: is the name of the site
+        :param list lfns: is the LFNs to find
+        :param str url: is the location of the PhEDEx data service
+        :returns: the PFN of each LFN
+        :rtype: dict
+        :raises Exception: if PhEDEx cannot be reached or does not know an LFN
+        """
+
+        client = PhedexClient(url)
+        try:
+            for lfn in lfns:
+                if self.get(site_name, lfn) is None:
+                    self.entries[self.key(site_name, lfn)] = {
+                        'pfn': client.lfn2pfn(site_name, lfn),
+                        'found': time.time()
+                        }
+        finally:
+            client.close()
+
+        try:
+            self.save()
+        except (IOError, OSError) as msg:
+            print 'Cannot save PFNs to %s: %s' % (self.file_name, msg)
+
+        return dict([(lfn, self.get(site_name, lfn, stale=True)) for lfn in lfns])
+
+    def save(self):
+        """
+        Writes the cache file.
+        The file is replaced in one step, so other processes never read half of it.
+        """
+
+        if not self.file_name:
+            return
+
+        CacheTools.write_atomic(self.file_name, json.dumps(self.entries))
+
+
+def pfn_from_cache(site_name, lfn, file_name=None, ttl=None, url=PHEDEX_URL):
+    """
+    Get the PFN of a directory for a given LFN, asking PhEDEx only if the
+    :py:class:`PfnCache` has not seen it within the TTL.
+    This is called by ``config.py``, so loading the configuration usually reads one small file.
+    If PhEDEx cannot be reached, an expired PFN is used instead.
+
+    :param str site_name: is the name of the site to check
+    :param str lfn: is the LFN to find
+    :param str file_name: is the cache file, **PFN_CACHE** by default
+    :param float ttl: is the seconds to keep a PFN, **PFN_CACHE_TTL** by default
+    :param str url: is the location of the PhEDEx data service
+    :returns: PFN of the folder
+    :rtype: str
+    """
+
+    if file_name is None:
+        file_name = DEFAULTS['PFN_CACHE']
+    if ttl is None:
+        ttl = DEFAULTS['PFN_CACHE_TTL']
+
+    cache = PfnCache(file_name, ttl)
+    location = cache.get(site_name, lfn)
+    if location is not None:
+        return location
+
+    try:
+        return cache.resolve(site_name, [lfn], url)[lfn]
+
+    except Exception as msg:   # pylint: disable=broad-except
+        print 'Exception: %s' % msg
+        location = cache.get(site_name, lfn, stale=True)
+        if location is not None:
+            print 'Cannot refresh the PFN of %s from Phedex. Using the cached %s.' % \
+                (lfn, location)
+            return location
+
+        print 'Failed to get LFNs from Phedex...'
+        print 'Had tried %s.' % site_name
+        exit(1)
 
 
 def guess_site():
@@ -121,11 +320,31 @@ def guess_site():
 # Default values for the configuration are given here:
 DEFAULTS = {
     'LFN_TO_CLEAN':  '/store/unmerged',
+    'PFN_CACHE':     'unmerged_pfns.json',
+    'PFN_CACHE_TTL': 60 * 60 * 24 * 30,       # Thirty days
     'STORAGE_TYPE':  'posix',
     'DIRS_TO_AVOID': ['SAM', 'logs'],
     'MIN_AGE':       60 * 60 * 24 * 7 * 2,    # Corresponds to two weeks
     'WHICH_LIST':    'directories',
     'SLEEP_TIME':    0.5,
+    'SCAN_THREADS':  1,
+    'TREE_TYPE':     'objects',
+    'FILE_LISTER':   'native',
+    'SCAN_MODE':     'full',
+    'HADOOP_BATCH_SIZE': 100,
+    'DELETE_THREADS': 1,
+    'DELETE_RATE':   0,
+    'DELETE_LATENCY_TARGET': 0,
+    'DELETE_ERROR_TARGET':   0.05,
+    'SCAN_CACHE':    '',
+    'PROTECTED_SOURCE':  'https://cmst2.web.cern.ch/cmst2/unified/listProtectedLFN.txt',
+    'PROTECTED_CACHE':   'protected_lfns.json',
+    'PROTECTED_REFRESH': 60 * 60,             # One hour
+    'PROTECTED_MAX_AGE': 60 * 60 * 24,        # One day
+    'METRICS_DIR':   '',
+    'PROGRESS_INTERVAL': 60,
+    'DAEMON_WRITE_INTERVAL': 60 * 10,         # Ten minutes
+    'DAEMON_RESCAN_INTERVAL': 60 * 60 * 24,   # One day
 }
 
 DOCS = {
@@ -137,12 +356,22 @@ DOCS = {
         ('The Unmerged Cleaner tool cleans the directory matching this LFN. On most sites, this\n'
          'will not need to be changed, but it is possible for a ``/store/dcachetests/unmerged``\n'
          'directory to exist, for example. The default is ``\'%s\'``.' % DEFAULTS['LFN_TO_CLEAN']),
+    'PFN_CACHE':
+        ('The JSON file where the PFN of the unmerged directory is kept after asking Phedex,\n'
+         'so that loading this configuration does not need the network.\n'
+         'Do not put it in a directory that other users can write to, like /tmp.\n'
+         'The default is ``\'%s\'`` next to config.py.' % DEFAULTS['PFN_CACHE']),
+    'PFN_CACHE_TTL':
+        ('The number of seconds that a PFN in **PFN_CACHE** is used before Phedex is asked\n'
+         'again. If Phedex cannot be reached then, the old PFN is still used. '
+         'The default is ``%s``.' % DEFAULTS['PFN_CACHE_TTL']),
     'UNMERGED_DIR_LOCATION':
         ('The location, or PFN, of the unmerged directory. This can be\n'
          'retrieved from Phedex (default) or given explicitly.'),
     'STORAGE_TYPE':
         ('This defines the storage type of the site. This may be necessary for the script to run\n'
-         'correctly or optimally. Acceptable values are ``\'posix\'`` and ``\'hadoop\'``.\n'
+         'correctly or optimally. Acceptable values are ``\'posix\'``, ``\'hadoop\'``,\n'
+         'and ``\'dcache\'``, or any other backend added to ``StorageTools.BACKENDS``.\n'
          'The default is ``\'%s\'``.' % DEFAULTS['STORAGE_TYPE']),
     'DELETION_FILE':
         ('The list of directory or file PFNs to delete are placed this file.\n'
@@ -165,11 +394,111 @@ DOCS = {
          'The sleep avoids overloading the system and '
          'allows the operator to interrupt a deletion.\n'
          'The default is ``%s``.' % DEFAULTS['SLEEP_TIME']),
+    'SCAN_THREADS':
+        ('The number of threads listing directories at the same time. '
+         'Most of the scan is spent waiting for the storage system,\n'
+         'so values larger than the number of cores can help. '
+         'The default is ``%s``.' % DEFAULTS['SCAN_THREADS']),
+    'TREE_TYPE':
+        ('How the directory tree is held in memory when WHICH_LIST is ``\'directories\'``.\n'
+         'With ``\'objects\'``, each directory is a Python object. With ``\'columnar\'``,\n'
+         'the tree is stored in flat arrays, which uses much less memory for large sites\n'
+         'and is faster if NumPy is installed. ``\'columnar\'`` ignores **SCAN_THREADS**. '
+         'The default is ``\'%s\'``.' % DEFAULTS['TREE_TYPE']),
+    'FILE_LISTER':
+        ('How old files are found when WHICH_LIST is ``\'files\'`` on POSIX storage.\n'
+         'With ``\'native\'``, the directories are listed by **SCAN_THREADS** threads and\n'
+         'avoided or protected directories are skipped. With ``\'find\'``, the external\n'
+         '``find`` command lists everything. '
+         'The default is ``\'%s\'``.' % DEFAULTS['FILE_LISTER']),
+    'SCAN_MODE':
+        ('How much is learned about each directory when WHICH_LIST is ``\'directories\'``.\n'
+         'With ``\'full\'``, every file is stat-ed. With ``\'decision\'``, the files in a\n'
+         'directory stop being stat-ed once one newer than **MIN_AGE** is found, since the\n'
+         'directory cannot be deleted anyway. Subdirectories are still scanned.\n'
+         'Sizes are not added up while listing. Instead, only the deletable directories\n'
+         'are listed again to get their sizes, and the scan cache is read but not written. '
+         'The default is ``\'%s\'``.' % DEFAULTS['SCAN_MODE']),
+    'HADOOP_BATCH_SIZE':
+        ('The number of paths passed to each ``hdfs dfs -rm -r`` command when deleting\n'
+         'directories on Hadoop. This avoids starting a JVM for every directory.\n'
+         'The checksum directory and data directory count separately, and **SLEEP_TIME**\n'
+         'is applied once per command. '
+         'The default is ``%s``.' % DEFAULTS['HADOOP_BATCH_SIZE']),
+    'DELETE_THREADS':
+        ('The number of deletions done at the same time by ``ListDeletable.py --delete``.\n'
+         'The default is ``%s``.' % DEFAULTS['DELETE_THREADS']),
+    'DELETE_RATE':
+        ('If not zero, this is the maximum number of deletions started each second,\n'
+         'shared by all of the **DELETE_THREADS**. It replaces **SLEEP_TIME**.\n'
+         'The default is ``%s``.' % DEFAULTS['DELETE_RATE']),
+    'DELETE_LATENCY_TARGET':
+        ('If not zero, the deletion rate adapts to the storage system instead of being fixed.\n'
+         'It starts at **DELETE_RATE**, or one deletion every **SLEEP_TIME**, is raised\n'
+         'while each file or directory takes less than this many seconds to remove, and is\n'
+         'halved when they take longer. Each change is printed with its reason. '
+         'The default is ``%s``.' % DEFAULTS['DELETE_LATENCY_TARGET']),
+    'DELETE_ERROR_TARGET':
+        ('With **DELETE_LATENCY_TARGET**, the deletion rate is also halved when more than\n'
+         'this fraction of deletions fail. '
+         'The default is ``%s``.' % DEFAULTS['DELETE_ERROR_TARGET']),
+    'SCAN_CACHE':
+        ('If not empty, this is an SQLite file where the directory listings are kept\n'
+         'between runs. A directory is listed again only if its modification time\n'
+         'changed, or if it had files newer than **MIN_AGE** when it was cached.\n'
+         'Otherwise, a run only needs to check the time of each directory.\n'
+         'A file that is modified in place, without being created or removed,\n'
+         'is not noticed until its directory changes, so only use this if files\n'
+         'in your unmerged directory are written once. The cache is not used when\n'
+         'listing files or reading a dump. The default is ``\'%s\'``.' %
+         DEFAULTS['SCAN_CACHE']),
+    'PROTECTED_SOURCE':
+        ('The location of the list of protected LFNs. This can be an http or https URL,\n'
+         'or a local file in the same JSON format.\n'
+         'The default is ``\'%s\'``.' % DEFAULTS['PROTECTED_SOURCE']),
+    'PROTECTED_CACHE':
+        ('A local copy of the protected LFNs is kept in this file.\n'
+         'Set this to an empty string to read the source every time.\n'
+         'Do not put it in a directory that other users can write to, like /tmp.\n'
+         'The default is ``\'%s\'`` next to config.py.' % DEFAULTS['PROTECTED_CACHE']),
+    'PROTECTED_REFRESH':
+        ('The local copy of the protected LFNs is used without contacting the source\n'
+         'if it was checked less than this many seconds ago. After that, the source is\n'
+         'asked for the list only if it changed. The default is ``%s``.' %
+         DEFAULTS['PROTECTED_REFRESH']),
+    'PROTECTED_MAX_AGE':
+        ('If the source of protected LFNs cannot be read, the local copy is used\n'
+         'if it was checked less than this many seconds ago. Otherwise, the script stops.\n'
+         'The default is ``%s``.' % DEFAULTS['PROTECTED_MAX_AGE']),
+    'METRICS_DIR':
+        ('If not empty, each run writes its phase times, storage call latencies and\n'
+         'per directory timings to ``unmerged_cleaner_<action>.json`` and\n'
+         '``unmerged_cleaner_<action>.prom`` in this directory, where the action is\n'
+         '``list`` or ``delete``. Point the Prometheus node exporter textfile collector\n'
+         'here to graph them. The default is ``\'%s\'``.' % DEFAULTS['METRICS_DIR']),
+    'PROGRESS_INTERVAL':
+        ('The number of seconds between progress lines, with the rate and expected\n'
+         'time left, while scanning or deleting. Zero turns them off.\n'
+         'The default is ``%s``.' % DEFAULTS['PROGRESS_INTERVAL']),
+    'DAEMON_WRITE_INTERVAL':
+        ('With ``--daemon``, the number of seconds between writes of the deletion file.\n'
+         'Sending ``SIGUSR1`` to the daemon writes it right away.\n'
+         'The default is ``%s``.' % DEFAULTS['DAEMON_WRITE_INTERVAL']),
+    'DAEMON_RESCAN_INTERVAL':
+        ('With ``--daemon``, the number of seconds between listings of everything.\n'
+         'This catches changes that inotify does not report, like the ones made\n'
+         'by other nodes of a network file system.\n'
+         'The default is ``%s``.' % DEFAULTS['DAEMON_RESCAN_INTERVAL']),
 }
 
+# Files kept next to config.py, since other users can replace files in a shared place like /tmp
+LOCAL_FILES = ['PFN_CACHE', 'PROTECTED_CACHE']
+
 VAR_ORDER = [
     'SITE_NAME',
     'LFN_TO_CLEAN',
+    'PFN_CACHE',
+    'PFN_CACHE_TTL',
     'UNMERGED_DIR_LOCATION',
     'WHICH_LIST',
     'DELETION_FILE',
@@ -177,23 +506,46 @@ VAR_ORDER = [
     'DIRS_TO_AVOID',
     'MIN_AGE',
     'STORAGE_TYPE',
+    'SCAN_THREADS',
+    'TREE_TYPE',
+    'FILE_LISTER',
+    'SCAN_MODE',
+    'HADOOP_BATCH_SIZE',
+    'DELETE_THREADS',
+    'DELETE_RATE',
+    'DELETE_LATENCY_TARGET',
+    'DELETE_ERROR_TARGET',
+    'SCAN_CACHE',
+    'PROTECTED_SOURCE',
+    'PROTECTED_CACHE',
+    'PROTECTED_REFRESH',
+    'PROTECTED_MAX_AGE',
+    'METRICS_DIR',
+    'PROGRESS_INTERVAL',
+    'DAEMON_WRITE_INTERVAL',
+    'DAEMON_RESCAN_INTERVAL',
     ]
 
 
-def get_default(key):
+def get_default(key, site_name=None):
     """
     :param str key: This can be any of the keys in DEFAULTS in addition to
                     SITE_NAME and UNMERGED_DIR_LOCATION
+    :param str site_name: is the site to write for SITE_NAME, instead of guessing it
     :returns: a string to write to the default configuration module.
     :rtype: str
     """
 
     if key == 'SITE_NAME':
-        return 'SITE_NAME = \'%s\'' % guess_site()
+        return 'SITE_NAME = \'%s\'' % (site_name or guess_site())
     elif key == 'UNMERGED_DIR_LOCATION':
-        return 'UNMERGED_DIR_LOCATION = pfn_from_phedex(SITE_NAME, LFN_TO_CLEAN)'
+        return ('UNMERGED_DIR_LOCATION = pfn_from_cache(SITE_NAME, LFN_TO_CLEAN, '
+                'PFN_CACHE, PFN_CACHE_TTL)')
     elif key == 'DELETION_FILE':
         return 'DELETION_FILE = \'/tmp/%s_to_delete.txt\' % WHICH_LIST'
+    elif key in LOCAL_FILES:
+        return '%s = os.path.join(os.path.dirname(os.path.abspath(__file__)), \'%s\')' % \
+            (key, DEFAULTS[key])
 
     str_form = key + " = '%s'"
     if not isinstance(DEFAULTS[key], str):
@@ -207,16 +559,20 @@ def generate_default_config():
     This generates the file ``config.py``, if it does not exist.
     Site admins should check this configuration and change to their desired
     values before running ``ListDeletable.py`` a second time.
+    The PFN of the unmerged directory at the guessed site is put in **PFN_CACHE** right away,
+    so that loading the new configuration does not have to ask Phedex.
     """
 
     if os.path.exists('config.py'):
         print 'Default config, config.py already exists.'
     else:
+        site_name = guess_site()
 
         # This goes at the top of the config file.
         header = ('# Automatically generated by ConfigTools.generate_default_config()\n'
                   '# %s on the node %s\n\n\n'
-                  'from ConfigTools import pfn_from_phedex\n\n' %
+                  'import os\n\n'
+                  'from ConfigTools import pfn_from_cache\n\n' %
                   (datetime.date.strftime(
                       datetime.datetime.now(),
                       'On %d %B %Y at %H:%M:%S'
@@ -233,4 +589,11 @@ def generate_default_config():
 
                 config_file.write('\n#' + '-' * 99 + '\n')
                 config_file.write('# ' + DOCS[var].replace('\n', '\n# ').replace('``', '') + '\n\n')
-                config_file.write(get_default(var) + '\n')
+                config_file.write(get_default(var, site_name) + '\n')
+
+        try:
+            PfnCache(os.path.abspath(DEFAULTS['PFN_CACHE']), DEFAULTS['PFN_CACHE_TTL']).resolve(
+                site_name, [DEFAULTS['LFN_TO_CLEAN']])
+        except Exception as msg:   # pylint: disable=broad-except
+            print 'Cannot get the unmerged directory of %s from Phedex yet: %s' % \
+                (site_name, msg)
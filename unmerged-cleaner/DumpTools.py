@@ -0,0 +1,279 @@
+"""
+This module reads namespace dumps of a storage system,
+so that the unmerged directory can be checked without listing the live storage.
+Three formats are understood:
+
+- ``'fsimage'`` is the tab delimited output of the HDFS offline image viewer::
+
+      hdfs oiv -p Delimited -i fsimage_0000000000000000000 -o dump.txt
+
+- ``'find'`` is a listing made with::
+
+      find /path/to/store/unmerged -printf '%y %s %T@ %p\\n' > dump.txt
+
+- ``'hdfs-ls'`` is the output of::
+
+      hdfs dfs -ls -R /store/unmerged > dump.txt
+
+Each path has to start with either the unmerged LFN, like the Hadoop paths in HDFS dumps,
+or the PFN of the unmerged directory, and only the part after that is used.
+Times with only minute precision are read in the local time zone.
+"""
+
+import time
+import datetime
+
+
+FORMATS = ['fsimage', 'find', 'hdfs-ls']
+
+
+def to_timestamp(date_string):
+    """
+    :param str date_string: is a date in the format ``'%Y-%m-%d %H:%M'``,
+                            or a number of seconds or milliseconds since the epoch
+    :returns: the time as seconds since the epoch
+    :rtype: float
+    """
+
+    if date_string.isdigit():
+        stamp = float(date_string)
+        # Hadoop gives times in milliseconds
+        return stamp / 1000 if stamp > 1e11 else stamp
+
+    return time.mktime(
+        datetime.datetime.strptime(date_string, '%Y-%m-%d %H:%M').timetuple())
+
+
+def parse_fsimage(line):
+    """
+    :param str line: is a line of an offline image viewer dump
+    :returns: the path, whether it is a directory, the size, and the modification time,
+              or ``None`` if the line is a header
+    :rtype: tuple
+    """
+
+    fields = line.split('\t')
+    if fields[0] == 'Path':
+        return None
+
+    return (fields[0], fields[9].startswith('d'),
+            int(fields[6]), to_timestamp(fields[2]))
+
+
+def parse_find(line):
+    """
+    :param str line: is a line of a ``find -printf '%y %s %T@ %p\\n'`` dump
+    :returns: the path, whether it is a directory, the size, and the modification time,
+              or ``None`` if the line is not a directory or file
+    :rtype: tuple
+    """
+
+    kind, size, mtime, path = line.split(' ', 3)
+    if kind not in ('d', 'f'):
+        return None
+
+    return (path, kind == 'd', int(size), float(mtime))
+
+
+def parse_hdfs_ls(line):
+    """
+    :param str line: is a line of a ``hdfs dfs -ls -R`` dump
+    :returns: the path, whether it is a directory, the size, and the modification time,
+              or ``None`` if the line is a header
+    :rtype: tuple
+    """
+
+    fields = line.split(None, 7)
+    if len(fields) < 8:
+        return None
+
+    return (fields[7], fields[0].startswith('d'),
+            int(fields[4]), to_timestamp('%s %s' % (fields[5], fields[6])))
+
+
+PARSERS = {
+    'fsimage': parse_fsimage,
+    'find': parse_find,
+    'hdfs-ls': parse_hdfs_ls,
+}
+
+
+def guess_format(line):
+    """
+    :param str line: is the first line of a dump
+    :returns: the name of the dump format
+    :rtype: str
+    :raises ValueError: if the format is not recognized
+    """
+
+    if line.startswith('Path\t') or line.count('\t') >= 11:
+        return 'fsimage'
+    if line[:2] in ('d ', 'f ', 'l '):
+        return 'find'
+    if line[:1] in ('d', '-') and len(line.split(None, 7)) == 8:
+        return 'hdfs-ls'
+
+    raise ValueError('Cannot determine the format of the dump from the line:\n%s' % line)
+
+
+def relative_path(path, lfn, pfn=None):
+    """
+    :param str path: is a path from a dump
+    :param str lfn: is the LFN of the unmerged directory
+    :param str pfn: is the PFN of the unmerged directory, if the dump may hold PFNs
+    :returns: the path relative to the unmerged directory,
+              or ``None`` if the path does not start with the LFN or PFN
+    :rtype: str
+    """
+
+    for top in (lfn, pfn):
+        if not top:
+            continue
+        top = top.rstrip('/')
+        if path == top:
+            return ''
+        if path.startswith(top + '/'):
+            return path[len(top):].strip('/')
+
+    return None
+
+
+class NamespaceDump(object):
+    """
+    Holds the contents of the unmerged directory, as read from a dump.
+    Directories are keyed by their path relative to the unmerged directory,
+    with ``''`` being the unmerged directory itself.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty namespace.
+        """
+        self.dirs = {'': []}
+        self.dir_mtimes = {'': 0}
+        self.num_files = 0
+
+    def add(self, path, is_dir, size, mtime):
+        """
+        Adds an entry to the namespace.
+        Parent directories that are not in the dump are made as needed.
+
+        :param str path: is the path relative to the unmerged directory
+        :param bool is_dir: is whether or not the entry is a directory
+        :param int size: is the size of a file
+        :param float mtime: is the modification time of the entry
+        """
+
+        if not path:
+            self.dir_mtimes[''] = mtime
+            return
+
+        if is_dir:
+            if path not in self.dirs:
+                self.dirs[path] = []
+                self.dir_mtimes[path] = mtime
+                self.add_to_parent(path, True, None)
+            else:
+                self.dir_mtimes[path] = mtime
+        else:
+            self.num_files += 1
+            self.add_to_parent(path, False, (size, mtime))
+
+    def add_to_parent(self, path, is_dir, stats):
+        """
+        Adds an entry to the listing of its parent directory.
+
+        :param str path: is the path relative to the unmerged directory
+        :param bool is_dir: is whether or not the entry is a directory
+        :param tuple stats: is the size and modification time of a file
+        """
+
+        parent, _, name = path.rpartition('/')
+        if parent not in self.dirs:
+            self.add(parent, True, 0, 0)
+
+        self.dirs[parent].append((name, is_dir, stats))
+
+    @classmethod
+    def from_file(cls, file_name, lfn, dump_format=None, pfn=None):
+        """
+        Reads a dump, one line at a time.
+
+        :param str file_name: is the name of the dump file
+        :param str lfn: is the LFN of the unmerged directory
+        :param str dump_format: is one of :py:data:`FORMATS`.
+                                If not given, it is guessed from the first line.
+        :param str pfn: is the PFN of the unmerged directory, for dumps that hold PFNs
+        :returns: the namespace of the unmerged directory
+        :rtype: NamespaceDump
+        """
+
+        namespace = cls()
+        parser = PARSERS.get(dump_format)
+
+        with open(file_name, 'r') as dump:
+            for line in dump:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+
+                if parser is None:
+                    parser = PARSERS[guess_format(line)]
+
+                parsed = parser(line)
+                if parsed is None:
+                    continue
+
+                path = relative_path(parsed[0], lfn, pfn)
+                if path is not None:
+                    namespace.add(path, *parsed[1:])
+
+        return namespace
+
+    def list_dir(self, path):
+        """
+        :param str path: is the directory relative to the unmerged directory
+        :returns: tuples of the name, whether it is a directory, the size,
+                  and the modification time of each entry in the directory
+        :rtype: list
+        :raises OSError: if the directory is not in the dump
+        """
+
+        if path not in self.dirs:
+            raise OSError(2, 'No such directory in dump', path)
+
+        output = []
+        for name, is_dir, stats in self.dirs[path]:
+            if is_dir:
+                child = '/'.join([path, name]) if path else name
+                output.append((name, True, 0, self.dir_mtimes[child]))
+            else:
+                output.append((name, False, stats[0], stats[1]))
+
+        return output
+
+    def get_mtime(self, path):
+        """
+        :param str path: is the directory relative to the unmerged directory
+        :returns: the modification time of the directory
+        :rtype: float
+        :raises OSError: if the directory is not in the dump
+        """
+
+        if path not in self.dir_mtimes:
+            raise OSError(2, 'No such directory in dump', path)
+
+        return self.dir_mtimes[path]
+
+    def iter_files(self):
+        """
+        :returns: the path relative to the unmerged directory, size,
+                  and modification time of every file
+        :rtype: generator
+        """
+
+        for path, entries in self.dirs.iteritems():
+            for name, is_dir, stats in entries:
+                if not is_dir:
+                    yield ('/'.join([path, name]) if path else name,
+                           stats[0], stats[1])
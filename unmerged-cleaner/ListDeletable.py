@@ -25,6 +25,11 @@ This will attempt to determine the site it is being run at through the hostname
 and set **SITE_NAME** accordingly.
 However, you should check the default values since there are other values that can be changed.
 In particular, the **STORAGE_TYPE** may affect whether or not the script runs optimally at the site.
+The PFN of the unmerged directory is asked from Phedex once and kept in **PFN_CACHE**,
+so loading the configuration does not need the network.
+A ``config.py`` generated before that calls ``pfn_from_phedex(SITE_NAME, LFN_TO_CLEAN)``
+on every run, and can be switched by replacing it with
+``pfn_from_cache(SITE_NAME, LFN_TO_CLEAN)`` after importing ``pfn_from_cache`` from ``ConfigTools``.
 The various configuration options inside ``config.py`` are listed below.
 
 %s
@@ -36,6 +41,42 @@ Running
 
 After creating and checking the :file:`config.py`, the ``ListDeletable.py`` script can be run again
 to write a list of directory or file PFNs that can be removed.
+The sizes of directories are written to a metadata file next to the list,
+so that ``--delete --target-bytes`` can free the most space first.
+
+A large unmerged directory can be listed by many nodes that mount the same storage.
+Each node runs ``ListDeletable.py --shard I/N`` for a different I from 1 to N,
+which lists only the top level directories assigned to that shard by a hash of their names,
+and writes a partial deletion file next to **DELETION_FILE**.
+After every shard has finished, ``ListDeletable.py --merge`` combines the partial files
+into **DELETION_FILE** and prints the table of deletions for the whole site.
+Every shard of one scan has to be given the same ``--run-id``, which is the UTC date by default,
+so that a partial file left over from an earlier scan is not merged.
+This only works when listing directories, and **DELETION_FILE** needs to be on a shared file system
+or the partial files need to be copied to one node before merging.
+To avoid loading the storage system while listing, the contents of the unmerged directory
+can instead be read from a namespace dump by passing ``--dump <FILE>``.
+To choose **MIN_AGE**, ``ListDeletable.py --what-if 3,7,14,30`` lists the directories once
+and prints how much could be deleted with a minimum age of each number of days,
+without writing the deletion file.
+
+On a POSIX storage that changes slowly compared to its size,
+``ListDeletable.py --daemon`` lists everything once, then keeps running and follows changes
+with the :ref:`unmerged-watch-ref-ref`, so that only changed directories are listed again.
+It rewrites **DELETION_FILE** every **DAEMON_WRITE_INTERVAL** seconds,
+or within a couple of seconds of ``kill -USR1 <PID>``.
+inotify only reports changes made through the kernel of the node running the daemon,
+so on NFS, Lustre or other network file systems it should run on the node doing the writes,
+or rely on the full listing done every **DAEMON_RESCAN_INTERVAL** seconds.
+Before each write, every deletable directory is listed once more without its subdirectories,
+and its files are stat-ed until one is too new,
+which costs about one listing for each deletable directory.
+A file written without an event deeper inside a deletable directory
+is only seen by the full listing,
+so **DAEMON_RESCAN_INTERVAL** should be well below **MIN_AGE** on a network file system.
+Each directory takes one watch, so ``fs.inotify.max_user_watches`` may need to be raised
+above the number of directories in the unmerged directory.
+
 We expect most site admins to have tools to correctly remove those directories.
 However, available tools for removing directories or files in this list are given under
 :ref:`unmerged-delete-ref`.
@@ -46,13 +87,14 @@ Potential Optimization
 ++++++++++++++++++++++
 
 This script was originally developed on a Hadoop system and unit tested on POSIX.
-There are three different functions that interact with the file system which could potentially
-be broken or unoptimized for other types of file systems.
-These functions are :py:func:`list_folder`, :py:func:`get_file_size`,
-:py:func:`do_delete`, and :py:func:`get_mtime`.
-Anyone who wants to contribute optimized versions of these functions,
-depending on the value of :py:data:`config.STORAGE_TYPE`
-(as it is called from within ``ListDeletable.py``)
+Everything that touches the storage system goes through a backend
+from the :ref:`unmerged-storage-ref-ref`, picked by **STORAGE_TYPE**.
+A backend lists a directory with the sizes and modification times of its entries in one call,
+gets the stats of many paths at once, and deletes many paths at once.
+The POSIX backend uses the ``scandir`` module if it is installed
+(it is built in for Python 3.5 and later), so that entry types come from the
+directory read itself and only files are stat-ed.
+Anyone who wants to contribute an optimized backend for their file system
 is welcome to make pull requests.
 
 :authors: Christoph Wissing <christoph.wissing@desy.de> \n
@@ -60,17 +102,34 @@ is welcome to make pull requests.
           Daniel Abercrombie <dabercro@mit.edu>
 """
 
-import httplib
-import json
+import errno
+import hashlib
 import os
+import re
+import signal
 import time
 import datetime
 import subprocess
-import shutil
+import threading
+import Queue
+from array import array
 from bisect import bisect_left
+from collections import namedtuple
 from optparse import OptionParser
 
+# NumPy is only used to speed up the columnar tree, if it is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import CacheTools
 import ConfigTools
+import DumpTools
+import MetricsTools
+import StorageTools
+import WatchTools
+from ProtectionTools import ProtectedTrie, PatternMatcher
 
 
 if __name__ == '__main__':
@@ -91,6 +150,55 @@ if __name__ == '__main__':
                             'can be activated so that the site admin can take a look by '
                             'hand at the deletion list.'))
 
+    PARSER.add_option('--resume', action='store_true', dest='resume',
+                      help=('With --delete, continue from where the last deletion run '
+                            'on the same deletion file stopped.'))
+
+    PARSER.add_option('--target-bytes', metavar='SIZE', dest='target_bytes',
+                      help=('With --delete, delete the directories that free the most space '
+                            'for each operation first, and stop once SIZE bytes are freed. '
+                            'SIZE can end with K, M, G, T or P.'))
+
+    PARSER.add_option('--time-budget', metavar='SECONDS', dest='time_budget', type='float',
+                      help=('With --delete, delete the directories that free the most space '
+                            'for each operation first, and stop after SECONDS.'))
+
+    PARSER.add_option('--shard', metavar='I/N', dest='shard',
+                      help=('List only the top level directories in shard I of N, '
+                            'so that N nodes can share the scan. Each shard writes its '
+                            'own partial deletion file, which are combined with --merge.'))
+
+    PARSER.add_option('--merge', action='store_true', dest='merge',
+                      help=('Combine the partial deletion files written by every --shard '
+                            'into the deletion file.'))
+
+    PARSER.add_option('--run-id', metavar='ID', dest='run_id',
+                      help=('With --shard, the name of the scan that the shard belongs to. '
+                            'Every shard of a scan needs the same ID. '
+                            'The default is the UTC date when the shard starts. '
+                            'With --merge, only merge the shards of this scan.'))
+
+    PARSER.add_option('--daemon', action='store_true', dest='daemon',
+                      help=('Keep running after listing the directories, follow changes '
+                            'with inotify, and rewrite the deletion file every '
+                            'DAEMON_WRITE_INTERVAL seconds or when sent SIGUSR1.'))
+
+    PARSER.add_option('--what-if', metavar='DAYS', dest='what_if',
+                      help=('Instead of writing the deletion file, list the directories once '
+                            'and print what could be deleted with each MIN_AGE in DAYS, '
+                            'a comma-separated list of days like 3,7,14,30.'))
+
+    PARSER.add_option('--dump', metavar='FILE', dest='dump',
+                      help=('Read the contents of the unmerged directory from a namespace '
+                            'dump instead of listing the storage. '
+                            'See the DumpTools module for the dumps that can be read.'))
+
+    PARSER.add_option('--dump-format', metavar='FORMAT', dest='dump_format',
+                      choices=DumpTools.FORMATS,
+                      help=('The format of the file given to --dump: %s. '
+                            'By default, this is guessed from the file.' %
+                            ', '.join(DumpTools.FORMATS)))
+
     (OPTS, ARGS) = PARSER.parse_args()
 
 
@@ -107,6 +215,18 @@ except ImportError:
     exit()
 
 
+# Fill in any options added since the configuration file was generated
+for _key in ConfigTools.DEFAULTS:
+    if not hasattr(config, _key):
+        if _key in ConfigTools.LOCAL_FILES:
+            # A configuration made in memory has no file, so its files go in the working directory
+            config_file = getattr(config, '__file__', 'config.py')
+            setattr(config, _key, os.path.join(os.path.dirname(os.path.abspath(config_file)),
+                                               ConfigTools.DEFAULTS[_key]))
+        else:
+            setattr(config, _key, ConfigTools.DEFAULTS[_key])
+
+
 class SuspiciousConditions(Exception):
     """
     An exception for catching anticipated configuration an tool problems.
@@ -121,80 +241,193 @@ class DataNode(object):
     Removability is determined by the list of protected directories and the directory age.
     """
 
-    def __init__(self, path_name):
+    def __init__(self, path_name, mtime=None):
         """
         Initializes the DataNode.
         :param str path_name: is the path to the directory that defines this DataNode
+        :param float mtime: is the modification time of the directory, if already known
+                            from the listing of the parent directory
         """
         self.path_name = path_name
+        self.mtime = mtime
         self.sub_nodes = []
         self.can_vanish = None
+        self.protected = False
+        self.holds_protected = False
         self.latest = 0
         self.nsubnodes = 0
         self.nsubfiles = 0
         self.size = 0
 
+        # The deletable DataNodes under this one, if this one cannot be deleted itself.
+        # These move to the parent DataNode when it is aggregated.
+        self.to_delete = []
+
+        # Totals of the files directly inside of this directory
+        self.nfiles = 0
+        self.files_size = 0
+        self.files_latest = 0
+
     def fill(self):
         """
         Fills this DataNode's sub_node member with all DataNodes made by subdirectories.
-        Recursively builds the full tree.
+        Builds the full tree, depth first, using a stack instead of recursion.
+        Each DataNode is aggregated as soon as all of its subdirectories are filled,
+        so deletable directories are known without walking the tree again.
+        """
+
+        stack = [(self, False)]
+
+        while stack:
+            node, listed = stack.pop()
+            if listed:
+                node.aggregate()
+            else:
+                stack.append((node, True))
+                stack.extend([(sub_node, False) for sub_node in reversed(node.list_contents())])
+
+    def list_contents(self):
+        """
+        Lists the directory of this DataNode.
+        The DataNodes of the subdirectories are created, but not filled,
+        and the files directly inside the directory are counted.
+        A protected directory is not listed.
+        If there is a :py:data:`SCAN_CACHE` and the directory is unchanged
+        since it was cached, the cached listing is used instead.
+        If **SCAN_MODE** is ``'decision'``, the files stop being stat-ed once one is too new,
+        and sizes are not added up at all, since :py:func:`add_sizes` gets them
+        for the deletable directories only.
+
+        :returns: the new sub_nodes, which still need to be filled
+        :rtype: list
         """
 
-        lfn_path_name = os.path.join(config.LFN_TO_CLEAN, self.path_name)
+        protection = PROTECTED_INDEX.lookup(
+            os.path.join(config.LFN_TO_CLEAN, self.path_name))
 
         # If protected, cannot delete this DataNode, and stop filling
-        if bi_search(ALL_LENGTHS, len(lfn_path_name)) and \
-                bi_search(PROTECTED_LIST, lfn_path_name):
-            self.can_vanish = False
+        if protection == ProtectedTrie.PROTECTED:
+            self.protected = True
+            return []
 
-        else:
-            full_path_name = os.path.join(config.UNMERGED_DIR_LOCATION, self.path_name)
+        # Directories above protected ones cannot be deleted either
+        self.holds_protected = protection == ProtectedTrie.HOLDS_PROTECTED
 
-            # Here we invoke method that might not work on all storage systems
-            # Check list_folder()
+        full_path_name = os.path.join(config.UNMERGED_DIR_LOCATION, self.path_name)
 
-            dirs = list_folder(full_path_name, 'subdirs')
-            all_files = list_folder(full_path_name, 'files')
+        if SCAN_CACHE is not None:
+            # Get the time before listing, so that changes during the listing are caught
+            if self.mtime is None:
+                self.mtime = get_mtime(full_path_name)
 
-            for subdir in dirs:
-                sub_node = DataNode(os.path.join(self.path_name, subdir))
-                sub_node.fill()
-                self.sub_nodes.append(sub_node)
+            cached = SCAN_CACHE.get(self.path_name, self.mtime)
 
-            # Get the latest modification start for all files
-            for file_name in all_files:
-                modtime = get_mtime(full_path_name + '/' + file_name)
-                self.size = self.size + get_file_size(full_path_name + '/' + file_name)
-                if modtime > self.latest:
-                    self.latest = modtime
+            # Files that are still being written do not change the directory time
+            if cached is not None and NOW - cached.files_latest >= config.MIN_AGE:
+                self.nfiles, self.files_size, self.files_latest = cached[:3]
+                self.sub_nodes = [DataNode(os.path.join(self.path_name, name))
+                                  for name in cached.subdirs]
+                return self.sub_nodes
 
-            self.can_vanish = True
+        # Here we invoke method that might not work on all storage systems
+        # Check list_entries()
 
-            for sub_node in self.sub_nodes:
-                # Add one to include the subnode in the loop
-                self.nsubnodes += sub_node.nsubnodes + 1
-                self.nsubfiles += sub_node.nsubfiles
-                self.size += sub_node.size
+        newer_than = NOW - config.MIN_AGE if config.SCAN_MODE == 'decision' else None
 
-                if not sub_node.can_vanish:
-                    self.can_vanish = False
+        for entry in list_entries(full_path_name, newer_than):
+            if entry.is_dir:
+                self.sub_nodes.append(
+                    DataNode(os.path.join(self.path_name, entry.name), entry.mtime))
 
-                if sub_node.latest > self.latest:
-                    self.latest = sub_node.latest
+            else:
+                # Get the latest modification start for all files
+                self.nfiles += 1
+                if entry.mtime is None:
+                    continue
+                if newer_than is None:
+                    self.files_size += entry.size
+                if entry.mtime > self.files_latest:
+                    self.files_latest = entry.mtime
+
+        if not self.sub_nodes and not self.nfiles and self.mtime is None:
+            # Check that this time function works for your system as well
+            self.mtime = get_mtime(full_path_name)
+
+        # A later run might need the stats and sizes that were skipped
+        if SCAN_CACHE is not None and newer_than is None:
+            SCAN_CACHE.put(self.path_name, self.mtime, self.nfiles, self.files_size,
+                           self.files_latest,
+                           [os.path.basename(sub_node.path_name) for sub_node in self.sub_nodes])
+
+        return self.sub_nodes
+
+    def aggregate(self):
+        """
+        Sums the totals of the already filled sub_nodes into this DataNode
+        and determines whether or not it can be deleted.
+        """
 
-            self.nsubfiles += len(all_files)
+        self.to_delete = []
 
-            if self.nsubnodes == 0 and self.nsubfiles == 0:
-                # Check that this time function works for your system as well
-                self.latest = get_mtime(full_path_name)
+        if self.protected:
+            self.can_vanish = False
+            return
 
-            if (NOW - self.latest) < config.MIN_AGE or lfn_path_name in PROTECTED_UPPER_DIRS:
+        self.can_vanish = True
+        self.nsubnodes = 0
+        self.nsubfiles = self.nfiles
+        self.size = self.files_size
+        self.latest = self.files_latest
+
+        for sub_node in self.sub_nodes:
+            # Add one to include the subnode in the loop
+            self.nsubnodes += sub_node.nsubnodes + 1
+            self.nsubfiles += sub_node.nsubfiles
+            self.size += sub_node.size
+
+            if sub_node.can_vanish:
+                self.to_delete.append(sub_node)
+            else:
                 self.can_vanish = False
+                self.to_delete.extend(sub_node.to_delete)
+                # Only the top of the tree keeps the list, instead of every level
+                sub_node.to_delete = []
+
+            if sub_node.latest > self.latest:
+                self.latest = sub_node.latest
+
+        if self.nsubnodes == 0 and self.nsubfiles == 0:
+            self.latest = self.mtime
+
+        if (NOW - self.latest) < config.MIN_AGE or self.holds_protected:
+            self.can_vanish = False
+
+        if self.can_vanish:
+            # Everything below is removed with this directory
+            self.to_delete = []
+
+    def aggregate_tree(self):
+        """
+        Calls :py:meth:`aggregate` for every DataNode in this tree,
+        starting from the bottom.
+        This is used after the tree has been listed by :py:func:`fill_parallel`.
+        """
+
+        stack = [(self, False)]
+
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                node.aggregate()
+            else:
+                stack.append((node, True))
+                stack.extend([(sub_node, False) for sub_node in node.sub_nodes])
 
     def traverse_tree(self, list_to_del):
         """
-        Searches the tree for directories that can be deleted
-        and appends them to a list of directories to delete.
+        Appends the directories in this tree that can be deleted
+        to a list of directories to delete.
+        These are found while the tree is aggregated, so no walk is needed here.
 
         :param list list_to_del: is a list of directories that
                                 can be deleted by a cleaner.
@@ -203,8 +436,337 @@ class DataNode(object):
         if self.can_vanish:
             list_to_del.append(self)
         else:
-            for sub_node in self.sub_nodes:
-                sub_node.traverse_tree(list_to_del)
+            list_to_del.extend(self.to_delete)
+
+
+DeletableDir = namedtuple('DeletableDir',
+                          ['path_name', 'nsubnodes', 'nsubfiles', 'size', 'latest'])
+"""
+A deletable directory found by :py:class:`ColumnarTree`.
+It has the same members that ``main()`` reads from a deletable :py:class:`DataNode`.
+"""
+
+
+class ColumnarTree(object):
+    """
+    Holds the same information as a tree of DataNodes, but in flat arrays
+    with one element per directory instead of one object per directory.
+    Each directory only stores the index of its parent and an index into a table of
+    directory names, so full paths are only built for the directories that are deleted.
+    This uses much less memory for very large unmerged directories.
+
+    Directories are stored in depth-first order, so every parent comes before its children
+    and deletable directories are listed in the same order as :py:meth:`DataNode.traverse_tree`.
+    The sums up the tree are done one depth level at a time with NumPy, if it is installed.
+    """
+
+    # Values of the flags column
+    PROTECTED = 1
+    HOLDS_PROTECTED = 2
+
+    def __init__(self, path_name):
+        """
+        Initializes an empty ColumnarTree.
+        :param str path_name: is the path to the top directory of the tree,
+                              relative to the unmerged directory
+        """
+        self.path_name = path_name
+
+        self.names = []
+        self.name_ids = {}
+
+        self.name = array('l')
+        self.parent = array('l')
+        self.depth = array('l')
+        self.flags = array('b')
+        self.mtime = array('d')
+        self.nfiles = array('l')
+        self.files_size = array('l')
+        self.files_latest = array('d')
+
+        # Filled by aggregate()
+        self.can_vanish = None
+        self.latest = None
+        self.size = None
+        self.nsubnodes = None
+        self.nsubfiles = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def fill(self):
+        """
+        Lists the full tree, depth first, and then calls :py:meth:`aggregate`.
+        Each directory is listed by a temporary :py:class:`DataNode`,
+        which is dropped as soon as its contents are copied into the arrays.
+        """
+
+        stack = [(-1, DataNode(self.path_name))]
+
+        while stack:
+            parent, node = stack.pop()
+            sub_nodes = node.list_contents()
+            index = self.append(parent, node)
+            stack.extend([(index, sub_node) for sub_node in reversed(sub_nodes)])
+
+        self.aggregate()
+
+    def append(self, parent, node):
+        """
+        Adds a listed directory to the end of the arrays.
+
+        :param int parent: is the index of the parent directory, or -1 for the top
+        :param DataNode node: is the listed, but not aggregated, DataNode
+        :returns: the index of the new directory
+        :rtype: int
+        """
+
+        name = node.path_name if parent < 0 else os.path.basename(node.path_name)
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+
+        flags = 0
+        if node.protected:
+            flags = self.PROTECTED
+        elif node.holds_protected:
+            flags = self.HOLDS_PROTECTED
+
+        self.name.append(name_id)
+        self.parent.append(parent)
+        self.depth.append(0 if parent < 0 else self.depth[parent] + 1)
+        self.flags.append(flags)
+        self.mtime.append(node.mtime or 0)
+        self.nfiles.append(node.nfiles)
+        self.files_size.append(node.files_size)
+        self.files_latest.append(node.files_latest)
+
+        return len(self.parent) - 1
+
+    def get_path(self, index):
+        """
+        :param int index: is the index of a directory in the tree
+        :returns: the path of the directory, relative to the unmerged directory
+        :rtype: str
+        """
+
+        names = []
+        while index >= 0:
+            names.append(self.names[self.name[index]])
+            index = self.parent[index]
+
+        return '/'.join(reversed(names))
+
+    def aggregate(self):
+        """
+        Sums the file counts, sizes and latest modification times up the tree
+        and determines which directories can be deleted.
+        This gives the same results as :py:meth:`DataNode.aggregate`.
+        """
+
+        if numpy is not None:
+            self._aggregate_numpy()
+        else:
+            self._aggregate_python()
+
+    def _aggregate_numpy(self):
+        """
+        Does the aggregation with NumPy, handling a full depth level of the tree at once.
+        """
+
+        parent = numpy.array(self.parent, dtype=numpy.int64)
+        depth = numpy.array(self.depth, dtype=numpy.int64)
+        flags = numpy.array(self.flags, dtype=numpy.int8)
+        mtime = numpy.array(self.mtime, dtype=numpy.float64)
+
+        size = numpy.array(self.files_size, dtype=numpy.int64)
+        nsubfiles = numpy.array(self.nfiles, dtype=numpy.int64)
+        latest = numpy.array(self.files_latest, dtype=numpy.float64)
+        nsubnodes = numpy.zeros(len(parent), dtype=numpy.int64)
+        blocked = flags != 0
+        can_vanish = numpy.zeros(len(parent), dtype=bool)
+
+        protected = flags == self.PROTECTED
+        size[protected] = 0
+        nsubfiles[protected] = 0
+        latest[protected] = 0
+
+        # Indices of each depth level, deepest level first
+        order = numpy.argsort(depth, kind='mergesort')
+        bounds = numpy.searchsorted(depth[order],
+                                    numpy.arange(depth.max() + 2 if len(depth) else 1))
+
+        for level in xrange(len(bounds) - 2, -1, -1):
+            index = order[bounds[level]:bounds[level + 1]]
+
+            empty = index[(nsubnodes[index] == 0) & (nsubfiles[index] == 0) &
+                          numpy.logical_not(protected[index])]
+            latest[empty] = mtime[empty]
+
+            can_vanish[index] = numpy.logical_not(blocked[index]) & \
+                ((NOW - latest[index]) >= config.MIN_AGE)
+
+            if level:
+                up = parent[index]
+                numpy.add.at(size, up, size[index])
+                numpy.add.at(nsubfiles, up, nsubfiles[index])
+                numpy.add.at(nsubnodes, up, nsubnodes[index] + 1)
+                numpy.maximum.at(latest, up, latest[index])
+                numpy.logical_or.at(blocked, up, numpy.logical_not(can_vanish[index]))
+
+        self.can_vanish = can_vanish
+        self.latest = latest
+        self.size = size
+        self.nsubnodes = nsubnodes
+        self.nsubfiles = nsubfiles
+
+    def _aggregate_python(self):
+        """
+        Does the aggregation in plain Python.
+        Children always come after their parent, so a single backwards loop is enough.
+        """
+
+        num = len(self.parent)
+
+        size = array('l', [0]) * num
+        nsubfiles = array('l', [0]) * num
+        nsubnodes = array('l', [0]) * num
+        latest = array('d', [0]) * num
+        can_vanish = array('b', [0]) * num
+        blocked = array('b', [0]) * num
+
+        for index in xrange(num - 1, -1, -1):
+            if self.flags[index] == self.PROTECTED:
+                blocked[index] = 1
+
+            else:
+                size[index] += self.files_size[index]
+                nsubfiles[index] += self.nfiles[index]
+                latest[index] = max(latest[index], self.files_latest[index])
+
+                if nsubnodes[index] == 0 and nsubfiles[index] == 0:
+                    latest[index] = self.mtime[index]
+
+                can_vanish[index] = not blocked[index] and not self.flags[index] and \
+                    (NOW - latest[index]) >= config.MIN_AGE
+
+            up = self.parent[index]
+            if up >= 0:
+                size[up] += size[index]
+                nsubfiles[up] += nsubfiles[index]
+                nsubnodes[up] += nsubnodes[index] + 1
+                latest[up] = max(latest[up], latest[index])
+                if not can_vanish[index]:
+                    blocked[up] = 1
+
+        self.can_vanish = can_vanish
+        self.latest = latest
+        self.size = size
+        self.nsubnodes = nsubnodes
+        self.nsubfiles = nsubfiles
+
+    def traverse_tree(self, list_to_del):
+        """
+        Appends the directories in this tree that can be deleted
+        to a list of directories to delete.
+
+        :param list list_to_del: is a list that :py:class:`DeletableDir` tuples are added to
+        """
+
+        for index in xrange(len(self.parent)):
+            up = self.parent[index]
+            if self.can_vanish[index] and (up < 0 or not self.can_vanish[up]):
+                list_to_del.append(DeletableDir(self.get_path(index),
+                                                int(self.nsubnodes[index]),
+                                                int(self.nsubfiles[index]),
+                                                int(self.size[index]),
+                                                float(self.latest[index])))
+
+
+def parallel_walk(items, expand, n_threads, stop=None):
+    """
+    Walks a tree of items using a pool of threads.
+    All of the threads take items from a single shared queue,
+    so a large directory tree is spread over the whole pool instead of
+    being walked by a single thread.
+
+    :param list items: are the items at the top of the tree
+    :param function expand: is called with each item and returns the list of items below it
+    :param int n_threads: is the number of threads calling *expand* at the same time
+    :param threading.Event stop: if given and set, the remaining items are not expanded
+    :raises Exception: the first exception raised by *expand*
+    """
+
+    stop = stop or threading.Event()
+
+    # Last in, first out keeps the queue short by finishing subtrees that are started
+    work = Queue.LifoQueue()
+    errors = []
+
+    def worker():
+        """Expands items from the queue until it gets None"""
+        while True:
+            item = work.get()
+            try:
+                if item is None:
+                    return
+                if not stop.is_set():
+                    for sub_item in expand(item):
+                        work.put(sub_item)
+            except Exception as err:   # pylint: disable=broad-except
+                errors.append(err)
+                stop.set()
+            finally:
+                work.task_done()
+
+    for item in items:
+        work.put(item)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(n_threads)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Queue.join() cannot be interrupted, so wait on an Event instead
+    finished = threading.Event()
+
+    def wait_for_queue():
+        """Sets the finished flag once every queued item is expanded"""
+        work.join()
+        finished.set()
+
+    waiter = threading.Thread(target=wait_for_queue)
+    waiter.daemon = True
+    waiter.start()
+    while not finished.is_set():
+        finished.wait(1)
+
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def fill_parallel(nodes, n_threads):
+    """
+    Fills a list of DataNodes using a pool of threads.
+    Directories are listed by :py:func:`parallel_walk`,
+    and the trees are aggregated once everything is listed.
+    The resulting trees are identical to the ones made by :py:meth:`DataNode.fill`.
+
+    :param list nodes: is the list of DataNodes to fill
+    :param int n_threads: is the number of threads listing directories at the same time
+    :raises Exception: the first exception raised while listing a directory
+    """
+
+    parallel_walk(nodes, DataNode.list_contents, n_threads)
+
+    for node in nodes:
+        node.aggregate_tree()
 
 
 def bi_search(thelist, item):
@@ -228,13 +790,39 @@ def bi_search(thelist, item):
     return False
 
 
-def list_folder(name, opt):
+def get_storage():
     """
-    Lists the directories or files in a parent directory.
+    :returns: the backend for the storage being cleaned.
+              This is a :py:class:`StorageTools.DumpBackend` if :py:data:`NAMESPACE` is set,
+              and otherwise the backend in :py:data:`StorageTools.BACKENDS` for **STORAGE_TYPE**.
+              The same backend is returned until either of those change.
+              If **METRICS_DIR** is set, the backend is wrapped in a
+              :py:class:`MetricsTools.TimedBackend` that records its calls in :py:data:`METRICS`.
+    :rtype: StorageTools.Backend
+    :raises ValueError: if there is no backend for **STORAGE_TYPE**
+    """
+
+    global STORAGE, STORAGE_KEY  # pylint: disable=global-statement
+
+    key = (NAMESPACE, config.STORAGE_TYPE, config.UNMERGED_DIR_LOCATION)
+    if STORAGE is None or key != STORAGE_KEY:
+        if NAMESPACE is not None:
+            STORAGE = StorageTools.DumpBackend(NAMESPACE, config.UNMERGED_DIR_LOCATION)
+        else:
+            if config.STORAGE_TYPE not in StorageTools.BACKENDS:
+                raise ValueError('Unknown STORAGE_TYPE %r. Use one of: %s' %
+                                 (config.STORAGE_TYPE, ', '.join(sorted(StorageTools.BACKENDS))))
+            STORAGE = StorageTools.BACKENDS[config.STORAGE_TYPE].from_config(config)
+        if config.METRICS_DIR:
+            STORAGE = MetricsTools.TimedBackend(STORAGE, METRICS)
+        STORAGE_KEY = key
+
+    return STORAGE
 
-    .. Note::
 
-       This can potentially be optimized for different filesystems.
+def list_folder(name, opt):
+    """
+    Lists the directories or files in a parent directory.
 
     :param str name: is the name of the directory to list.
     :param str opt: determines what to list inside the directory.
@@ -245,74 +833,104 @@ def list_folder(name, opt):
     :rtype: list
     """
 
-    # This is where the call is made depending on what
-    # file system the site is running, should add more as we go on
-    if opt == 'subdirs':
-        # Return list of directories
-        the_filter = os.path.isdir
-    else:
-        # Return list of files
-        the_filter = os.path.isfile
+    return [entry.name for entry in list_entries(name)
+            if entry.is_dir == (opt == 'subdirs')]
 
-    return [listing for listing in os.listdir(name) if
-            the_filter(os.path.join(name, listing))]
 
+def list_entries(name, newer_than=None):
+    """
+    Lists the directories and files in a parent directory, along with their
+    sizes and modification times, with one call to :py:meth:`StorageTools.Backend.list_dir`.
 
-def get_mtime(name):
+    :param str name: is the name of the directory to list.
+    :param float newer_than: if given, the files may stop being stat-ed after the first
+                             one modified after this time, using
+                             :py:meth:`StorageTools.Backend.list_dir_until`
+    :returns: the contents of the directory
+    :rtype: list of StorageTools.FolderEntry
     """
-    Get the modification time for a directory or file.
 
-    .. Note::
+    if newer_than is None:
+        return get_storage().list_dir(name)
+
+    return get_storage().list_dir_until(name, newer_than)
+
 
-       This can potentially be optimized for different filesystems.
+def get_stats(name):
+    """
+    :param str name: Name of directory or file
+    :returns: the stats of the directory or file
+    :rtype: StorageTools.FolderEntry
+    :raises OSError: if the directory or file does not exist
+    """
+
+    stats = get_storage().stat_many([name])[0]
+    if stats is None:
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+    return stats
+
+
+def get_mtime(name):
+    """
+    Get the modification time for a directory or file.
 
     :param str name: Name of directory or file
     :returns: Modification time
     :rtype: int
     """
 
-    return os.stat(name).st_mtime
+    return get_stats(name).mtime
 
 
 def get_file_size(name):
     """
     Get the size of a file.
 
-    .. Note::
-
-       This can potentially be optimized for different filesystems.
-       There's no real use for this function though besides reporting back the user,
-       so go ahead and return 0 or something if you want to.
-
     :param str name: Name of file
     :returns: File size, in bytes
     :rtype: int
     """
 
-    return os.stat(name).st_size
+    return get_stats(name).size
 
 
 def get_protected():
     """
+    Reads the protected LFNs from **PROTECTED_SOURCE**.
+    If **PROTECTED_CACHE** is set, a copy checked less than **PROTECTED_REFRESH** seconds ago
+    is used without contacting the source.
+    Otherwise, the source is only asked to send the list if it changed.
+    If the source cannot be read, a copy checked less than **PROTECTED_MAX_AGE** seconds ago
+    is used instead.
+
     :returns: the protected directory LFNs.
     :rtype: list
     """
 
-    url = 'cmst2.web.cern.ch'
-    conn = httplib.HTTPSConnection(url)
+    cache = CacheTools.ProtectedCache(config.PROTECTED_SOURCE, config.PROTECTED_CACHE)
+    age = cache.age()
+
+    if age is not None and 0 <= age < config.PROTECTED_REFRESH:
+        return cache.protected
 
     try:
-        conn.request('GET', '/cmst2/unified/listProtectedLFN.txt')
-        res = conn.getresponse()
-        result = json.loads(res.read())
-        protected = result['protected']
-    except Exception:
+        cache.refresh()
+    except Exception as msg:   # pylint: disable=broad-except
+        print 'Exception: %s' % msg
+        if age is not None and 0 <= age < config.PROTECTED_MAX_AGE:
+            print 'Cannot refresh Protected LFNs. Using the copy from %i seconds ago.' % age
+            return cache.protected
+
         print 'Cannot read Protected LFNs. Have to stop...'
         exit(1)
 
-    conn.close()
+    try:
+        cache.save()
+    except (IOError, OSError) as msg:
+        print 'Cannot save Protected LFNs to %s: %s' % (config.PROTECTED_CACHE, msg)
 
-    return protected
+    return cache.protected
 
 
 def lfn_to_pfn(lfn):
@@ -326,243 +944,1848 @@ def lfn_to_pfn(lfn):
     return pfn
 
 
-def hadoop_delete(directory, mount_point='/mnt/hadoop'):
+class RateLimiter(object):
     """
-    Does the deletion for Hadoop sites.
-
-    :param str directory: The directory name for hdfs to delete.
-                          This is not exactly the same as the LFN or PFN.
-    :param str mount_point: The location of the hadoop mount point.
+    Spaces out operations from any number of threads,
+    so that no more than a given number start each second.
     """
 
-    # Check if path is still there in case checksum is actually in a different place
-    # than we are expecting at the moment.
-    if os.path.exists(os.path.normpath(os.path.sep.join([mount_point, directory]))):
-        command = 'hdfs dfs -rm -r %s' % directory
-        print 'Will do:', command
-        time.sleep(config.SLEEP_TIME)
-        os.system(command)
+    def __init__(self, rate):
+        """
+        Initializes the RateLimiter.
+        :param float rate: is the maximum number of operations per second
+        """
+        self.interval = 1.0 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self, count=1):
+        """
+        Sleeps until the calling thread is allowed to start its next operations.
 
+        :param int count: is the number of operations that the thread will do
+        """
 
-def dcache_delete(directory):
-    """
-    Does the deletion for dCache sites.
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval * count
 
-    :param str directory: The directory name for dCache to delete
-    """
-    print 'Not implimented yet. %s has not been deleted.' % directory
-    print 'Try posix or editing dcache_delete() in ListDeletable.py'
+        if start > now:
+            time.sleep(start - now)
 
 
-def do_delete():
+class AdaptiveRateLimiter(RateLimiter):
+    """
+    A :py:class:`RateLimiter` that follows how the storage system is coping.
+    The latency and outcomes of deletions are passed to :py:meth:`observe`.
+    After each window of calls, the rate is raised by a fixed step if the storage kept up,
+    and halved if the deletions were too slow or too many failed.
     """
-    Does the deletion for a site based on the deletion file contents.
-    If the deletion file does not exist a message is printed to the user
-    and the script exits.
 
-    .. Note::
+    def __init__(self, rate, latency_target, error_target, window=10):
+        """
+        Initializes the AdaptiveRateLimiter.
+        :param float rate: is the number of operations per second to start with.
+                           The rate is raised by a tenth of this at a time,
+                           and never drops below a hundredth of it.
+        :param float latency_target: is the most seconds that removing one file or directory
+                                     should take
+        :param float error_target: is the largest fraction of entries that may fail
+        :param int window: is the number of calls observed before each change of the rate
+        """
+        RateLimiter.__init__(self, rate)
+        self.rate = float(rate)
+        self.increase = self.rate / 10
+        self.min_rate = self.rate / 100
+        self.latency_target = latency_target
+        self.error_target = error_target
+        self.window = window
+        self.decisions = []
+        self.reset()
+
+    def reset(self):
+        """
+        Starts a new window of observations.
+        """
 
-       This can potentially be optimized for different filesystems.
+        self.calls = 0
+        self.count = 0
+        self.seconds = 0.0
+        self.entries = 0
+        self.failed = 0
 
-    .. Warning::
+    def observe(self, seconds, count, results):
+        """
+        Records one finished call, and changes the rate at the end of each window.
 
-       **For Hadoop sites:**
-       Currently, we assume your Hadoop instance is mounted at `/mnt/hadoop`
-       and the checksums are located under `/mnt/hadoop/cksums`.
-       If this is not the case, the cksums will not be deleted.
-       Your LFN will still be properly propagated to delete
-       the unmerged files themselves.
-    """
+        :param float seconds: is how long the call took
+        :param int count: is the number of files and directories that the call removed
+        :param list results: is the outcomes of the call, from :py:func:`delete_entries`
+        """
 
-    if not os.path.isfile(config.DELETION_FILE):
-        print 'Deletion file %s has not been created yet.' % config.DELETION_FILE
-        exit()
+        with self.lock:
+            self.calls += 1
+            self.count += count
+            self.seconds += seconds
+            self.entries += len(results)
+            self.failed += len([True for _, outcome, _ in results if outcome == 'failed'])
 
-    if config.WHICH_LIST != 'directories':
-        print '-' * 40
-        print 'Deleting individual files.'
-        print 'Your sleep time is set to %s seconds.' % config.SLEEP_TIME
-        print 'To change it, edit your config.py.'
-        print '-' * 40
+            if self.calls < self.window:
+                return
 
-    with open(config.DELETION_FILE, 'r') as deletions:
-        for deleted in deletions.readlines():
-            deleting = deleted.strip('\n')
+            latency = self.seconds / max(1, self.count)
+            errors = float(self.failed) / max(1, self.entries)
 
-            # Do a check of the directory names. End process if something is wrong.
-            if '/unmerged/' not in deleting:
-                print 'Something is either wrong with your deletions file or'
-                print 'ListDetetable.do_delete().'
-                print 'Your deletions file is at', config.DELETION_FILE
-                print 'Refusing to continue.'
-                exit()
+            if errors > self.error_target:
+                self.set_rate(self.rate / 2, '%.1f%% of deletions failed' % (100 * errors))
+            elif latency > self.latency_target:
+                self.set_rate(self.rate / 2, 'deletions took %.3f seconds each' % latency)
+            else:
+                self.set_rate(self.rate + self.increase,
+                              'deletions took %.3f seconds each' % latency)
 
-            if config.WHICH_LIST == 'directories':
+            self.reset()
 
-                if config.STORAGE_TYPE == 'hadoop':
-                    # Hadoop stores also a directory with checksums
-                    hadoop_delete(deleting.replace('/mnt/hadoop', '/cksums'))
-                    # Delete the unmerged directory
-                    hadoop_delete(deleting.replace('/mnt/hadoop', ''))
+    def set_rate(self, rate, reason):
+        """
+        Changes the rate, and prints the decision and keeps it in ``decisions``.
+        Nothing is done if the rate stays the same, like when it is already at the lowest.
 
-                elif config.STORAGE_TYPE == 'dcache':
-                    dcache_delete(deleting)
+        :param float rate: is the new number of operations per second
+        :param str reason: is why the rate changed
+        """
 
-                else:
-                    # The default, 'posix', goes here
-                    print 'About to delete %s' % deleting
-                    time.sleep(config.SLEEP_TIME)
-                    shutil.rmtree(deleting)
+        old_rate = self.rate
+        rate = max(self.min_rate, rate)
+        if rate == old_rate:
+            return
 
-            else:
-                if os.path.isfile(deleting):
-                    print 'About to delete %s' % deleting
-                    time.sleep(config.SLEEP_TIME)
-                    os.remove(deleting)
+        self.rate = rate
+        self.interval = 1.0 / self.rate
+        self.decisions.append((time.time(), self.rate, reason))
 
+        print 'Deletion rate %s from %.2f to %.2f per second: %s' % \
+            ('raised' if self.rate > old_rate else 'lowered', old_rate, self.rate, reason)
 
-def get_unmerged_files():
+
+def delete_entries(entries):
     """
-    :returns: the old files' PFNs in the unmerged directory
+    Deletes a group of entries from the deletion file
+    with one call to :py:meth:`StorageTools.Backend.delete_many`.
+
+    :param list entries: are the directory or file PFNs to delete
+    :returns: a tuple for each entry with the entry, the outcome
+              (``'deleted'``, ``'missing'``, ``'skipped'`` or ``'failed'``), and a message
     :rtype: list
     """
 
-    find_cmd = 'find {0} -type f -not -newermt \'-{1} seconds\' -print'.format(
-        config.UNMERGED_DIR_LOCATION, config.MIN_AGE)
+    outcomes = get_storage().delete_many(entries, config.WHICH_LIST == 'directories')
+    return [(deleting, outcome, message)
+            for deleting, (outcome, message) in zip(entries, outcomes)]
 
-    print 'About to run:'
-    print find_cmd
 
-    out = subprocess.Popen(find_cmd, shell=True, stdin=subprocess.PIPE,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def deletion_weight(entries):
+    """
+    :param list entries: is a group of entries from :py:func:`iter_deletion_groups`
+    :returns: the number of deletions that the group counts as
+              for **DELETE_RATE** and **SLEEP_TIME**,
+              from :py:meth:`StorageTools.Backend.delete_cost`
+    :rtype: int
+    """
 
-    stdout, _ = out.communicate()
-    return stdout.decode().split()
+    return get_storage().delete_cost(entries, config.WHICH_LIST == 'directories')
 
-def get_unmerged_files_hadoop():
+
+def run_deletions(groups, n_threads, pace, journal=None, progress=None, feedback=None):
     """
-    :returns: the old files' PFNs in the unmerged directory
-    :rtype: list
+    Runs :py:func:`delete_entries` on groups of entries using a pool of threads.
+    Outcomes are printed in the same order as the groups,
+    no matter which thread finishes first.
+    After a keyboard interrupt, the deletions in progress are allowed to finish,
+    but no new ones are started.
+
+    :param groups: gives tuples of the list of entries to pass to each
+                   :py:func:`delete_entries` call, the offset in the deletion file
+                   just after those entries, and the number of files and directories
+                   that they hold, like :py:func:`group_deletions`
+    :type groups: generator
+    :param int n_threads: is the number of groups deleted at the same time
+    :param function pace: is called by a thread before each group that it deletes,
+                          with the :py:func:`deletion_weight` of the group,
+                          to limit the rate of deletions
+    :param file journal: if given, the outcome of every entry is written here.
+                         After each group, a line ``@<offset>`` is also written
+                         if every group up to that offset has been attempted.
+    :param function progress: if given, is called with the offset and the outcomes
+                              of each group after it is logged
+    :param function feedback: if given, is called with the seconds that each group took
+                              to delete, the number of files and directories in it
+                              and its outcomes,
+                              like :py:meth:`AdaptiveRateLimiter.observe`, after it is logged
+    :returns: the number of entries with each outcome
+    :rtype: dict
     """
 
-    older_than_timestamp = int(time.time()) - config.MIN_AGE
-    hdfs_cmd = "hdfs dfs -ls -R {0} | grep -v '^d' | sed '1d;s/  */ /g' | cut -d\  -f6-8".format(
-        config.LFN_TO_CLEAN)
+    todo = Queue.Queue()
+    done = Queue.Queue()
+    stop = threading.Event()
+    counts = {}
+
+    def worker():
+        """Deletes groups from the queue until it gets None"""
+        for index, entries, offset, removed in iter(todo.get, None):
+            results = None
+            timing = None
+            if not stop.is_set():
+                weight = deletion_weight(entries)
+                pace(weight)
+                # An interrupt during the wait skips this group too
+                if not stop.is_set():
+                    start = time.time()
+                    try:
+                        results = delete_entries(entries)
+                    except Exception as err:   # pylint: disable=broad-except
+                        results = [(deleting, 'failed', str(err)) for deleting in entries]
+                    timing = (time.time() - start, removed)
+            done.put((index, entries, offset, results, timing))
+
+    threads = [threading.Thread(target=worker) for _ in xrange(n_threads)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    groups = iter(groups)
+    state = {'sent': 0, 'logged': 0, 'exhausted': False, 'committing': True}
+    finished = {}
+
+    def log_group(entries, offset, results, timing):
+        """Prints and journals the outcomes of one group"""
+        if results is None:
+            # Skipped after an interrupt, so nothing later can be committed
+            counts['skipped'] = counts.get('skipped', 0) + len(entries)
+            state['committing'] = False
+            return
+
+        for deleting, outcome, message in results:
+            counts[outcome] = counts.get(outcome, 0) + 1
+            print '%-8s %s%s' % (outcome, deleting, message and ': ' + message)
+            if journal:
+                journal.write('%s\t%s\n' % (outcome, deleting))
+
+        if journal:
+            # Groups out of the order of the deletion file have no offset to commit
+            if state['committing'] and offset is not None:
+                journal.write('@%i\n' % offset)
+            journal.flush()
+
+        if progress:
+            progress(offset, results)
+
+        if feedback:
+            feedback(timing[0], timing[1], results)
+
+    def log_finished():
+        """Feeds the threads and logs finished groups, in order, until all are done"""
+        while True:
+            while not (state['exhausted'] or stop.is_set()) and \
+                    state['sent'] - state['logged'] < 2 * n_threads:
+                try:
+                    entries, offset, removed = next(groups)
+                    todo.put((state['sent'], entries, offset, removed))
+                    state['sent'] += 1
+                except StopIteration:
+                    state['exhausted'] = True
+
+            if state['logged'] == state['sent']:
+                return
+
+            try:
+                index, entries, offset, results, timing = done.get(True, 1)
+            except Queue.Empty:
+                continue
 
-    print 'About to run:'
-    print hdfs_cmd
+            finished[index] = (entries, offset, results, timing)
+            while state['logged'] in finished:
+                log_group(*finished.pop(state['logged']))
+                state['logged'] += 1
 
-    out = subprocess.Popen(hdfs_cmd, shell=True, stdin=subprocess.PIPE,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    stdout, _ = out.communicate()
-    all_files = stdout.decode().split("\n")
-    unmerged_files = []
-    for file_line in all_files:
-        tmp_line = file_line.split()
-        if not tmp_line:
-            continue
-        file_date = "%s %s" % (tmp_line[0], tmp_line[1])
-        file_date = int(
-            time.mktime(
-                datetime.datetime.strptime(
-                    file_date, "%Y-%m-%d %H:%M").timetuple()))
+    try:
+        try:
+            log_finished()
+        except KeyboardInterrupt:
+            stop.set()
+            print 'Interrupted. Waiting for the deletions in progress to finish...'
+            log_finished()
 
-        if file_date < older_than_timestamp:
-            unmerged_files.append(file_line[2])
-    return unmerged_files
+    finally:
+        stop.set()
+        for _ in threads:
+            todo.put(None)
 
+    return counts
 
-def filter_protected(unmerged_files, protected):
-    """
-    Lists unprotected files
 
-    :param list unmerged_files: the list of files to check and delete, if unprotected.
-    :param list protected: the list of protected LFNs.
-    :raises SuspiciousConditions: If the beginning of the file name does not match the
-                                  configured location of ``/store/unmerged``
-                                  or if there is a partial match with a protected LFN
+# The columns of the metadata file of a deletion file. The PFN is always last.
+DELETION_COLUMNS = ['size', 'files', 'dirs', 'latest', 'pfn']
+
+DeletionEntry = namedtuple('DeletionEntry', DELETION_COLUMNS)
+"""
+One line of the deletion file, as read by :py:func:`iter_deletion_entries`.
+The **size**, number of **files** and **dirs** below, and **latest** modification time
+are ``None`` for deletion files without metadata.
+"""
+
+
+def format_deletion_header():
+    """
+    :returns: the first line of the metadata file of a deletion file
+    :rtype: str
     """
 
-    print 'Got %i deletion candidates' % len(unmerged_files)
-    print 'Have %i protected dirs' % len(protected)
-    print 'Have %i avoided dirs' % len(config.DIRS_TO_AVOID)
-    n_protect = 0
-    n_delete = 0
-    output = []
+    return '# %s\n' % '\t'.join(DELETION_COLUMNS)
 
-    for unmerged_file in unmerged_files:
-        protect = False
 
-        if not unmerged_file.startswith(config.UNMERGED_DIR_LOCATION):
-            raise SuspiciousConditions(
-                '\nFile %s\nis not in your configured unmerged location:\n%s' %
-                (unmerged_file, config.UNMERGED_DIR_LOCATION))
+def format_deletion_entry(pfn, size, files, dirs, latest):
+    """
+    :param str pfn: is the directory or file to delete
+    :param int size: is the number of bytes freed by deleting it
+    :param int files: is the number of files deleted along with it
+    :param int dirs: is the number of directories below it
+    :param float latest: is the latest modification time inside of it
+    :returns: the line of the metadata file for the entry
+    :rtype: str
+    """
 
-        for lfn in protected:
-            pfn = lfn_to_pfn(lfn)
-            if pfn in unmerged_file:
-                protect = True
-                break
-            elif lfn in unmerged_file:
-                raise SuspiciousConditions(
-                    '\nFile %s\nhas partial match to LFN %s,\n'
-                    'but LFN mapped to %s\nCheck your configuration file' %
-                    (unmerged_file, lfn, pfn))
+    return '%i\t%i\t%i\t%i\t%s\n' % (size, files, dirs, int(latest or 0), pfn)
 
 
-        for root_dir in config.DIRS_TO_AVOID:
-            pfn = os.path.join(config.UNMERGED_DIR_LOCATION, root_dir)
-            if pfn in unmerged_file:
-                protect = True
-                break
+def write_deletion_entries(file_name, entries, run_id=None):
+    """
+    Writes a deletion file with one PFN on each line, so that other tools can read it,
+    and the metadata of each entry to ``<file_name>.meta``.
+    Both files are replaced in one step, the metadata first,
+    so a deletion never reads half a file.
+
+    :param str file_name: is the deletion file to write
+    :param entries: gives a DeletionEntry for each line
+    :type entries: iterable
+    :param str run_id: if given, is written to the metadata file for :py:func:`read_run_id`
+    """
 
-        if not protect:
-            output.append(unmerged_file)
-            n_delete += 1
-        else:
-            n_protect += 1
+    metadata_name = file_name + '.meta'
 
-    with open(config.DELETION_FILE, 'w') as deletions:
-        deletions.write('\n'.join(output))
+    with open(file_name + '.tmp', 'w') as del_file:
+        with open(metadata_name + '.tmp', 'w') as meta_file:
+            meta_file.write(format_deletion_header())
+            if run_id is not None:
+                meta_file.write('# run %s\n' % run_id)
+            for entry in entries:
+                del_file.write(entry.pfn + '\n')
+                meta_file.write(format_deletion_entry(entry.pfn, entry.size, entry.files,
+                                                      entry.dirs, entry.latest))
 
-    print 'Number to delete: %i,\nNumber protected/avoided: %i' % (n_delete, n_protect)
+    os.rename(metadata_name + '.tmp', metadata_name)
+    os.rename(file_name + '.tmp', file_name)
 
 
-def main():
+def read_run_id(file_name):
     """
-    Does the full listing for the site given in the :file:`config.py` file.
+    :param str file_name: is the name of a deletion file
+    :returns: the ID of the scan that wrote the deletion file,
+              or ``None`` if it was not written with one
+    :rtype: str
     """
 
-    # Perform some checks of configuration file
-    if not config.UNMERGED_DIR_LOCATION.endswith('/store/unmerged'):
-        raise SuspiciousConditions(
-            '\n\'/store/unmerged\' not at the end of your PFN path: %s\n'
-            'This tool replaces the \'/store/unmerged\' part of the LFN with your PFN path.\n'
-            '(So it will expect \'/store/unmerged/protected/dir\' at \'%s\')\n'
-            'If that is intended, please modify the beginning of this script\'s main() function.'
-            % (config.UNMERGED_DIR_LOCATION, lfn_to_pfn('/store/unmerged/protected/dir')))
-
-    # Expect protected LFN list from Unified
-    if not PROTECTED_LIST:
-        raise SuspiciousConditions(
-            '\nNo directories are protected.\n'
-            'Check https://cmst2.web.cern.ch/cmst2/unified/listProtectedLFN.txt')
+    metadata_name = file_name + '.meta'
+    if not os.path.isfile(metadata_name):
+        return None
 
-    # Start checks
-    if config.WHICH_LIST == 'files':
-        unmerged_files = get_unmerged_files_hadoop() \
-            if config.STORAGE_TYPE == 'hadoop' else \
-            get_unmerged_files()
+    with open(metadata_name, 'r') as meta_file:
+        for line in iter(meta_file.readline, ''):
+            if not line.startswith('#'):
+                break
+            if line.startswith('# run '):
+                return line[len('# run '):].rstrip('\n')
 
-        filter_protected(unmerged_files, PROTECTED_LIST)
+    return None
 
-    elif config.WHICH_LIST == 'directories':
-        for directory in PROTECTED_LIST:
-            parent = os.path.dirname(directory)
-            while parent and parent != '/':
-                PROTECTED_UPPER_DIRS.add(parent)
-                parent = os.path.dirname(parent)
+
+def iter_deletion_entries(deletions, start=0, metadata=None):
+    """
+    Reads the deletion file one line at a time.
+    Each line is a PFN, and the rest of the entry is read from the same line of the metadata file,
+    which starts with a line from :py:func:`format_deletion_header`
+    and has tab-separated columns, with the PFN last so that it may hold tabs.
+    If the metadata file is missing or does not match the deletion file, only PFNs are given.
+    Empty lines and lines starting with ``#`` are skipped.
+    If an entry does not look like it is in an unmerged directory, the script exits.
+
+    :param file deletions: is the open deletion file
+    :param int start: is the offset in the file to start reading from
+    :param str metadata: is the name of the metadata file, usually ``<deletion file>.meta``
+    :returns: tuples of a DeletionEntry and the offset just after it
+    :rtype: generator
+    """
+
+    def parse(line):
+        """Reads an entry from a line of the metadata file"""
+        values = dict(zip(columns, line.rstrip('\n').split('\t', len(columns) - 1)))
+        return DeletionEntry(*([values.get(column) and int(values[column])
+                                for column in DELETION_COLUMNS[:-1]] + [values.get('pfn')]))
+
+    meta_file = None
+    if metadata and os.path.isfile(metadata):
+        meta_file = open(metadata, 'r')
+        header = meta_file.readline()
+        if header.startswith('#'):
+            columns = header[1:].split()
+        else:
+            meta_file.close()
+            meta_file = None
+
+    # The metadata of the lines before the start has to be read too
+    offset = 0 if meta_file else start
+    deletions.seek(offset)
+
+    try:
+        # Not iterating over the file, which reads ahead and hides the offset
+        for deleted in iter(deletions.readline, ''):
+            offset += len(deleted)
+            line = deleted.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+
+            if meta_file:
+                meta_line = meta_file.readline()
+                while meta_line.startswith('#'):
+                    meta_line = meta_file.readline()
+                try:
+                    entry = parse(meta_line)
+                except ValueError:
+                    entry = None
+                if entry is None or entry.pfn != line:
+                    print '%s does not match the deletion file. Ignoring it.' % metadata
+                    meta_file.close()
+                    meta_file = None
+                    entry = DeletionEntry(None, None, None, None, line)
+            else:
+                entry = DeletionEntry(None, None, None, None, line)
+
+            if offset <= start:
+                continue
+
+            # Do a check of the directory names. End process if something is wrong.
+            if '/unmerged/' not in entry.pfn:
+                print 'Something is either wrong with your deletions file or'
+                print 'ListDetetable.do_delete().'
+                print 'Your deletions file is at', config.DELETION_FILE
+                print 'Refusing to continue.'
+                exit()
+
+            yield entry, offset
+
+    finally:
+        if meta_file:
+            meta_file.close()
+
+
+def group_deletions(entries):
+    """
+    Groups entries of the deletion file for :py:func:`delete_entries`.
+    Files are grouped with the files next to them in the same directory.
+    Each group also counts the files and directories that deleting it removes,
+    from the metadata of the deletion file, so that the latency of one removal is known.
+
+    :param entries: gives tuples of a DeletionEntry and the offset in the deletion file
+                    just after it, like :py:func:`iter_deletion_entries`
+    :type entries: generator
+    :returns: tuples of a list of PFNs, the offset just after them,
+              and the number of files and directories they hold
+    :rtype: generator
+    """
+
+    recursive = config.WHICH_LIST == 'directories'
+    batch_size = get_storage().delete_group_size(recursive)
+    # Files in the same directory are removed together
+    by_parent = not recursive
+
+    batch = []
+    offset = None
+    removed = 0
+
+    for entry, next_offset in entries:
+        if by_parent and batch and \
+                os.path.dirname(entry.pfn) != os.path.dirname(batch[0]):
+            yield batch, offset, removed
+            batch = []
+            removed = 0
+
+        batch.append(entry.pfn)
+        offset = next_offset
+        removed += (entry.files or 0) + (entry.dirs or 0) + 1
+        if len(batch) >= batch_size:
+            yield batch, offset, removed
+            batch = []
+            removed = 0
+
+    if batch:
+        yield batch, offset, removed
+
+
+def iter_deletion_groups(deletions, start=0):
+    """
+    Reads the deletion file one line at a time,
+    checks the entries and groups them for :py:func:`delete_entries`.
+
+    :param file deletions: is the open deletion file
+    :param int start: is the offset in the file to start reading from
+    :returns: the groups from :py:func:`group_deletions`
+    :rtype: generator
+    """
+
+    return group_deletions(iter_deletion_entries(deletions, start))
+
+
+def deletion_score(entry):
+    """
+    :param DeletionEntry entry: is an entry of the deletion file
+    :returns: the bytes freed for each storage operation needed to delete the entry.
+              A directory takes one operation for itself and for each file and directory below.
+    :rtype: float
+    """
+
+    if entry.size is None:
+        return 0.0
+
+    return float(entry.size) / ((entry.files or 0) + (entry.dirs or 0) + 1)
+
+
+def iter_prioritized(entries, freed, target_bytes=None, time_budget=None):
+    """
+    Gives the entries of the deletion file in order of :py:func:`deletion_score`,
+    so that the most space is freed first.
+    No more entries are given after *target_bytes* are freed or *time_budget* runs out.
+    The deletions already in progress at that time still finish.
+
+    :param list entries: is tuples of a DeletionEntry and its offset
+    :param dict freed: has the number of bytes deleted so far under ``'bytes'``,
+                       which is updated while deleting
+    :param int target_bytes: is the number of bytes to free
+    :param float time_budget: is the number of seconds to keep giving entries
+    :returns: tuples of a DeletionEntry and ``None``, since the order of
+              the deletion file is not kept
+    :rtype: generator
+    """
+
+    start = time.time()
+    for entry, _ in sorted(entries, key=lambda pair: deletion_score(pair[0]), reverse=True):
+        if target_bytes and freed['bytes'] >= target_bytes:
+            return
+        if time_budget and time.time() - start >= time_budget:
+            return
+
+        yield entry, None
+
+
+def parse_bytes(text):
+    """
+    :param str text: is a number of bytes, possibly ending with
+                     ``K``, ``M``, ``G``, ``T`` or ``P`` for powers of 1024
+    :returns: the number of bytes, or ``None`` if *text* is empty
+    :rtype: int
+    :raises ValueError: if *text* is not a number
+    """
+
+    if not text:
+        return None
+
+    text = text.strip().upper().rstrip('B')
+    if not text:
+        raise ValueError('no number of bytes given')
+
+    power = 'KMGTP'.find(text[-1]) + 1
+    if power:
+        text = text[:-1]
+
+    return int(float(text) * 1024 ** power)
+
+
+def journal_header(file_name):
+    """
+    :param str file_name: is the name of the deletion file
+    :returns: the first line of a journal for this deletion file.
+              It changes if the deletion file is rewritten.
+    :rtype: str
+    """
+
+    stats = os.stat(file_name)
+    return '# %s %i %i\n' % (file_name, stats.st_size, int(stats.st_mtime))
+
+
+def read_journal(journal_name):
+    """
+    Reads a journal written by :py:func:`run_deletions`, one line at a time.
+
+    :param str journal_name: is the name of the journal file
+    :returns: the header of the journal and the last committed offset in the deletion file
+    :rtype: tuple
+    """
+
+    committed = 0
+    with open(journal_name, 'r') as journal:
+        header = journal.readline()
+        for line in journal:
+            if line.startswith('@'):
+                committed = int(line[1:])
+
+    return header, committed
+
+
+def do_delete(resume=False, target_bytes=None, time_budget=None):
+    """
+    Does the deletion for a site based on the deletion file contents.
+    If the deletion file does not exist a message is printed to the user
+    and the script exits.
+
+    Deletions are done by **DELETE_THREADS** threads at the same time.
+    If **DELETE_RATE** is set, no more than that many deletions start each second.
+    Otherwise, each thread sleeps for **SLEEP_TIME** before each deletion.
+    If **DELETE_LATENCY_TARGET** is set, the rate starts there instead and is then changed
+    by an :py:class:`AdaptiveRateLimiter`, to keep each deletion under that many seconds
+    and the fraction of failed deletions under **DELETE_ERROR_TARGET**.
+    The outcome of each entry is printed in the order of the deletion file.
+    Press Ctrl-C to stop after the deletions in progress.
+    The deletions are done by the backend from :py:func:`get_storage`.
+
+    The deletion file is read one line at a time, and the outcomes are also written
+    to a journal next to it, with the suffix ``.journal``.
+    The journal records how far into the deletion file every entry has been attempted,
+    so an interrupted run can be continued with ``ListDeletable.py --delete --resume``.
+
+    .. Warning::
+
+       **For Hadoop sites:**
+       Currently, we assume your Hadoop instance is mounted at `/mnt/hadoop`
+       and the checksums are located under `/mnt/hadoop/cksums`.
+       If this is not the case, the cksums will not be deleted.
+       Your LFN will still be properly propagated to delete
+       the unmerged files themselves.
+       Directories are passed to ``hdfs dfs -rm -r`` in groups of **HADOOP_BATCH_SIZE**,
+       and the pacing is applied once for each group.
+
+    To free space quickly, ``--target-bytes`` or ``--time-budget`` deletes the entries
+    that free the most bytes for each storage operation first, using the sizes written
+    to the deletion file by ``ListDeletable.py`` (see :py:func:`iter_prioritized`).
+    It stops once that much space is freed or the time is up.
+    Such a run cannot be resumed, but running it again skips what is already gone.
+
+    Progress lines are printed every **PROGRESS_INTERVAL** seconds,
+    counting the bytes of the deletion file that have been handled,
+    or the bytes freed for a prioritized run.
+
+    :param bool resume: if True, start after the last offset committed
+                        in the journal of a previous run. If there is no journal,
+                        the script exits instead of starting from the beginning.
+    :param int target_bytes: if given, stop after freeing this many bytes
+    :param float time_budget: if given, stop starting deletions after this many seconds
+    """
+
+    if not os.path.isfile(config.DELETION_FILE):
+        print 'Deletion file %s has not been created yet.' % config.DELETION_FILE
+        exit()
+
+    prioritized = bool(target_bytes or time_budget)
+    if prioritized and resume:
+        print 'A prioritized deletion cannot be resumed. Run it again without --resume.'
+        exit()
+
+    journal_name = config.DELETION_FILE + '.journal'
+    header = journal_header(config.DELETION_FILE)
+    start = 0
+
+    if resume and not os.path.isfile(journal_name):
+        print 'No journal %s was found to resume from.' % journal_name
+        print 'Run without --resume to start from the beginning of the deletion file.'
+        exit()
+
+    if resume:
+        journal_header_line, start = read_journal(journal_name)
+        if journal_header_line != header:
+            print 'The journal %s is for a different deletion file.' % journal_name
+            print 'The deletion file was changed since that run.'
+            print 'Refusing to resume.'
+            exit()
+
+        print 'Resuming after byte %i of %s' % (start, config.DELETION_FILE)
+        mode = 'a'
+    else:
+        mode = 'w'
+
+    limiter = None
+    if config.DELETE_LATENCY_TARGET:
+        limiter = AdaptiveRateLimiter(
+            config.DELETE_RATE or (1.0 / config.SLEEP_TIME if config.SLEEP_TIME else 1.0),
+            config.DELETE_LATENCY_TARGET, config.DELETE_ERROR_TARGET)
+        pace = limiter.wait
+        pacing = 'Deletions start at %.2f per second, and follow the latency of the storage.' % \
+            limiter.rate
+    elif config.DELETE_RATE:
+        pace = RateLimiter(config.DELETE_RATE).wait
+        pacing = 'Deletions are limited to %s per second.' % config.DELETE_RATE
+    else:
+        pace = lambda count: time.sleep(config.SLEEP_TIME * count)
+        pacing = 'Your sleep time is set to %s seconds.' % config.SLEEP_TIME
+
+    if config.WHICH_LIST != 'directories':
+        print '-' * 40
+        print 'Deleting individual files.'
+        print pacing
+        print 'To change it, edit your config.py.'
+        print '-' * 40
+
+    with open(journal_name, mode) as journal:
+        if mode == 'w':
+            journal.write(header)
+
+        with open(config.DELETION_FILE, 'r') as deletions:
+            entries = iter_deletion_entries(deletions, start, config.DELETION_FILE + '.meta')
+            freed = {'bytes': 0}
+
+            if prioritized:
+                entries = list(entries)
+                sizes = dict([(entry.pfn, entry.size) for entry, _ in entries])
+                if target_bytes and None in sizes.itervalues():
+                    print 'The deletion file %s has no sizes.' % config.DELETION_FILE
+                    print 'List the directories again to use --target-bytes.'
+                    exit()
+
+                progress = MetricsTools.Progress(
+                    'delete', target_bytes or sum([size or 0 for size in sizes.itervalues()]),
+                    'bytes freed', config.PROGRESS_INTERVAL)
+                entries = iter_prioritized(entries, freed, target_bytes, time_budget)
+
+            else:
+                progress = MetricsTools.Progress(
+                    'delete', os.path.getsize(config.DELETION_FILE) - start,
+                    'bytes of the deletion file', config.PROGRESS_INTERVAL)
+
+            def record(offset, results):
+                """Counts the bytes freed and reports the progress"""
+                if prioritized:
+                    for deleting, outcome, _ in results:
+                        if outcome == 'deleted':
+                            freed['bytes'] += sizes[deleting] or 0
+                    progress.update(freed['bytes'])
+                else:
+                    progress.update(offset - start)
+
+            with METRICS.phase('delete'):
+                counts = run_deletions(group_deletions(entries),
+                                       max(1, config.DELETE_THREADS), pace, journal, record,
+                                       limiter and limiter.observe)
+
+    print 'Summary: %s' % ', '.join(['%i %s' % (counts[outcome], outcome)
+                                     for outcome in sorted(counts)])
+    if prioritized:
+        print 'Freed %.3f GB' % (freed['bytes'] / 1024.0 ** 3)
+    if limiter and limiter.decisions:
+        rates = [rate for _, rate, _ in limiter.decisions]
+        print 'Deletion rate ended at %.2f per second, after %i changes between %.2f and %.2f' % \
+            (limiter.rate, len(rates), min(rates), max(rates))
+    write_metrics('delete')
+
+
+def iter_unmerged_files(chunk_size=1024 * 1024):
+    """
+    Runs ``find`` over the unmerged directory and yields file names as soon as they are printed.
+    File names are separated by null characters, so whitespace in names is kept.
+
+    :param int chunk_size: is the number of bytes read from ``find`` at a time
+    :returns: the old files' PFNs in the unmerged directory
+    :rtype: generator
+    """
+
+    find_cmd = 'find {0} -type f -not -newermt \'-{1} seconds\' -print0'.format(
+        config.UNMERGED_DIR_LOCATION, config.MIN_AGE)
+
+    print 'About to run:'
+    print find_cmd
+
+    out = subprocess.Popen(find_cmd, shell=True, stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+
+    remainder = ''
+    for chunk in iter(lambda: out.stdout.read(chunk_size), ''):
+        names = (remainder + chunk).split('\0')
+        remainder = names.pop()
+        for name in names:
+            yield name
+
+    if remainder:
+        yield remainder
+
+    if out.wait():
+        print 'Warning: find exited with status %i' % out.returncode
+
+
+def iter_old_files(n_threads, max_queued=1000):
+    """
+    Walks the unmerged directory with a pool of threads and yields files older than
+    **MIN_AGE**, without calling any external program.
+    The modification times come from the same listing that finds the files.
+    The avoided directories at the top level and protected directories are not listed at all.
+    Files inside them could never be deleted anyway.
+    Directories that vanish during the walk or cannot be read are skipped,
+    like ``find`` does. Any other listing error stops the walk and is raised.
+
+    :param int n_threads: is the number of threads listing directories at the same time
+    :param int max_queued: is the number of listed directories that can wait to be read
+                           before the threads pause
+    :returns: the old files' PFNs in the unmerged directory
+    :rtype: generator
+    """
+
+    cutoff = time.time() - config.MIN_AGE
+    avoided = set(os.path.join(config.UNMERGED_DIR_LOCATION, root_dir).rstrip('/')
+                  for root_dir in config.DIRS_TO_AVOID)
+    protected = ProtectedTrie(PROTECTED_LIST)
+
+    results = Queue.Queue(max_queued)
+    stop = threading.Event()
+    closed = threading.Event()
+    errors = []
+
+    def put(result):
+        """Passes a result to the generator, unless it has stopped reading"""
+        while not closed.is_set():
+            try:
+                results.put(result, True, 1)
+                return
+            except Queue.Full:
+                pass
+
+    def expand(path_name):
+        """Lists one directory and returns the subdirectories to walk"""
+        full_path_name = os.path.join(config.UNMERGED_DIR_LOCATION, path_name)
+        subdirs = []
+        old_files = []
+
+        try:
+            entries = list_entries(full_path_name)
+        except (IOError, OSError) as err:
+            if err.errno == errno.ENOENT:
+                return []
+            if err.errno == errno.EACCES:
+                print 'Cannot list %s: %s' % (full_path_name, err)
+                return []
+            raise
+
+        for entry in entries:
+            if entry.is_dir:
+                sub_path = os.path.join(path_name, entry.name)
+                if os.path.join(config.UNMERGED_DIR_LOCATION, sub_path) not in avoided and \
+                        not protected.is_under(os.path.join(config.LFN_TO_CLEAN, sub_path)):
+                    subdirs.append(sub_path)
+
+            elif entry.mtime <= cutoff:
+                old_files.append(os.path.join(full_path_name, entry.name))
+
+        if old_files:
+            put(old_files)
+
+        return subdirs
+
+    def walk():
+        """Runs the walk and marks the end of the results"""
+        try:
+            parallel_walk([''], expand, n_threads, stop)
+        except Exception as err:   # pylint: disable=broad-except
+            errors.append(err)
+        # Also sent after an error, which stops the walk but not the reader
+        put(None)
+
+    walker = threading.Thread(target=walk)
+    walker.daemon = True
+    walker.start()
+
+    try:
+        for old_files in iter(results.get, None):
+            for old_file in old_files:
+                yield old_file
+    finally:
+        closed.set()
+        stop.set()
+
+    if errors:
+        raise errors[0]
+
+
+def iter_dump_files():
+    """
+    :returns: the PFNs of files older than **MIN_AGE** in the loaded namespace dump
+    :rtype: generator
+    """
+
+    cutoff = NOW - config.MIN_AGE
+    for path, _, mtime in NAMESPACE.iter_files():
+        if mtime <= cutoff:
+            yield os.path.join(config.UNMERGED_DIR_LOCATION, path)
+
+
+def get_unmerged_files():
+    """
+    :returns: the old files' PFNs in the unmerged directory
+    :rtype: list
+    """
+
+    return list(iter_unmerged_files())
+
+
+def iter_unmerged_files_hadoop():
+    """
+    Runs ``hdfs dfs -ls -R`` over the unmerged directory and yields old files
+    as soon as they are listed.
+
+    :returns: the old files' PFNs in the unmerged directory
+    :rtype: generator
+    """
+
+    older_than_timestamp = int(time.time()) - config.MIN_AGE
+    hdfs_cmd = "hdfs dfs -ls -R {0} | grep -v '^d' | sed '1d;s/  */ /g' | cut -d\  -f6-".format(
+        config.LFN_TO_CLEAN)
+
+    print 'About to run:'
+    print hdfs_cmd
+
+    out = subprocess.Popen(hdfs_cmd, shell=True, stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+
+    for file_line in iter(out.stdout.readline, ''):
+        tmp_line = file_line.rstrip('\n').split(' ', 2)
+        if len(tmp_line) < 3:
+            continue
+        file_date = "%s %s" % (tmp_line[0], tmp_line[1])
+        file_date = int(
+            time.mktime(
+                datetime.datetime.strptime(
+                    file_date, "%Y-%m-%d %H:%M").timetuple()))
+
+        if file_date < older_than_timestamp:
+            yield lfn_to_pfn(tmp_line[2])
+
+    out.wait()
+
+
+def get_unmerged_files_hadoop():
+    """
+    :returns: the old files' PFNs in the unmerged directory
+    :rtype: list
+    """
+
+    return list(iter_unmerged_files_hadoop())
+
+
+def filter_protected(unmerged_files, protected, buffer_size=1024 * 1024):
+    """
+    Lists unprotected files.
+    The files are read and written one at a time, so *unmerged_files* can be a generator
+    of any length without filling the memory.
+    While running, results are written to the deletion file name with ``.tmp`` appended.
+    That file is moved to the deletion file only after every file is checked.
+
+    :param unmerged_files: the files to check and delete, if unprotected.
+    :type unmerged_files: list or generator
+    :param list protected: the list of protected LFNs.
+    :param int buffer_size: the number of bytes to buffer before writing to the deletion file
+    :raises SuspiciousConditions: If the beginning of the file name does not match the
+                                  configured location of ``/store/unmerged``
+                                  or if there is a partial match with a protected LFN
+    """
+
+    print 'Have %i protected dirs' % len(protected)
+    print 'Have %i avoided dirs' % len(config.DIRS_TO_AVOID)
+    n_protect = 0
+    n_delete = 0
+
+    # Look for all of the protected and avoided paths in a single pass over each file name.
+    # Protected LFNs are labeled by their position in the list to keep the order of checks.
+    matcher = PatternMatcher()
+    for index, lfn in enumerate(protected):
+        matcher.add(lfn_to_pfn(lfn), (True, index))
+        matcher.add(lfn, (False, index))
+
+    for root_dir in config.DIRS_TO_AVOID:
+        matcher.add(os.path.join(config.UNMERGED_DIR_LOCATION, root_dir), (True, len(protected)))
+
+    deletion_dir = os.path.dirname(config.DELETION_FILE)
+    if deletion_dir and not os.path.exists(deletion_dir):
+        os.makedirs(deletion_dir)
+
+    partial_file = config.DELETION_FILE + '.tmp'
+    output = open(partial_file, 'w', buffer_size)
+    finished = False
+
+    # Left by listing directories, and no longer matching
+    if os.path.exists(config.DELETION_FILE + '.meta'):
+        os.remove(config.DELETION_FILE + '.meta')
+
+    try:
+        for unmerged_file in unmerged_files:
+            if check_unmerged_file(unmerged_file, matcher, protected):
+                output.write(unmerged_file + '\n')
+                n_delete += 1
+            else:
+                n_protect += 1
+
+        finished = True
+
+    finally:
+        output.close()
+        if finished:
+            os.rename(partial_file, config.DELETION_FILE)
+        else:
+            os.remove(partial_file)
+
+    print 'Got %i deletion candidates' % (n_delete + n_protect)
+    print 'Number to delete: %i,\nNumber protected/avoided: %i' % (n_delete, n_protect)
+
+
+def check_unmerged_file(unmerged_file, matcher, protected):
+    """
+    Checks if a single file can be deleted.
+
+    :param str unmerged_file: is the PFN of the file
+    :param PatternMatcher matcher: holds the protected and avoided PFNs and the protected LFNs,
+                                   as built by :py:func:`filter_protected`
+    :param list protected: the list of protected LFNs.
+    :returns: whether or not the file can be deleted
+    :rtype: bool
+    :raises SuspiciousConditions: for the same reasons as :py:func:`filter_protected`
+    """
+
+    if not unmerged_file.startswith(config.UNMERGED_DIR_LOCATION):
+        raise SuspiciousConditions(
+            '\nFile %s\nis not in your configured unmerged location:\n%s' %
+            (unmerged_file, config.UNMERGED_DIR_LOCATION))
+
+    pfn_matches = set()
+    lfn_matches = set()
+    for is_pfn, index in matcher.find(unmerged_file):
+        (pfn_matches if is_pfn else lfn_matches).add(index)
+
+    # The first protected LFN whose PFN matches the file protects it, but if
+    # an earlier LFN matches without its PFN, the configuration is likely wrong
+    protect = min(pfn_matches) if pfn_matches else None
+    partial = [index for index in lfn_matches
+               if index not in pfn_matches and (protect is None or index < protect)]
+
+    if partial:
+        lfn = protected[min(partial)]
+        raise SuspiciousConditions(
+            '\nFile %s\nhas partial match to LFN %s,\n'
+            'but LFN mapped to %s\nCheck your configuration file' %
+            (unmerged_file, lfn, lfn_to_pfn(lfn)))
+
+    return protect is None
+
+
+def check_conditions():
+    """
+    Checks the configuration and the protected LFNs before anything is listed.
+
+    :raises SuspiciousConditions: if the unmerged directory does not look right,
+                                  or nothing is protected
+    """
+
+    # Perform some checks of configuration file
+    if not config.UNMERGED_DIR_LOCATION.endswith('/store/unmerged'):
+        raise SuspiciousConditions(
+            '\n\'/store/unmerged\' not at the end of your PFN path: %s\n'
+            'This tool replaces the \'/store/unmerged\' part of the LFN with your PFN path.\n'
+            '(So it will expect \'/store/unmerged/protected/dir\' at \'%s\')\n'
+            'If that is intended, please modify this script\'s check_conditions() function.'
+            % (config.UNMERGED_DIR_LOCATION, lfn_to_pfn('/store/unmerged/protected/dir')))
+
+    # Expect protected LFN list from Unified
+    if not PROTECTED_LIST:
+        raise SuspiciousConditions(
+            '\nNo directories are protected.\n'
+            'Check https://cmst2.web.cern.ch/cmst2/unified/listProtectedLFN.txt')
+
+
+def add_sizes(dirs_to_delete):
+    """
+    Lists the deletable directories again to get their sizes,
+    which are not added up while listing when **SCAN_MODE** is ``'decision'``.
+
+    :param list dirs_to_delete: is the deletable :py:class:`DataNode` or
+                                :py:class:`DeletableDir` objects
+    :returns: the same directories, with their sizes
+    :rtype: list
+    """
+
+    output = []
+    for item in dirs_to_delete:
+        size = 0
+        stack = [os.path.join(config.UNMERGED_DIR_LOCATION, item.path_name)]
+        while stack:
+            path = stack.pop()
+            try:
+                entries = list_entries(path)
+            except OSError:
+                # Gone since the listing
+                continue
+            for entry in entries:
+                if entry.is_dir:
+                    stack.append(os.path.join(path, entry.name))
+                else:
+                    size += entry.size
+
+        if isinstance(item, DeletableDir):
+            item = item._replace(size=size)
+        else:
+            item.size = size
+        output.append(item)
+
+    return output
+
+
+def write_deletion_file(file_name, dirs_to_delete, run_id=None):
+    """
+    Writes deletable directories to a deletion file, with their sizes in its metadata file.
+    The files are replaced by :py:func:`write_deletion_entries`, so a finished shard is only seen by
+    :py:func:`merge_shards` once it is complete.
+
+    :param str file_name: is the deletion file to write
+    :param list dirs_to_delete: is the deletable :py:class:`DataNode` or
+                                :py:class:`DeletableDir` objects
+    :param str run_id: is the ID of the scan, for the partial files of shards
+    """
+
+    deletion_dir = os.path.dirname(file_name)
+    if deletion_dir and not os.path.exists(deletion_dir):
+        os.makedirs(deletion_dir)
+
+    write_deletion_entries(file_name, (
+        DeletionEntry(item.size, item.nsubfiles, item.nsubnodes, item.latest,
+                      os.path.join(config.UNMERGED_DIR_LOCATION, item.path_name))
+        for item in dirs_to_delete), run_id)
+
+
+class WatchedTree(object):
+    """
+    Holds the :py:class:`DataNode` trees of the whole unmerged directory in memory
+    and keeps them up to date with the :ref:`unmerged-watch-ref-ref`.
+    Every listed directory is watched. When a directory changes, only that directory is listed
+    again, new subdirectories are listed fully, and the directories above it are aggregated again.
+    """
+
+    # Events are collected for this many seconds, so a busy directory is listed once for all of them
+    SETTLE_SECONDS = 1.0
+
+    def __init__(self, inotify):
+        """
+        Initializes an empty tree.
+        :param WatchTools.Inotify inotify: is the instance holding the watches
+        """
+        self.inotify = inotify
+        self.tops = {}
+        self.nodes = {}
+        self.watches = {}
+        self.wds = {}
+        self.out_of_watches = False
+
+    def watch(self, path_name):
+        """
+        Starts watching a directory.
+        If there are no watches left, a warning is printed once,
+        and changes below unwatched directories are only found by the next :py:meth:`scan`.
+
+        :param str path_name: is the directory, relative to the unmerged directory
+        """
+
+        if self.out_of_watches:
+            return
+
+        try:
+            wd = self.inotify.add_watch(os.path.join(config.UNMERGED_DIR_LOCATION, path_name))
+        except OSError as err:
+            if err.errno == errno.ENOSPC:
+                print 'Ran out of inotify watches. Raise fs.inotify.max_user_watches.'
+                print 'Until then, some changes are only seen by the periodic rescan.'
+                self.out_of_watches = True
+            # Otherwise, the directory is gone, and its parent will be listed again
+            return
+
+        self.watches[wd] = path_name
+        self.wds[path_name] = wd
+
+    def unwatch(self, path_name):
+        """
+        :param str path_name: is a directory to stop watching
+        """
+
+        wd = self.wds.pop(path_name, None)
+        if wd is not None:
+            del self.watches[wd]
+            self.inotify.remove_watch(wd)
+
+    def forget(self, wd):
+        """
+        Drops a watch that the kernel removed, because its directory is gone.
+
+        :param int wd: is the watch descriptor
+        """
+
+        path_name = self.watches.pop(wd, None)
+        if path_name is not None and self.wds.get(path_name) == wd:
+            del self.wds[path_name]
+
+    def add_tree(self, node):
+        """
+        Lists a new DataNode and everything below it, watching each directory
+        before it is listed so that no change is missed.
+        A directory that is gone before it is listed is dropped,
+        and removed from its parent when the parent is listed again.
+
+        :param DataNode node: is the new node
+        """
+
+        stack = [node]
+        while stack:
+            next_node = stack.pop()
+            self.nodes[next_node.path_name] = next_node
+            self.watch(next_node.path_name)
+            try:
+                stack.extend(next_node.list_contents())
+            except OSError:
+                self.nodes.pop(next_node.path_name, None)
+                self.unwatch(next_node.path_name)
+                continue
+            if next_node.protected:
+                self.unwatch(next_node.path_name)
+
+        node.aggregate_tree()
+
+    def remove_tree(self, node):
+        """
+        :param DataNode node: is a node to drop, along with everything below it
+        """
+
+        stack = [node]
+        while stack:
+            next_node = stack.pop()
+            self.nodes.pop(next_node.path_name, None)
+            self.unwatch(next_node.path_name)
+            stack.extend(next_node.sub_nodes)
+
+    def replace_tree(self, node):
+        """
+        Lists a directory and everything below it again, in place of its old tree.
+
+        :param DataNode node: is the node to replace
+        """
+
+        self.remove_tree(node)
+        fresh = DataNode(node.path_name)
+        self.add_tree(fresh)
+
+        parent = self.nodes.get(os.path.dirname(node.path_name))
+        if parent is None:
+            self.tops[node.path_name] = fresh
+        else:
+            parent.sub_nodes[parent.sub_nodes.index(node)] = fresh
+
+    def scan(self):
+        """
+        Lists everything again, replacing the trees and watches.
+        """
+
+        for node in self.tops.values():
+            self.remove_tree(node)
+        self.unwatch('')
+        self.tops = {}
+        self.out_of_watches = False
+
+        self.watch('')
+        self.relist('')
+
+    def relist(self, path_name):
+        """
+        Lists one directory again, after it changed.
+        Subdirectories that are still there keep their trees.
+
+        :param str path_name: is the directory, relative to the unmerged directory,
+                              or an empty string for the unmerged directory itself
+        """
+
+        if not path_name:
+            names = set([subdir for subdir in
+                         list_folder(config.UNMERGED_DIR_LOCATION, 'subdirs')
+                         if subdir not in config.DIRS_TO_AVOID])
+            for name in set(self.tops) - names:
+                self.remove_tree(self.tops.pop(name))
+            for name in sorted(names - set(self.tops)):
+                self.tops[name] = DataNode(name)
+                self.add_tree(self.tops[name])
+            return
+
+        node = self.nodes.get(path_name)
+        if node is None or node.protected:
+            # Removed along with its parent, or not listed at all
+            return
+
+        fresh = DataNode(path_name)
+        try:
+            listed = fresh.list_contents()
+        except OSError:
+            # The directory is gone, and its parent will be listed again
+            return
+
+        old_subs = dict([(sub_node.path_name, sub_node) for sub_node in node.sub_nodes])
+        node.sub_nodes = []
+        for sub_node in listed:
+            if sub_node.path_name in old_subs:
+                node.sub_nodes.append(old_subs.pop(sub_node.path_name))
+            else:
+                self.add_tree(sub_node)
+                node.sub_nodes.append(sub_node)
+
+        for sub_node in old_subs.itervalues():
+            self.remove_tree(sub_node)
+
+        node.mtime = fresh.mtime
+        node.nfiles = fresh.nfiles
+        node.files_size = fresh.files_size
+        node.files_latest = fresh.files_latest
+
+        while path_name:
+            node = self.nodes.get(path_name)
+            if node is not None:
+                node.aggregate()
+            path_name = os.path.dirname(path_name)
+
+    def update(self, timeout):
+        """
+        Waits for changes, and lists each changed directory again once.
+
+        :param float timeout: is the most seconds to wait for the first change
+        :returns: True if events were lost and everything needs to be scanned again
+        :rtype: bool
+        """
+
+        events = self.inotify.read(timeout)
+        if not events:
+            return False
+
+        deadline = time.time() + self.SETTLE_SECONDS
+        while time.time() < deadline:
+            events.extend(self.inotify.read(max(0, deadline - time.time())))
+
+        changed = set()
+        for event in events:
+            if event.mask & WatchTools.IN_Q_OVERFLOW:
+                return True
+            if event.mask & WatchTools.IN_IGNORED:
+                self.forget(event.wd)
+            elif event.wd in self.watches:
+                changed.add(self.watches[event.wd])
+
+        # Parents first, so that removed directories are not listed
+        for path_name in sorted(changed, key=lambda name: name.count('/') + 1 if name else 0):
+            self.relist(path_name)
+
+        return False
+
+    def update_protection(self):
+        """
+        Checks every directory against :py:data:`PROTECTED_INDEX` again,
+        after the protected LFNs changed.
+        Newly protected directories are dropped, and no longer protected ones are listed.
+        """
+
+        for path_name, node in self.nodes.items():
+            if self.nodes.get(path_name) is not node:
+                # Dropped with a newly protected directory above it
+                continue
+
+            protection = PROTECTED_INDEX.lookup(os.path.join(config.LFN_TO_CLEAN, path_name))
+            node.holds_protected = protection == ProtectedTrie.HOLDS_PROTECTED
+
+            if protection == ProtectedTrie.PROTECTED and not node.protected:
+                for sub_node in node.sub_nodes:
+                    self.remove_tree(sub_node)
+                self.unwatch(path_name)
+                node.protected = True
+                node.sub_nodes = []
+                node.nfiles = node.files_size = node.files_latest = 0
+
+            elif node.protected and protection != ProtectedTrie.PROTECTED:
+                node.protected = False
+                self.watch(path_name)
+                try:
+                    sub_nodes = node.list_contents()
+                except OSError:
+                    # The directory is gone, and its parent will be listed again
+                    continue
+                for sub_node in sub_nodes:
+                    self.add_tree(sub_node)
+
+    def deletions(self):
+        """
+        Aggregates the trees again at the current time,
+        since directories get old enough to delete without changing.
+        Inotify does not see writes made by other nodes of a network file system,
+        so each deletable directory is checked with :py:meth:`changed`,
+        and dropped if it changed.
+
+        :returns: the deletable directories
+        :rtype: list of DataNode
+        """
+
+        global NOW  # pylint: disable=global-statement
+        NOW = int(time.time())
+
+        list_to_del = []
+        for name in sorted(self.tops):
+            self.tops[name].aggregate_tree()
+            self.tops[name].traverse_tree(list_to_del)
+
+        checked = []
+        for node in list_to_del:
+            try:
+                changed = self.changed(node)
+            except OSError:
+                # Already gone
+                continue
+            if changed:
+                print 'Not deleting %s, which changed without an event' % node.path_name
+                self.replace_tree(node)
+            else:
+                checked.append(node)
+
+        return checked
+
+    def changed(self, node):
+        """
+        Lists a deletable directory again, without going into its subdirectories.
+        Only the files directly inside are stat-ed, and only until one is too new,
+        so a change deeper in the tree is only found by the next full listing.
+
+        :param DataNode node: is the directory to check
+        :returns: True if a file is too new or a subdirectory is new
+        :rtype: bool
+        :raises OSError: if the directory is gone
+        """
+
+        full_path_name = os.path.join(config.UNMERGED_DIR_LOCATION, node.path_name)
+        newer_than = NOW - config.MIN_AGE
+
+        entries = list_entries(full_path_name, newer_than)
+        if not entries:
+            return get_mtime(full_path_name) > newer_than
+
+        subdirs = set([os.path.basename(sub_node.path_name) for sub_node in node.sub_nodes])
+        for entry in entries:
+            if entry.is_dir:
+                if entry.name not in subdirs:
+                    return True
+            elif entry.mtime is None or entry.mtime > newer_than:
+                return True
+
+        return False
+
+
+def run_daemon():
+    """
+    Lists the unmerged directory once, then keeps the listing up to date with a
+    :py:class:`WatchedTree` until killed.
+    The deletion file is written after the first listing,
+    every **DAEMON_WRITE_INTERVAL** seconds, and whenever the process gets ``SIGUSR1``.
+    The protected LFNs are read again before each write.
+    Everything is listed again every **DAEMON_RESCAN_INTERVAL** seconds,
+    or as soon as the kernel reports that events were lost.
+    """
+
+    global PROTECTED_LIST, PROTECTED_INDEX  # pylint: disable=global-statement
+
+    check_conditions()
+
+    if config.WHICH_LIST != 'directories' or NAMESPACE is not None:
+        print 'The daemon only lists directories on the storage.'
+        return
+
+    PROTECTED_INDEX = ProtectedTrie(PROTECTED_LIST)
+
+    requested = {'write': False}
+
+    def request_write(*_):
+        """Asks for the deletion file to be written"""
+        requested['write'] = True
+
+    signal.signal(signal.SIGUSR1, request_write)
+
+    inotify = WatchTools.Inotify()
+    tree = WatchedTree(inotify)
+
+    try:
+        with METRICS.phase('scan'):
+            tree.scan()
+        print 'Watching %i directories' % len(tree.watches)
+
+        next_rescan = time.time() + config.DAEMON_RESCAN_INTERVAL
+        next_write = 0
+
+        while True:
+            lost = tree.update(1.0)
+
+            if lost or time.time() >= next_rescan:
+                print 'Events were lost. Rescanning.' if lost else 'Rescanning.'
+                with METRICS.phase('scan'):
+                    tree.scan()
+                next_rescan = time.time() + config.DAEMON_RESCAN_INTERVAL
+
+            if requested['write'] or time.time() >= next_write:
+                requested['write'] = False
+
+                with METRICS.phase('protected'):
+                    protected = sorted(get_protected())
+                if not protected:
+                    print 'No directories are protected. Keeping the previous list.'
+                elif protected != PROTECTED_LIST:
+                    PROTECTED_LIST = protected
+                    PROTECTED_INDEX = ProtectedTrie(PROTECTED_LIST)
+                    tree.update_protection()
+
+                with METRICS.phase('write'):
+                    dirs_to_delete = tree.deletions()
+                    if config.SCAN_MODE == 'decision':
+                        dirs_to_delete = add_sizes(dirs_to_delete)
+                    write_deletion_file(config.DELETION_FILE, dirs_to_delete)
+
+                print '%s: wrote %i directories to %s' % \
+                    (time.strftime('%Y-%m-%d %H:%M:%S'), len(dirs_to_delete),
+                     config.DELETION_FILE)
+                write_metrics('daemon')
+                next_write = time.time() + config.DAEMON_WRITE_INTERVAL
+
+    finally:
+        inotify.close()
+
+
+def parse_shard(text):
+    """
+    :param str text: is a shard given as ``I/N``, where I counts from 1
+    :returns: the shard number and the number of shards
+    :rtype: tuple
+    :raises ValueError: if *text* is not a valid shard
+    """
+
+    index, count = [int(number) for number in text.split('/')]
+    if not 1 <= index <= count:
+        raise ValueError('Shard %s is not between 1/%i and %i/%i' % (text, count, count, count))
+
+    return index, count
+
+
+def shard_of(subdir, count):
+    """
+    :param str subdir: is the name of a top level directory in the unmerged directory
+    :param int count: is the number of shards
+    :returns: the shard that lists the directory.
+              This is the same on every node and for every Python version.
+    :rtype: int
+    """
+
+    return int(hashlib.md5(subdir).hexdigest(), 16) % count + 1
+
+
+def shard_suffix(shard):
+    """
+    :param tuple shard: is the shard number and the number of shards
+    :returns: the suffix added to the deletion file and scan cache of the shard
+    :rtype: str
+    """
+
+    return '.shard-%i-of-%i' % shard
+
+
+def print_totals_row(num_upper, num_dirs, num_files, size_gb, name):
+    """
+    Prints a line of the table of deletions made by :py:func:`main`.
+
+    :param int num_upper: is the number of directories to delete
+    :param int num_dirs: is the number of directories below those
+    :param int num_files: is the number of files deleted
+    :param int size_gb: is the space freed, in GB
+    :param str name: is the top level directory, or ``'TOTALS'``
+    """
+
+    print "  %-8d %-8d %-6d %-9d %-s" % (num_upper, num_dirs, num_files, size_gb, name)
+
+
+def merge_shards():
+    """
+    Combines the partial deletion files written by ``ListDeletable.py --shard I/N``
+    into the deletion file, and prints the table of deletions for the full site.
+    The partial files are removed afterwards, so they cannot be merged twice.
+    If the partial file of any shard is missing, nothing is written and the script exits.
+    The same happens if the partial files were written by scans with different IDs,
+    or by a scan other than :py:data:`RUN_ID`, if that is set.
+    """
+
+    deletion_dir, deletion_name = os.path.split(config.DELETION_FILE)
+    partials = {}
+    for file_name in os.listdir(deletion_dir or '.'):
+        match = re.match(re.escape(deletion_name) + r'\.shard-(\d+)-of-(\d+)$', file_name)
+        if match:
+            partials[(int(match.group(1)), int(match.group(2)))] = \
+                os.path.join(deletion_dir, file_name)
+
+    counts = set([count for _, count in partials])
+    if len(counts) != 1:
+        print 'Need the partial deletion files of exactly one set of shards.'
+        print 'Found: %s' % (', '.join(sorted(partials.values())) or 'none')
+        exit()
+
+    count = counts.pop()
+    missing = [index for index in xrange(1, count + 1) if (index, count) not in partials]
+    if missing:
+        print 'Shards %s of %i have not finished.' % (', '.join([str(i) for i in missing]), count)
+        exit()
+
+    run_ids = dict([(index, read_run_id(partials[(index, count)]))
+                    for index in xrange(1, count + 1)])
+    if len(set(run_ids.values())) != 1 or (RUN_ID is not None and RUN_ID not in run_ids.values()):
+        print 'The partial deletion files are not all from %s.' % \
+            ('the same scan' if RUN_ID is None else 'the scan %s' % RUN_ID)
+        for index in sorted(run_ids):
+            print '  Shard %i of %i: run %s' % (index, count, run_ids[index])
+        print 'Run the shards from other scans again with the same --run-id.'
+        exit()
+
+    print "# Folders  Total    Total  DiskSize  FolderName"
+    print "#          Folders  Files  [GB]                "
+
+    totals = [0, 0, 0, 0]
+
+    by_top = {}
+    for index in xrange(1, count + 1):
+        with open(partials[(index, count)], 'r') as deletions:
+            for entry, _ in iter_deletion_entries(deletions,
+                                                  metadata=partials[(index, count)] + '.meta'):
+                top_dir = entry.pfn[len(config.UNMERGED_DIR_LOCATION):].strip('/').split('/')[0]
+                by_top.setdefault(top_dir, []).append(entry)
+
+    merged = []
+    for top_dir in sorted(by_top):
+        entries = by_top[top_dir]
+        row = [len(entries), sum([entry.dirs for entry in entries]),
+               sum([entry.files for entry in entries]),
+               sum([entry.size for entry in entries]) / (1024 * 1024 * 1024)]
+        print_totals_row(*(row + [top_dir]))
+        totals = [total + value for total, value in zip(totals, row)]
+        merged.extend(entries)
+
+    print "-" * 30
+    print_totals_row(*(totals + ['TOTALS']))
+
+    write_deletion_entries(config.DELETION_FILE, merged)
+    for file_name in partials.itervalues():
+        os.remove(file_name)
+        if os.path.exists(file_name + '.meta'):
+            os.remove(file_name + '.meta')
+
+    print 'Merged %i shards into %s' % (count, config.DELETION_FILE)
+
+
+def write_metrics(action):
+    """
+    Prints the time spent in each phase, and writes :py:data:`METRICS`
+    to ``unmerged_cleaner_<action>.json`` and ``unmerged_cleaner_<action>.prom``
+    in **METRICS_DIR**, if it is set.
+
+    :param str action: is either ``'list'`` or ``'delete'``
+    """
+
+    print METRICS.summary()
+
+    if not config.METRICS_DIR:
+        return
+
+    METRICS.labels.update({'site': config.SITE_NAME, 'mode': config.WHICH_LIST,
+                           'action': action})
+    if SHARD is not None:
+        METRICS.labels['shard'] = '%i/%i' % SHARD
+        action += shard_suffix(SHARD).replace('.', '_').replace('-', '_')
+
+    try:
+        if not os.path.exists(config.METRICS_DIR):
+            os.makedirs(config.METRICS_DIR)
+        for suffix, writer in [('json', METRICS.write_json),
+                               ('prom', METRICS.write_prometheus)]:
+            writer(os.path.join(config.METRICS_DIR, 'unmerged_cleaner_%s.%s' % (action, suffix)))
+    except (IOError, OSError) as msg:
+        print 'Cannot write metrics to %s: %s' % (config.METRICS_DIR, msg)
+
+
+def parse_ages(text):
+    """
+    :param str text: is a comma-separated list of ages in days, like ``'3,7,14,30'``
+    :returns: the ages in seconds, from youngest to oldest
+    :rtype: list
+    :raises ValueError: if an age is not a positive number
+    """
+
+    ages = sorted([int(float(days) * 60 * 60 * 24) for days in text.split(',')])
+    if not ages or ages[0] <= 0:
+        raise ValueError('ages must be positive numbers of days')
+
+    return ages
+
+
+def add_reclaimable(top_node, ages, totals):
+    """
+    Adds what could be deleted from a filled and aggregated tree with each MIN_AGE.
+    A directory is deletable with a given age if it is not protected, does not hold
+    anything protected, and its latest modification time is at least that old.
+    This is what :py:meth:`DataNode.aggregate` decides,
+    so the number of deletions for **MIN_AGE** itself is the same as for a normal listing.
+
+    :param DataNode top_node: is the top of the tree
+    :param list ages: is the MIN_AGE values to try, in seconds
+    :param list totals: has a list for each age, with the number of directories to delete,
+                        the directories and files below those, and the bytes freed,
+                        which are added to
+    """
+
+    for age, total in zip(ages, totals):
+        stack = [top_node]
+        while stack:
+            node = stack.pop()
+            if node.protected:
+                continue
+
+            if not node.holds_protected and NOW - node.latest >= age:
+                total[0] += 1
+                total[1] += node.nsubnodes
+                total[2] += node.nsubfiles
+                total[3] += node.size
+            else:
+                stack.extend(node.sub_nodes)
+
+
+def what_if(ages):
+    """
+    Lists the directories once, and prints a table of the directories, files and space
+    that could be deleted with each MIN_AGE, with a bar for the space.
+    Only one top level directory is kept in memory at a time.
+    Directories are listed with the smallest age as **MIN_AGE**,
+    and with a **SCAN_MODE** of ``'full'``, since the sizes below deletable directories are needed.
+    Nothing is written to the deletion file.
+
+    :param list ages: is the MIN_AGE values to try, in seconds
+    :returns: a list for each age, with the number of directories to delete,
+              the directories and files below those, and the bytes freed
+    :rtype: list
+    """
+
+    global PROTECTED_INDEX  # pylint: disable=global-statement
+
+    check_conditions()
+
+    if config.WHICH_LIST != 'directories':
+        print 'Only the listing of directories can try many ages.'
+        return
+
+    PROTECTED_INDEX = ProtectedTrie(PROTECTED_LIST)
+
+    dirs = [subdir for subdir in list_folder(config.UNMERGED_DIR_LOCATION, 'subdirs')
+            if subdir not in config.DIRS_TO_AVOID]
+    if SHARD is not None:
+        dirs = [subdir for subdir in dirs if shard_of(subdir, SHARD[1]) == SHARD[0]]
+
+    totals = [[0, 0, 0, 0] for _ in ages]
+    progress = MetricsTools.Progress('scan', len(dirs), 'top directories',
+                                     config.PROGRESS_INTERVAL)
+
+    min_age = config.MIN_AGE
+    scan_mode = config.SCAN_MODE
+    config.MIN_AGE = ages[0]
+    config.SCAN_MODE = 'full'
+    try:
+        for num_done, subdir in enumerate(dirs):
+            top_node = DataNode(subdir)
+            with METRICS.phase('scan'):
+                top_node.fill()
+            with METRICS.phase('traverse'):
+                add_reclaimable(top_node, ages, totals)
+            progress.update(num_done + 1)
+    finally:
+        config.MIN_AGE = min_age
+        config.SCAN_MODE = scan_mode
+
+    most = max([total[3] for total in totals]) or 1
+
+    print "What could be deleted with each minimum age"
+    print "# MinAge  Folders  Total    Total  DiskSize"
+    print "# [days]           Folders  Files  [GB]    "
+
+    for age, total in zip(ages, totals):
+        print "  %-8.3g %-8d %-8d %-6d %-9.1f %s" % \
+            (age / (60.0 * 60 * 24), total[0], total[1], total[2],
+             total[3] / 1024.0 ** 3, '#' * int(round(40.0 * total[3] / most)))
+
+    write_metrics('what-if')
+
+    return totals
+
+
+def main():
+    """
+    Does the full listing for the site given in the :file:`config.py` file.
+    If :py:data:`SHARD` is set, only the top level directories in that shard are listed,
+    and the deletion file and scan cache get the :py:func:`shard_suffix`.
+    """
+
+    global PROTECTED_INDEX, SCAN_CACHE  # pylint: disable=global-statement
+
+    check_conditions()
+
+    if SHARD is not None and config.WHICH_LIST != 'directories':
+        print 'Only the listing of directories can be split into shards.'
+        return
+
+    # Start checks
+    if config.WHICH_LIST == 'files':
+        if NAMESPACE is not None:
+            unmerged_files = iter_dump_files()
+        elif config.STORAGE_TYPE == 'hadoop':
+            unmerged_files = iter_unmerged_files_hadoop()
+        elif config.FILE_LISTER == 'find':
+            unmerged_files = iter_unmerged_files()
+        else:
+            unmerged_files = iter_old_files(config.SCAN_THREADS)
+
+        progress = MetricsTools.Progress('scan', None, 'files', config.PROGRESS_INTERVAL)
+
+        # Files are listed, checked and written as they stream, so this is one phase
+        with METRICS.phase('scan'):
+            filter_protected(progress.iterate(unmerged_files), PROTECTED_LIST)
+
+    elif config.WHICH_LIST == 'directories':
+        PROTECTED_INDEX = ProtectedTrie(PROTECTED_LIST)
+
+        deletion_file = config.DELETION_FILE
+        cache_file = config.SCAN_CACHE
+        if SHARD is not None:
+            deletion_file += shard_suffix(SHARD)
+            cache_file += shard_suffix(SHARD)
+
+        # A dump is already fast to read, so it does not use the cache
+        if config.SCAN_CACHE and NAMESPACE is None:
+            SCAN_CACHE = CacheTools.ScanCache(cache_file)
 
         print "Some statistics about what is going to be deleted"
         print "# Folders  Total    Total  DiskSize  FolderName"
@@ -573,6 +2796,9 @@ def main():
         dirs = [subdir for subdir in list_folder(config.UNMERGED_DIR_LOCATION, 'subdirs') \
                     if subdir not in config.DIRS_TO_AVOID]
 
+        if SHARD is not None:
+            dirs = [subdir for subdir in dirs if shard_of(subdir, SHARD[1]) == SHARD[0]]
+
         dirs_to_delete = []
 
         tot_upper_dirs = 0
@@ -580,12 +2806,40 @@ def main():
         tot_files = 0
         tot_site = 0
 
-        for subdir in dirs:
-            top_node = DataNode(subdir)
-            top_node.fill()
+        if config.TREE_TYPE == 'columnar':
+            tree_class = ColumnarTree
+        else:
+            tree_class = DataNode
+
+        if tree_class is DataNode and config.SCAN_THREADS > 1:
+            top_nodes = [DataNode(subdir) for subdir in dirs]
+            # The top directories are listed together, so their timings only cover traversal
+            with METRICS.phase('scan'):
+                fill_parallel(top_nodes, config.SCAN_THREADS)
+        else:
+            # Only keep one full tree at a time
+            top_nodes = (tree_class(subdir) for subdir in dirs)
+
+        progress = MetricsTools.Progress('scan', len(dirs), 'top directories',
+                                         config.PROGRESS_INTERVAL)
+
+        for num_done, top_node in enumerate(top_nodes):
+            start = time.time()
+            subdir = top_node.path_name
+            with METRICS.phase('scan'):
+                if top_node.can_vanish is None:
+                    top_node.fill()
 
             list_to_del = []
-            top_node.traverse_tree(list_to_del)
+            with METRICS.phase('traverse'):
+                top_node.traverse_tree(list_to_del)
+
+            if config.SCAN_MODE == 'decision':
+                with METRICS.phase('sizes'):
+                    list_to_del = add_sizes(list_to_del)
+
+            METRICS.add_top_dir(subdir, time.time() - start, deletions=len(list_to_del))
+            progress.update(num_done + 1)
 
             if len(list_to_del) < 1:
                 continue
@@ -600,9 +2854,8 @@ def main():
                 todelete_size += item.size
 
             todelete_size /= (1024 * 1024 * 1024)
-            print "  %-8d %-8d %-6d %-9d %-s" \
-                % (len(list_to_del), num_todelete_dirs, num_todelete_files,
-                   todelete_size, subdir)
+            print_totals_row(len(list_to_del), num_todelete_dirs, num_todelete_files,
+                             todelete_size, subdir)
 
             tot_upper_dirs += len(list_to_del)
             tot_dirs += num_todelete_dirs
@@ -612,21 +2865,23 @@ def main():
             dirs_to_delete.extend(list_to_del)
 
         print "-" * 30
-        print "  %-8d %-8d %-6d %-9d TOTALS" % (tot_upper_dirs, tot_dirs, tot_files, tot_site)
+        print_totals_row(tot_upper_dirs, tot_dirs, tot_files, tot_site, 'TOTALS')
 
-        deletion_dir = os.path.dirname(config.DELETION_FILE)
-        if not os.path.exists(deletion_dir):
-            os.makedirs(deletion_dir)
+        with METRICS.phase('write'):
+            write_deletion_file(deletion_file, dirs_to_delete,
+                                RUN_ID if SHARD is not None else None)
 
-        with open(config.DELETION_FILE, 'w') as del_file:
-            del_file.write(
-                '\n'.join(
-                    [os.path.join(config.UNMERGED_DIR_LOCATION, item.path_name) \
-                         for item in dirs_to_delete]
-                    ) + '\n')
+        if SCAN_CACHE is not None:
+            print 'Reused %i cached directory listings and listed %i directories' % \
+                (SCAN_CACHE.hits, SCAN_CACHE.misses)
+            SCAN_CACHE.save()
+            SCAN_CACHE = None
 
     else:
         print 'The WHICH_LIST parameter in config.py is not valid.'
+        return
+
+    write_metrics('list')
 
 
 # Generate documentation for the options in the configuration file.
@@ -635,27 +2890,75 @@ __doc__ %= '\n'.join(['- **%s** - %s' % (var, ConfigTools.DOCS[var].replace('\n'
 
 NOW = int(time.time())
 
+# The namespace dump to read instead of the storage, if any
+NAMESPACE = None
+
+# The StorageTools backend, made by get_storage() when first needed
+STORAGE = None
+STORAGE_KEY = None
+
+# The CacheTools.ScanCache used by the directory scan, if any
+SCAN_CACHE = None
+
+# The MetricsTools.Metrics of this run
+METRICS = MetricsTools.Metrics()
+
+# The shard number and number of shards given by --shard, if any
+SHARD = None
+
+# The ID of the sharded scan given by --run-id, if any
+RUN_ID = None
+
 
 if __name__ == '__main__':
 
     if OPTS.do_delete:
-        do_delete()
+        try:
+            TARGET_BYTES = parse_bytes(OPTS.target_bytes)
+        except ValueError as msg:
+            PARSER.error('Invalid --target-bytes %s: %s' % (OPTS.target_bytes, msg))
+
+        do_delete(OPTS.resume, TARGET_BYTES, OPTS.time_budget)
+
+    elif OPTS.merge:
+        RUN_ID = OPTS.run_id
+        merge_shards()
 
     else:
+        if OPTS.shard:
+            try:
+                SHARD = parse_shard(OPTS.shard)
+            except ValueError as msg:
+                PARSER.error('Invalid --shard %s: %s' % (OPTS.shard, msg))
+            RUN_ID = OPTS.run_id or time.strftime('%Y-%m-%d', time.gmtime(NOW))
+
+        if OPTS.what_if:
+            try:
+                AGES = parse_ages(OPTS.what_if)
+            except ValueError as msg:
+                PARSER.error('Invalid --what-if %s: %s' % (OPTS.what_if, msg))
+
         # The list of protected directories to not delete
-        PROTECTED_LIST = get_protected()
+        with METRICS.phase('protected'):
+            PROTECTED_LIST = get_protected()
         PROTECTED_LIST.sort()
-        PROTECTED_UPPER_DIRS = set()
+        PROTECTED_INDEX = ProtectedTrie()
 
-        # The lengths of these protected directories for optimization
-        ALL_LENGTHS = list(set(len(protected) for protected in PROTECTED_LIST))
-        ALL_LENGTHS.sort()
+        if OPTS.dump:
+            print 'Reading namespace dump %s' % OPTS.dump
+            NAMESPACE = DumpTools.NamespaceDump.from_file(
+                OPTS.dump, config.LFN_TO_CLEAN, OPTS.dump_format, config.UNMERGED_DIR_LOCATION)
 
-        main()
+        if OPTS.daemon:
+            run_daemon()
+        elif OPTS.what_if:
+            what_if(AGES)
+        else:
+            main()
 
 else:
 
     # Some empty lists that we'll populate for tests.
 
     PROTECTED_LIST = []
-    ALL_LENGTHS = []
+    PROTECTED_INDEX = ProtectedTrie()
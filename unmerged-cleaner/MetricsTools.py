@@ -0,0 +1,359 @@
+"""
+This module measures where the time of an unmerged cleaner run goes.
+It keeps the wall time of each phase, the number and latency of calls to the storage backend,
+and timings for each top level directory.
+The measurements are written as JSON and in the text format read by the
+textfile collector of the Prometheus node exporter,
+so that the cost of the nightly runs can be graphed over time.
+It does not depend on ``config.py``.
+"""
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import CacheTools
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100]
+
+
+class Histogram(object):
+    """
+    Counts calls of one operation, the items that they handled, and their latencies.
+    It can be updated from any number of threads.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty histogram.
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.calls = 0
+        self.items = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, items=1, error=False):
+        """
+        Records one call.
+
+        :param float seconds: is how long the call took
+        :param int items: is the number of paths or entries that the call handled
+        :param bool error: is True if the call raised an exception
+        """
+
+        index = bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.calls += 1
+            self.items += items
+            self.errors += error
+            self.seconds += seconds
+
+    def to_dict(self):
+        """
+        :returns: the contents of the histogram, with the bucket counts cumulative
+        :rtype: dict
+        """
+
+        buckets = []
+        total = 0
+        for bound, count in zip(BUCKETS + ['+Inf'], self.counts):
+            total += count
+            buckets.append([bound, total])
+
+        return {'calls': self.calls, 'items': self.items, 'errors': self.errors,
+                'seconds': self.seconds, 'buckets': buckets}
+
+
+class Metrics(object):
+    """
+    Holds all of the measurements of one run.
+    """
+
+    def __init__(self, labels=None):
+        """
+        Starts the measurements.
+        :param dict labels: are added to every Prometheus metric, like the site name
+        """
+        self.labels = labels or {}
+        self.start = time.time()
+        self.phases = {}
+        self.phase_order = []
+        self.operations = {}
+        self.top_dirs = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent inside of a ``with`` block to a phase.
+        A phase can be entered many times, and the times are summed.
+
+        :param str name: is the name of the phase
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name, seconds):
+        """
+        :param str name: is the name of a phase
+        :param float seconds: is time to add to the phase
+        """
+
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = 0.0
+                self.phase_order.append(name)
+            self.phases[name] += seconds
+
+    def operation(self, name):
+        """
+        :param str name: is the name of an operation, like ``'list'``
+        :returns: the histogram of the operation
+        :rtype: Histogram
+        """
+
+        histogram = self.operations.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.operations.setdefault(name, Histogram())
+
+        return histogram
+
+    def add_top_dir(self, name, seconds, **counts):
+        """
+        :param str name: is a top level directory in the unmerged directory
+        :param float seconds: is the time spent on the directory
+        :param counts: are other numbers to store for the directory, like the number of files
+        """
+
+        counts['seconds'] = seconds
+        with self.lock:
+            self.top_dirs[name] = counts
+
+    def summary(self):
+        """
+        :returns: a line giving the time of each phase
+        :rtype: str
+        """
+
+        return 'Time spent: ' + ', '.join(['%s %.1f s' % (name, self.phases[name])
+                                           for name in self.phase_order])
+
+    def to_dict(self):
+        """
+        :returns: all of the measurements
+        :rtype: dict
+        """
+
+        return {
+            'labels': self.labels,
+            'start': self.start,
+            'end': time.time(),
+            'phases': self.phases,
+            'operations': dict([(name, histogram.to_dict())
+                                for name, histogram in self.operations.iteritems()]),
+            'top_dirs': self.top_dirs
+            }
+
+    def write_json(self, file_name):
+        """
+        :param str file_name: is the name of the JSON file to write
+        """
+
+        CacheTools.write_atomic(file_name,
+                                json.dumps(self.to_dict(), indent=2, sort_keys=True) + '\n')
+
+    def prometheus_lines(self, prefix='unmerged_cleaner'):
+        """
+        :param str prefix: is the start of every metric name
+        :returns: the lines of the Prometheus text format
+        :rtype: list
+        """
+
+        def labels(**extra):
+            """Formats the labels of one sample"""
+            merged = dict(self.labels)
+            merged.update(extra)
+            if not merged:
+                return ''
+            return '{%s}' % ','.join(
+                ['%s="%s"' % (key, str(merged[key]).replace('\\', '\\\\').
+                              replace('"', '\\"').replace('\n', '\\n'))
+                 for key in sorted(merged)])
+
+        lines = []
+        measured = self.to_dict()
+
+        lines.append('# HELP %s_last_run_timestamp_seconds When the run finished.' % prefix)
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % prefix)
+        lines.append('%s_last_run_timestamp_seconds%s %f' % (prefix, labels(), measured['end']))
+
+        lines.append('# HELP %s_phase_seconds Wall time of each phase.' % prefix)
+        lines.append('# TYPE %s_phase_seconds gauge' % prefix)
+        for name in self.phase_order:
+            lines.append('%s_phase_seconds%s %f' % (prefix, labels(phase=name), self.phases[name]))
+
+        lines.append('# HELP %s_operation_seconds Latency of calls to the storage.' % prefix)
+        lines.append('# TYPE %s_operation_seconds histogram' % prefix)
+        for name in sorted(measured['operations']):
+            histogram = measured['operations'][name]
+            for bound, count in histogram['buckets']:
+                lines.append('%s_operation_seconds_bucket%s %i' %
+                             (prefix, labels(operation=name, le=bound), count))
+            lines.append('%s_operation_seconds_sum%s %f' %
+                         (prefix, labels(operation=name), histogram['seconds']))
+            lines.append('%s_operation_seconds_count%s %i' %
+                         (prefix, labels(operation=name), histogram['calls']))
+
+        for key, description in [('items', 'Paths or entries handled by calls to the storage.'),
+                                 ('errors', 'Calls to the storage that failed.')]:
+            lines.append('# HELP %s_operation_%s %s' % (prefix, key, description))
+            lines.append('# TYPE %s_operation_%s gauge' % (prefix, key))
+            for name in sorted(measured['operations']):
+                lines.append('%s_operation_%s%s %i' % (prefix, key, labels(operation=name),
+                                                       measured['operations'][name][key]))
+
+        lines.append('# HELP %s_top_dir_seconds Time spent on each top level directory.' % prefix)
+        lines.append('# TYPE %s_top_dir_seconds gauge' % prefix)
+        for name in sorted(self.top_dirs):
+            lines.append('%s_top_dir_seconds%s %f' %
+                         (prefix, labels(dir=name), self.top_dirs[name]['seconds']))
+
+        return lines
+
+    def write_prometheus(self, file_name):
+        """
+        :param str file_name: is the name of the file to write.
+                              The textfile collector only reads files ending in ``.prom``.
+        """
+
+        CacheTools.write_atomic(file_name, '\n'.join(self.prometheus_lines()) + '\n')
+
+
+class TimedBackend(object):
+    """
+    Wraps a storage backend from :ref:`unmerged-storage-ref-ref`
+    and records every call to its bulk operations in a :py:class:`Metrics` object.
+    Everything else is passed to the wrapped backend.
+    """
+
+    def __init__(self, backend, metrics):
+        """
+        Wraps the backend.
+        :param StorageTools.Backend backend: is the backend to measure
+        :param Metrics metrics: is where the calls are recorded
+        """
+        self.backend = backend
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def timed(self, operation, function, *args):
+        """
+        Calls a function of the backend and records it.
+
+        :param str operation: is the name to record the call under
+        :param function function: is the function to call
+        :param args: are the arguments of the call.
+                     The items of a listing are its entries, and otherwise the paths passed.
+        :returns: what the function returns
+        """
+
+        start = time.time()
+        error = True
+        try:
+            output = function(*args)
+            error = False
+        finally:
+            if operation == 'list':
+                items = 0 if error else len(output)
+            else:
+                items = len(args[0])
+            self.metrics.operation(operation).observe(time.time() - start, items, error)
+
+        return output
+
+    def list_dir(self, path):
+        return self.timed('list', self.backend.list_dir, path)
+
+    def list_dir_until(self, path, newer_than):
+        return self.timed('list', self.backend.list_dir_until, path, newer_than)
+
+    def stat_many(self, paths):
+        return self.timed('stat', self.backend.stat_many, paths)
+
+    def delete_many(self, paths, recursive):
+        return self.timed('delete', self.backend.delete_many, paths, recursive)
+
+
+class Progress(object):
+    """
+    Prints a line every so often with how much of a phase is done,
+    the rate, and the expected time left.
+    """
+
+    def __init__(self, name, total, unit, interval):
+        """
+        Starts the clock.
+        :param str name: is the name of the phase
+        :param int total: is the amount of work in the phase, or ``None`` if not known
+        :param str unit: is what the work is counted in
+        :param float interval: is the least number of seconds between lines,
+                               or zero to print nothing
+        """
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.start = time.time()
+        self.last = self.start
+
+    def update(self, done):
+        """
+        Prints a line if enough time passed since the last one.
+
+        :param int done: is the amount of work done so far
+        """
+
+        now = time.time()
+        if not self.interval or now - self.last < self.interval:
+            return
+
+        self.last = now
+        rate = done / (now - self.start)
+        line = '%s: %i %s done, %.1f per second' % (self.name, done, self.unit, rate)
+
+        if self.total:
+            line += ', %.1f%% of %i' % (100.0 * done / self.total, self.total)
+            if rate:
+                left = int((self.total - done) / rate)
+                line += ', ETA %02i:%02i:%02i' % (left / 3600, left / 60 % 60, left % 60)
+
+        print line
+
+    def iterate(self, items):
+        """
+        :param items: are the items of work
+        :type items: list or generator
+        :returns: the same items, updating the progress for each one
+        :rtype: generator
+        """
+
+        done = 0
+        for item in items:
+            yield item
+            done += 1
+            self.update(done)
@@ -0,0 +1,250 @@
+"""
+This module removes files and directory trees from a POSIX file system
+by working relative to open directory file descriptors, the ``openat`` and ``unlinkat`` pattern.
+Each directory is opened once, and its entries are removed by name,
+so the file system does not resolve the full path again for every unlink.
+This saves many metadata lookups on file systems like Lustre or NFS.
+
+The first of these ways that works is used:
+
+- the ``dir_fd`` arguments of the ``os`` module, in Python 3.3 and later
+- ``openat`` and ``unlinkat`` from the C library, through ``ctypes``, on Linux
+- full paths, if neither of those is available
+
+It does not depend on ``config.py``.
+"""
+
+import errno
+import os
+
+try:
+    import ctypes
+    import ctypes.util
+    LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    LIBC.openat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    LIBC.unlinkat.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    LIBC = None
+
+
+# Directories are opened without following symbolic links, like shutil.rmtree
+DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+
+# The unlinkat flag to remove a directory on Linux
+AT_REMOVEDIR = 0x200
+
+
+class PathOps(object):
+    """
+    Removes entries using full paths.
+    The handle of a directory is its path.
+    """
+
+    def open_top(self, path):
+        """
+        :param str path: is the full path of a directory
+        :returns: a handle for the directory
+        """
+        return path
+
+    def open_dir(self, parent, name):
+        """
+        :param parent: is the handle of a directory
+        :param str name: is the name of a subdirectory
+        :returns: a handle for the subdirectory
+        :raises OSError: if the subdirectory cannot be opened
+        """
+        if not os.path.isdir(os.path.join(parent, name)):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), name)
+        return os.path.join(parent, name)
+
+    def list_dir(self, handle):
+        """
+        :param handle: is the handle of a directory
+        :returns: the names of the entries in the directory
+        :rtype: list
+        """
+        return os.listdir(handle)
+
+    def unlink(self, parent, name):
+        """
+        :param parent: is the handle of a directory
+        :param str name: is the name of a file to remove from it
+        """
+        os.unlink(os.path.join(parent, name))
+
+    def rmdir(self, parent, name):
+        """
+        :param parent: is the handle of a directory
+        :param str name: is the name of an empty subdirectory to remove from it
+        """
+        os.rmdir(os.path.join(parent, name))
+
+    def close(self, handle):
+        """
+        :param handle: is the handle of a directory that is no longer needed
+        """
+        pass
+
+
+class FdOps(PathOps):
+    """
+    Removes entries relative to directory file descriptors using the ``dir_fd``
+    arguments of the ``os`` module.
+    """
+
+    def open_top(self, path):
+        return os.open(path, DIR_FLAGS)
+
+    def open_dir(self, parent, name):
+        return os.open(name, DIR_FLAGS, dir_fd=parent)
+
+    def unlink(self, parent, name):
+        os.unlink(name, dir_fd=parent)
+
+    def rmdir(self, parent, name):
+        os.rmdir(name, dir_fd=parent)
+
+    def close(self, handle):
+        os.close(handle)
+
+
+class LibcOps(FdOps):
+    """
+    Removes entries relative to directory file descriptors
+    by calling ``openat`` and ``unlinkat`` from the C library.
+    Directories are listed through ``/proc/self/fd``, which does not look up their paths again.
+    """
+
+    @staticmethod
+    def check(result, name):
+        """
+        :param int result: is the return value of a C library call
+        :param str name: is the entry that the call was for
+        :returns: *result*
+        :raises OSError: if the call failed
+        """
+
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), name)
+
+        return result
+
+    def open_dir(self, parent, name):
+        return self.check(LIBC.openat(parent, name, DIR_FLAGS), name)
+
+    def list_dir(self, handle):
+        return os.listdir('/proc/self/fd/%i' % handle)
+
+    def unlink(self, parent, name):
+        self.check(LIBC.unlinkat(parent, name, 0), name)
+
+    def rmdir(self, parent, name):
+        self.check(LIBC.unlinkat(parent, name, AT_REMOVEDIR), name)
+
+
+def best_ops():
+    """
+    :returns: the fastest way of removing entries that works here
+    :rtype: PathOps
+    """
+
+    supports_dir_fd = getattr(os, 'supports_dir_fd', set())
+    if set([os.open, os.unlink, os.rmdir]) <= supports_dir_fd and \
+            os.listdir in getattr(os, 'supports_fd', set()):
+        return FdOps()
+
+    if LIBC is not None and hasattr(LIBC, 'openat') and hasattr(LIBC, 'unlinkat') and \
+            os.path.isdir('/proc/self/fd'):
+        return LibcOps()
+
+    return PathOps()
+
+
+OPS = best_ops()
+
+
+def delete_files(directory, names, ops=None):
+    """
+    Removes files from one directory, opening the directory only once.
+    An error for one file does not stop the others from being removed.
+
+    :param str directory: is the full path of the directory
+    :param list names: is the names of the files inside of the directory
+    :param PathOps ops: is the way to remove entries. The default is :py:data:`OPS`.
+    :returns: for each file, ``None`` if it was removed, or the OSError raised
+    :rtype: list
+    """
+
+    ops = ops or OPS
+
+    try:
+        handle = ops.open_top(directory)
+    except OSError as err:
+        return [err] * len(names)
+
+    errors = []
+    try:
+        for name in names:
+            try:
+                ops.unlink(handle, name)
+                errors.append(None)
+            except OSError as err:
+                errors.append(err)
+    finally:
+        ops.close(handle)
+
+    return errors
+
+
+def delete_tree(path, ops=None):
+    """
+    Removes a directory and everything inside of it.
+    Entries are first removed as files, and only opened as directories when that fails,
+    so nothing needs to be stat-ed.
+    The tree is walked with a stack, holding one open directory for each level.
+
+    :param str path: is the full path of the directory
+    :param PathOps ops: is the way to remove entries. The default is :py:data:`OPS`.
+    :raises OSError: for the first entry that cannot be removed
+    """
+
+    ops = ops or OPS
+    parent, name = os.path.split(path.rstrip('/'))
+
+    top = ops.open_top(parent)
+    handles = [top]
+
+    try:
+        handle = ops.open_dir(top, name)
+        handles.append(handle)
+        # Each level holds the parent handle, the name in the parent, and the entries left
+        stack = [(top, name, handle, iter(ops.list_dir(handle)))]
+
+        while stack:
+            parent, name, handle, entries = stack[-1]
+
+            for entry in entries:
+                try:
+                    ops.unlink(handle, entry)
+                except OSError as err:
+                    # Linux gives EISDIR for a directory, but POSIX says EPERM
+                    if err.errno not in (errno.EISDIR, errno.EPERM):
+                        raise
+                    try:
+                        sub_handle = ops.open_dir(handle, entry)
+                    except OSError:
+                        raise err
+                    handles.append(sub_handle)
+                    stack.append((handle, entry, sub_handle, iter(ops.list_dir(sub_handle))))
+                    break
+
+            else:
+                stack.pop()
+                ops.close(handles.pop())
+                ops.rmdir(parent, name)
+
+    finally:
+        while handles:
+            ops.close(handles.pop())
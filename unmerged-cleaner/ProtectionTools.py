@@ -0,0 +1,233 @@
+"""
+This module holds tools for quickly checking paths against the list of protected LFNs.
+It does not depend on ``config.py``, so other tools can use it
+to load an index saved by :py:meth:`ProtectedTrie.save`.
+"""
+
+import json
+
+
+class ProtectedTrie(object):
+    """
+    An index of protected LFNs, stored as a tree of path components.
+    Checking a path only takes one step for each directory level in the path,
+    independent of the number of protected LFNs.
+    """
+
+    # Results of lookup()
+    NOT_PROTECTED = 0
+    PROTECTED = 1
+    HOLDS_PROTECTED = 2
+
+    # Key marking the end of a protected path. Path components are never empty.
+    END = ''
+
+    def __init__(self, lfns=None):
+        """
+        Initializes the index.
+        :param list lfns: is a list of protected LFNs to add to the index
+        """
+        self.root = {}
+        for lfn in lfns or []:
+            self.add(lfn)
+
+    @staticmethod
+    def split(path):
+        """
+        :param str path: is an LFN or other path
+        :returns: the non-empty components of the path
+        :rtype: list
+        """
+
+        return [part for part in path.split('/') if part]
+
+    def add(self, lfn):
+        """
+        Adds a protected LFN to the index.
+
+        :param str lfn: is the LFN to protect
+        """
+
+        node = self.root
+        for part in self.split(lfn):
+            node = node.setdefault(part, {})
+
+        node[self.END] = 1
+
+    def lookup(self, path):
+        """
+        Checks a path with a single walk down the index.
+
+        :param str path: is the LFN of a directory or file
+        :returns: :py:data:`PROTECTED` if the path or one of its parents is protected,
+                  :py:data:`HOLDS_PROTECTED` if something below the path is protected,
+                  and :py:data:`NOT_PROTECTED` otherwise
+        :rtype: int
+        """
+
+        node = self.root
+        for part in self.split(path):
+            if self.END in node:
+                return self.PROTECTED
+            node = node.get(part)
+            if node is None:
+                return self.NOT_PROTECTED
+
+        if self.END in node:
+            return self.PROTECTED
+
+        return self.HOLDS_PROTECTED if node else self.NOT_PROTECTED
+
+    def is_protected(self, path):
+        """
+        :param str path: is the LFN of a directory or file
+        :returns: whether or not the path is exactly a protected LFN
+        :rtype: bool
+        """
+
+        node = self.root
+        for part in self.split(path):
+            node = node.get(part)
+            if node is None:
+                return False
+
+        return self.END in node
+
+    def is_under(self, path):
+        """
+        :param str path: is the LFN of a directory or file
+        :returns: whether or not the path, or one of its parents, is protected
+        :rtype: bool
+        """
+
+        return self.lookup(path) == self.PROTECTED
+
+    def holds_protected(self, path):
+        """
+        :param str path: is the LFN of a directory
+        :returns: whether or not something below the path is protected
+        :rtype: bool
+        """
+
+        return self.lookup(path) == self.HOLDS_PROTECTED
+
+    def save(self, file_name):
+        """
+        Saves the index so that it can be loaded without being rebuilt.
+
+        :param str file_name: is the name of the file to write
+        """
+
+        with open(file_name, 'w') as index_file:
+            json.dump(self.root, index_file, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Loads an index saved by :py:meth:`save`.
+
+        :param str file_name: is the name of the file to read
+        :returns: the loaded index
+        :rtype: ProtectedTrie
+        """
+
+        index = cls()
+        with open(file_name, 'r') as index_file:
+            index.root = json.load(index_file)
+
+        return index
+
+
+class PatternMatcher(object):
+    """
+    Finds every pattern, out of a fixed set, that appears anywhere inside a string.
+    This is an Aho-Corasick automaton, so checking a string takes time proportional
+    to the length of the string, no matter how many patterns there are.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty matcher. Add patterns with :py:meth:`add`.
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.values = [[]]
+        self.output = [[]]
+        self.built = True
+
+    def add(self, pattern, value):
+        """
+        Adds a pattern to the matcher.
+
+        :param str pattern: is the substring to look for
+        :param value: is returned by :py:meth:`find` when *pattern* is found.
+                      A value is returned once for each time it was added.
+        """
+
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.values.append([])
+            state = next_state
+
+        self.values[state].append(value)
+        self.built = False
+
+    def build(self):
+        """
+        Links the states of the automaton. This is called by :py:meth:`find` if needed.
+        """
+
+        self.output = list(self.values)
+
+        queue = list(self.goto[0].values())
+        for state in queue:
+            self.fail[state] = 0
+
+        # Breadth first, so shorter prefixes are always linked first
+        for state in queue:
+            for char, next_state in self.goto[state].iteritems():
+                queue.append(next_state)
+
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+
+                # Patterns ending here also end all of the patterns that are suffixes
+                self.output[next_state] = \
+                    self.values[next_state] + self.output[self.fail[next_state]]
+
+        self.built = True
+
+    def find(self, text):
+        """
+        :param str text: is the string to search
+        :returns: the values of all the patterns found in *text*,
+                  in the order that the patterns end in *text*
+        :rtype: list
+        """
+
+        if not self.built:
+            self.build()
+
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+
+        found = []
+        state = 0
+
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.extend(output[state])
+
+        return found
@@ -0,0 +1,590 @@
+"""
+This module holds the storage backends of the unmerged cleaner.
+A backend is everything that ``ListDeletable.py`` needs from a storage system:
+listing a directory along with the sizes and modification times of its entries,
+getting the stats of many paths at once, and deleting many paths at once.
+All paths given to a backend are PFNs.
+
+``ListDeletable.py`` uses the backend in :py:data:`BACKENDS` named by **STORAGE_TYPE**,
+or a :py:class:`DumpBackend` when reading a namespace dump.
+A site can add an optimized backend by subclassing :py:class:`Backend`
+and adding the class to :py:data:`BACKENDS`, without changing the scan or deletion code.
+
+It does not depend on ``config.py``.
+"""
+
+import errno
+import os
+import re
+import stat
+import subprocess
+from collections import namedtuple
+from itertools import groupby
+
+# scandir gives the entry type without a stat on most file systems.
+# It is in the standard library since Python 3.5 and on PyPI before that.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import PosixTools
+
+
+FolderEntry = namedtuple('FolderEntry', ['name', 'is_dir', 'size', 'mtime'])
+"""
+A single listing from :py:meth:`Backend.list_dir`, or the stats of a path from
+:py:meth:`Backend.stat_many`, where **name** is the full path.
+The **size** and **mtime** of a directory may be ``None`` if they were not needed to type it.
+"""
+
+
+def error_outcome(err):
+    """
+    :param OSError err: is the error raised while deleting a path, or ``None``
+    :returns: the outcome and message for :py:meth:`Backend.delete_many`
+    :rtype: tuple
+    """
+
+    if err is None:
+        return ('deleted', '')
+    if err.errno == errno.ENOENT:
+        return ('missing', '')
+    return ('failed', str(err))
+
+
+class Backend(object):
+    """
+    The interface of a storage backend.
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: is the configuration module of ``ListDeletable.py``,
+                       for backends that have their own options
+        :returns: a new backend
+        :rtype: Backend
+        """
+
+        return cls()
+
+    def list_dir(self, path):
+        """
+        Lists a directory with one call to the storage.
+        Entries that are neither directories nor regular files,
+        or that disappear during the listing, are skipped.
+
+        :param str path: is the directory to list
+        :returns: the contents of the directory
+        :rtype: list of FolderEntry
+        :raises OSError: if the directory cannot be listed
+        """
+
+        raise NotImplementedError
+
+    def list_dir_until(self, path, newer_than):
+        """
+        Lists a directory like :py:meth:`list_dir`, but may stop getting the stats
+        of files once one is found that was modified after a given time.
+        That is enough to know that the directory is too new to delete.
+        Backends that get the stats along with the listing do not need to change this.
+
+        :param str path: is the directory to list
+        :param float newer_than: is the time after which a file is too new
+        :returns: the contents of the directory.
+                  Files after the first new one may have a **size** and **mtime** of ``None``.
+        :rtype: list of FolderEntry
+        :raises OSError: if the directory cannot be listed
+        """
+
+        return self.list_dir(path)
+
+    def stat_many(self, paths):
+        """
+        :param list paths: is the directories and files to check
+        :returns: for each path, its stats or ``None`` if it does not exist
+        :rtype: list of FolderEntry
+        """
+
+        raise NotImplementedError
+
+    def delete_many(self, paths, recursive):
+        """
+        Deletes paths, continuing after any errors.
+
+        :param list paths: is the directories or files to delete
+        :param bool recursive: is True if the paths are directories to delete with their contents
+        :returns: for each path, the outcome (``'deleted'``, ``'missing'``,
+                  ``'skipped'`` or ``'failed'``) and a message
+        :rtype: list of tuples
+        """
+
+        raise NotImplementedError
+
+    def delete_group_size(self, recursive):
+        """
+        :param bool recursive: is True when deleting directories
+        :returns: the most paths to pass to one :py:meth:`delete_many` call
+        :rtype: int
+        """
+
+        return 1 if recursive else 1000
+
+    def delete_cost(self, paths, recursive):
+        """
+        :param list paths: is a group of paths passed to :py:meth:`delete_many`
+        :param bool recursive: is True when deleting directories
+        :returns: the number of operations that the group counts as when limiting the deletion rate
+        :rtype: int
+        """
+
+        return len(paths)
+
+
+class PosixBackend(Backend):
+    """
+    A file system with a POSIX interface, which is also the default.
+    Directories and files are deleted using :ref:`unmerged-posix-ref-ref`.
+    """
+
+    def list_dir(self, path):
+        output = []
+
+        if scandir is not None:
+            for entry in scandir(path):
+                try:
+                    if entry.is_dir():
+                        output.append(FolderEntry(entry.name, True, None, None))
+                    elif entry.is_file():
+                        stats = entry.stat()
+                        output.append(FolderEntry(entry.name, False,
+                                                  stats.st_size, stats.st_mtime))
+                except OSError:
+                    continue
+
+        else:
+            for listing in os.listdir(path):
+                try:
+                    stats = os.stat(os.path.join(path, listing))
+                except OSError:
+                    continue
+
+                if stat.S_ISDIR(stats.st_mode):
+                    output.append(FolderEntry(listing, True, stats.st_size, stats.st_mtime))
+                elif stat.S_ISREG(stats.st_mode):
+                    output.append(FolderEntry(listing, False, stats.st_size, stats.st_mtime))
+
+        return output
+
+    def list_dir_until(self, path, newer_than):
+        if scandir is None:
+            return self._list_dir_until_stat(path, newer_than)
+
+        output = []
+        found_new = False
+
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    output.append(FolderEntry(entry.name, True, None, None))
+                elif entry.is_file():
+                    if found_new:
+                        output.append(FolderEntry(entry.name, False, None, None))
+                        continue
+                    stats = entry.stat()
+                    output.append(FolderEntry(entry.name, False, stats.st_size, stats.st_mtime))
+                    found_new = stats.st_mtime > newer_than
+            except OSError:
+                continue
+
+        return output
+
+    def _list_dir_until_stat(self, path, newer_than):
+        """
+        Does :py:meth:`list_dir_until` without scandir, where each entry needs an ``lstat``.
+        After the first new file, entries are only stat-ed until the link count
+        of the directory shows that every subdirectory was found,
+        and the rest are returned as files without stats.
+        File systems that do not count subdirectory links have every entry stat-ed.
+        """
+
+        # Each subdirectory links to its parent with '..'
+        links = os.lstat(path).st_nlink
+        subdirs_left = links - 2 if links >= 2 else None
+        output = []
+        found_new = False
+
+        for listing in os.listdir(path):
+            if found_new and subdirs_left is not None and subdirs_left <= 0:
+                output.append(FolderEntry(listing, False, None, None))
+                continue
+
+            try:
+                stats = os.lstat(os.path.join(path, listing))
+            except OSError:
+                continue
+
+            if stat.S_ISDIR(stats.st_mode):
+                if subdirs_left is not None:
+                    subdirs_left -= 1
+                output.append(FolderEntry(listing, True, stats.st_size, stats.st_mtime))
+            elif not stat.S_ISREG(stats.st_mode):
+                continue
+            elif found_new:
+                output.append(FolderEntry(listing, False, None, None))
+            else:
+                output.append(FolderEntry(listing, False, stats.st_size, stats.st_mtime))
+                found_new = stats.st_mtime > newer_than
+
+        return output
+
+    def stat_many(self, paths):
+        output = []
+        for path in paths:
+            try:
+                stats = os.stat(path)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                output.append(None)
+                continue
+
+            output.append(FolderEntry(path, stat.S_ISDIR(stats.st_mode),
+                                      stats.st_size, stats.st_mtime))
+
+        return output
+
+    def delete_many(self, paths, recursive):
+        output = []
+
+        if recursive:
+            for path in paths:
+                try:
+                    PosixTools.delete_tree(path)
+                    output.append(error_outcome(None))
+                except OSError as err:
+                    output.append(error_outcome(err))
+
+        else:
+            # Each directory is opened once for all of its files in the group
+            for directory, files in groupby(paths, os.path.dirname):
+                files = list(files)
+                output.extend([error_outcome(err) for err in PosixTools.delete_files(
+                    directory, [os.path.basename(path) for path in files])])
+
+        return output
+
+
+class HadoopBackend(PosixBackend):
+    """
+    A Hadoop file system, listed through its mount point.
+    Directories are deleted along with their checksum directories,
+    by one ``hdfs dfs -rm -r`` command for each group, so that the JVM is only started once.
+    """
+
+    def __init__(self, batch_size=100, mount_point='/mnt/hadoop'):
+        """
+        Initializes the backend.
+        :param int batch_size: is the most paths given to one ``hdfs`` command
+        :param str mount_point: is the location of the hadoop mount point
+        """
+        self.batch_size = batch_size
+        self.mount_point = mount_point
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.HADOOP_BATCH_SIZE)
+
+    def mounted(self, directory):
+        """
+        :param str directory: is a path inside of Hadoop
+        :returns: the location of the path on the mount
+        :rtype: str
+        """
+
+        return os.path.normpath(os.path.sep.join([self.mount_point, directory]))
+
+    @staticmethod
+    def error_lines(stderr, directory):
+        """
+        :param str stderr: is the error output of an ``hdfs`` command
+        :param str directory: is one of the paths given to the command
+        :returns: the lines of the output about that path.
+                  The path has to be the whole word, so the lines about
+                  ``/a/dir_1`` are not given for ``/a/dir``.
+        :rtype: list
+        """
+
+        # hdfs quotes paths with `' in its messages
+        word = re.compile(r'(?:^|[\s`\'"])%s(?=$|[\s`\'"])' % re.escape(directory))
+        return [line for line in stderr.splitlines() if word.search(line)]
+
+    def hdfs_delete(self, directories):
+        """
+        Deletes many directories with a single ``hdfs dfs -rm -r`` command.
+        Directories that are not found under the mount point are skipped.
+
+        :param list directories: The directory names for hdfs to delete.
+                                 These are not exactly the same as the LFNs or PFNs.
+        :returns: For each directory that was attempted, ``None`` if the directory is gone
+                  after the command, or the error from hdfs if it is not
+        :rtype: dict
+        """
+
+        # Check if path is still there in case checksum is actually in a different place
+        # than we are expecting at the moment.
+        existing = [directory for directory in directories
+                    if os.path.exists(self.mounted(directory))]
+        if not existing:
+            return {}
+
+        out = subprocess.Popen(['hdfs', 'dfs', '-rm', '-r'] + existing,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = out.communicate()
+
+        # hdfs only gives one exit code, so check each path afterwards
+        statuses = {}
+        for directory in existing:
+            if os.path.exists(self.mounted(directory)):
+                statuses[directory] = ' '.join(self.error_lines(stderr, directory)) or \
+                    'hdfs exited with status %i' % out.returncode
+            else:
+                statuses[directory] = None
+
+        return statuses
+
+    def delete_many(self, paths, recursive):
+        if not recursive:
+            return PosixBackend.delete_many(self, paths, recursive)
+
+        hdfs_paths = []
+        for path in paths:
+            # Hadoop stores also a directory with checksums
+            hdfs_paths.append(path.replace(self.mount_point, '/cksums'))
+            # Delete the unmerged directory
+            hdfs_paths.append(path.replace(self.mount_point, ''))
+
+        statuses = self.hdfs_delete(hdfs_paths)
+
+        output = []
+        for cksum, data in zip(hdfs_paths[::2], hdfs_paths[1::2]):
+            if data not in statuses:
+                output.append(('missing', ''))
+            elif statuses[data] or statuses.get(cksum):
+                output.append(('failed', statuses[data] or statuses[cksum]))
+            else:
+                output.append(('deleted', ''))
+
+        return output
+
+    def delete_group_size(self, recursive):
+        if recursive:
+            # Each directory is deleted with its checksum directory
+            return max(1, self.batch_size / 2)
+
+        return PosixBackend.delete_group_size(self, recursive)
+
+    def delete_cost(self, paths, recursive):
+        return 1 if recursive else len(paths)
+
+
+class DcacheBackend(PosixBackend):
+    """
+    A dCache system, listed through its NFS mount.
+    Deleting directories is not implemented yet.
+    Try posix or adding it to :py:meth:`DcacheBackend.delete_many` in ``StorageTools.py``.
+    """
+
+    def delete_many(self, paths, recursive):
+        if recursive:
+            return [('skipped', 'dCache deletion is not implemented')] * len(paths)
+
+        return PosixBackend.delete_many(self, paths, recursive)
+
+
+class MemoryBackend(Backend):
+    """
+    A storage system simulated in memory, for tests and benchmarks.
+    Fill it with :py:meth:`add`.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty storage system.
+        """
+        # The directory flag, size, and modification time of each path
+        self.stats = {}
+        # The names inside of each directory
+        self.children = {}
+
+    def add(self, path, is_dir=False, size=0, mtime=0):
+        """
+        Adds an entry, and any parent directories that are missing.
+
+        :param str path: is the full path of the entry
+        :param bool is_dir: is whether or not the entry is a directory
+        :param int size: is the size of a file
+        :param float mtime: is the modification time of the entry and of new parents
+        """
+
+        path = os.path.normpath(path)
+
+        missing = []
+        parent = os.path.dirname(path)
+        while parent not in self.children and os.path.dirname(parent) != parent:
+            missing.append(parent)
+            parent = os.path.dirname(parent)
+
+        if parent not in self.children:
+            self.stats[parent] = (True, 0, mtime)
+            self.children[parent] = set()
+
+        for directory in reversed(missing):
+            self.insert(directory, True, 0, mtime)
+
+        self.insert(path, is_dir, size, mtime)
+
+    def insert(self, path, is_dir, size, mtime):
+        """
+        Adds an entry to a parent directory that already exists.
+
+        :param str path: is the normalized full path of the entry
+        :param bool is_dir: is whether or not the entry is a directory
+        :param int size: is the size of a file
+        :param float mtime: is the modification time of the entry
+        """
+
+        self.stats[path] = (is_dir, size, mtime)
+        if is_dir:
+            self.children.setdefault(path, set())
+        self.children[os.path.dirname(path)].add(os.path.basename(path))
+
+    def list_dir(self, path):
+        path = os.path.normpath(path)
+        if path not in self.children:
+            code = errno.ENOTDIR if path in self.stats else errno.ENOENT
+            raise OSError(code, os.strerror(code), path)
+
+        return [FolderEntry(name, *self.stats[os.path.join(path, name)])
+                for name in self.children[path]]
+
+    def list_dir_until(self, path, newer_than):
+        # Acts like a file system, so that benchmarks see what is skipped
+        output = []
+        found_new = False
+
+        for entry in self.list_dir(path):
+            if found_new and not entry.is_dir:
+                entry = FolderEntry(entry.name, False, None, None)
+            elif not entry.is_dir:
+                found_new = entry.mtime > newer_than
+            output.append(entry)
+
+        return output
+
+    def stat_many(self, paths):
+        output = []
+        for path in paths:
+            stats = self.stats.get(os.path.normpath(path))
+            output.append(stats and FolderEntry(path, *stats))
+
+        return output
+
+    def delete_many(self, paths, recursive):
+        output = []
+
+        for path in paths:
+            path = os.path.normpath(path)
+            stats = self.stats.get(path)
+
+            if stats is None:
+                output.append(('missing', ''))
+                continue
+
+            if stats[0] != recursive:
+                code = errno.EISDIR if stats[0] else errno.ENOTDIR
+                output.append(('failed', os.strerror(code)))
+                continue
+
+            self.children[os.path.dirname(path)].discard(os.path.basename(path))
+            removing = [path]
+            while removing:
+                next_path = removing.pop()
+                del self.stats[next_path]
+                removing.extend([os.path.join(next_path, name)
+                                 for name in self.children.pop(next_path, ())])
+
+            output.append(('deleted', ''))
+
+        return output
+
+
+class DumpBackend(Backend):
+    """
+    Reads a :py:class:`DumpTools.NamespaceDump` instead of the storage system.
+    A dump cannot be changed, so nothing is deleted.
+    """
+
+    def __init__(self, namespace, top):
+        """
+        Initializes the backend.
+        :param DumpTools.NamespaceDump namespace: is the loaded dump
+        :param str top: is the PFN of the unmerged directory that the dump holds
+        """
+        self.namespace = namespace
+        self.top = top
+
+    def relative(self, path):
+        """
+        :param str path: is the PFN of a directory or file
+        :returns: the path relative to the unmerged directory, which is used by the dump
+        :rtype: str
+        :raises OSError: if the path is not inside the unmerged directory
+        """
+
+        if not path.startswith(self.top):
+            raise OSError(errno.ENOENT, 'Not in the unmerged directory', path)
+
+        return path[len(self.top):].strip('/')
+
+    def list_dir(self, path):
+        return [FolderEntry(*entry) for entry in self.namespace.list_dir(self.relative(path))]
+
+    def stat_many(self, paths):
+        output = []
+        for path in paths:
+            relative = self.relative(path)
+            if relative in self.namespace.dir_mtimes:
+                output.append(FolderEntry(path, True, 0, self.namespace.dir_mtimes[relative]))
+                continue
+
+            parent, _, name = relative.rpartition('/')
+            found = None
+            if parent in self.namespace.dirs:
+                for entry in self.namespace.list_dir(parent):
+                    if entry[0] == name:
+                        found = FolderEntry(path, *entry[1:])
+                        break
+
+            output.append(found)
+
+        return output
+
+    def delete_many(self, paths, recursive):
+        return [('skipped', 'Cannot delete from a namespace dump')] * len(paths)
+
+
+BACKENDS = {
+    'posix': PosixBackend,
+    'hadoop': HadoopBackend,
+    'dcache': DcacheBackend,
+}
+"""
+The backend class for each **STORAGE_TYPE**.
+Tests and benchmarks add :py:class:`MemoryBackend` here themselves,
+so that a site cannot pick it by accident.
+"""
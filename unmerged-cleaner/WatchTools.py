@@ -0,0 +1,165 @@
+"""
+This module follows changes to directories using Linux inotify, through ``ctypes``,
+so that ``ListDeletable.py --daemon`` only lists the directories that changed.
+
+inotify only sees changes made through the kernel of the node that is watching.
+On network file systems, like NFS or Lustre, changes made by other nodes are not reported,
+so the daemon also rescans everything periodically.
+There is one watch for each directory, and their number is limited by
+``/proc/sys/fs/inotify/max_user_watches``.
+
+It does not depend on ``config.py``.
+"""
+
+import errno
+import os
+import select
+import struct
+from collections import namedtuple
+
+try:
+    import ctypes
+    import ctypes.util
+    LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    LIBC.inotify_init1.argtypes = [ctypes.c_int]
+    LIBC.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    LIBC.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    LIBC = None
+
+
+# Event flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+# Everything that can change the listing of a directory or the times of its files
+DIR_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# The fixed part of each event read from the inotify file descriptor
+EVENT_HEADER = struct.Struct('iIII')
+
+
+Event = namedtuple('Event', ['wd', 'mask', 'cookie', 'name'])
+"""
+One event from :py:meth:`Inotify.read`.
+**wd** is the watch of the directory, and **name** is the entry inside of it,
+or an empty string if the event is for the directory itself.
+"""
+
+
+def available():
+    """
+    :returns: whether or not inotify can be used here
+    :rtype: bool
+    """
+
+    return LIBC is not None and hasattr(LIBC, 'inotify_init1')
+
+
+class Inotify(object):
+    """
+    An inotify instance, with a watch for each directory that is followed.
+    """
+
+    def __init__(self):
+        """
+        Opens the instance.
+        :raises OSError: if inotify is not available
+        """
+        if not available():
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self.fd = self.check(LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC), 'inotify_init1')
+
+    @staticmethod
+    def check(result, name):
+        """
+        :param int result: is the return value of a C library call
+        :param str name: is what the call was for
+        :returns: *result*
+        :raises OSError: if the call failed
+        """
+
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), name)
+
+        return result
+
+    def add_watch(self, path, mask=DIR_EVENTS):
+        """
+        :param str path: is a directory to follow
+        :param int mask: is the events to report
+        :returns: the watch descriptor, which is the same if the directory is already watched
+        :rtype: int
+        :raises OSError: if the directory cannot be watched,
+                         with ``errno.ENOSPC`` if there are no watches left
+        """
+
+        return self.check(LIBC.inotify_add_watch(self.fd, path, mask), path)
+
+    def remove_watch(self, wd):
+        """
+        Stops following a directory. Watches of removed directories are already gone.
+
+        :param int wd: is the watch descriptor
+        """
+
+        LIBC.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """
+        :param float timeout: is the most seconds to wait for the first event
+        :returns: the events that are ready, or an empty list if there were none in time
+        :rtype: list of Event
+        """
+
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error as err:
+            # A signal interrupted the wait
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            events.append(Event(wd, mask, cookie, data[offset:offset + length].rstrip('\0')))
+            offset += length
+
+        return events
+
+    def close(self):
+        """
+        Closes the instance, which removes all of its watches.
+        """
+
+        os.close(self.fd)